@@ -1,28 +1,41 @@
-import io
+import json
 import logging
 import mimetypes
 import os
-import time
+import tempfile
+from typing import AsyncGenerator
 
 import openai
-from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
-from azure.storage.blob import BlobServiceClient
-from flask import (
+from azure.core.exceptions import ResourceNotFoundError
+from azure.identity.aio import DefaultAzureCredential
+from azure.search.documents.aio import SearchClient
+from azure.storage.blob.aio import BlobServiceClient
+from quart import (
     Blueprint,
-    Flask,
+    Quart,
     abort,
     current_app,
     jsonify,
+    make_response,
     request,
-    send_file,
     send_from_directory,
 )
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import unquote_etag
 
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.readdecomposeask import ReadDecomposeAsk
 from approaches.readretrieveread import ReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
+from core.answercache import AnswerCache
+from core.contentcache import BlobBody, CachedFileBody, ContentCache
+from core.embeddings import EmbeddingCache
+from core.indexgeneration import IndexGeneration
+from core.metrics import MetricsRegistry, MetricsStore, RequestMetrics
+from core.retriever import Retriever
+from core.searchcache import CachingSearchClient, SearchCache
+from core.tokenmanager import TokenManager
+from core.vectorindex import FallbackSearchClient, LocalSearchClient, LocalVectorIndex
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT", "mystorageaccount")
@@ -39,93 +52,220 @@ KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
 KB_FIELDS_CATEGORY = os.getenv("KB_FIELDS_CATEGORY", "category")
 KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
 
-CONFIG_OPENAI_TOKEN = "openai_token"
+# Query embeddings are cached in a SQLite file shared by all workers on the machine, set the path to "" to disable the cache
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(tempfile.gettempdir(), "querycache.sqlite3"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 3600))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 50000))
+
+# Search results are cached in the same kind of file until they expire or the index generation changes, set the TTL to 0 to disable the cache.
+# prepdocs.py writes a new generation to the metadata of the storage container whenever it uploads or removes documents
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", os.path.join(tempfile.gettempdir(), "querycache.sqlite3"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 600))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 10000))
+SEARCH_CACHE_GENERATION_REFRESH = float(os.getenv("SEARCH_CACHE_GENERATION_REFRESH", 30))
+# Must match index_generation_metadata_key in scripts/prepdocs.py
+INDEX_GENERATION_METADATA_KEY = "indexgeneration_" + AZURE_SEARCH_INDEX.replace("-", "_")
+
+# The rtr approach of /ask reuses the answer of a recent question for a new one with a cosine similarity of at least ANSWER_CACHE_THRESHOLD
+# between their embeddings, asked with the same overrides and index generation. The answers are kept in the memory of each worker.
+# Off by default (a TTL of 0): a paraphrase gets the answer of another question, tune the threshold on your questions and embedding model first
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 0))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000))
+
+# Embed the user question while the chat approach rewrites it into a search query, and use that embedding when the rewrite doesn't change the question
+CHAT_SPECULATIVE_EMBEDDING = os.getenv("CHAT_SPECULATIVE_EMBEDDING", "false").lower() == "true"
+
+# Search the vector and keyword index written by prepdocs.py --localindex in this directory in-process instead of Cognitive Search,
+# for small corpora and offline development (without semantic ranking). "" (the default) uses Cognitive Search
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "")
+# With a local index, set this to true to keep using Cognitive Search and only answer from the local index when it's throttled or unavailable
+LOCAL_INDEX_FALLBACK = os.getenv("LOCAL_INDEX_FALLBACK", "false").lower() == "true"
+
+# Content files served by /content are kept in a local directory shared by all workers, set the path to "" to disable the cache
+CONTENT_CACHE_PATH = os.getenv("CONTENT_CACHE_PATH", os.path.join(tempfile.gettempdir(), "contentcache"))
+CONTENT_CACHE_MAX_BYTES = int(os.getenv("CONTENT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# /metrics renders the metrics of all workers on the machine, which add theirs to this SQLite file every METRICS_FLUSH_INTERVAL seconds.
+# Set the path to "" to keep them in the memory of each worker, and scrape each worker instead
+METRICS_PATH = os.getenv("METRICS_PATH", os.path.join(tempfile.gettempdir(), "metrics.sqlite3"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+
+CONFIG_OPENAI_TOKEN_MANAGER = "openai_token_manager"
 CONFIG_CREDENTIAL = "azure_credential"
 CONFIG_ASK_APPROACHES = "ask_approaches"
 CONFIG_CHAT_APPROACHES = "chat_approaches"
 CONFIG_BLOB_CLIENT = "blob_client"
+CONFIG_SEARCH_CLIENT = "search_client"
+CONFIG_CONTENT_CACHE = "content_cache"
+CONFIG_METRICS = "metrics"
 
 
 bp = Blueprint("routes", __name__, static_folder='static')
 
 @bp.route("/")
-def index():
-    return bp.send_static_file("index.html")
+async def index():
+    return await bp.send_static_file("index.html")
 
 @bp.route("/favicon.ico")
-def favicon():
-    return bp.send_static_file("favicon.ico")
+async def favicon():
+    return await bp.send_static_file("favicon.ico")
 
 @bp.route("/assets/<path:path>")
-def assets(path):
-    return send_from_directory("static/assets", path)
+async def assets(path):
+    return await send_from_directory("static/assets", path)
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Files are streamed from storage (honoring Range, If-None-Match and If-Modified-Since
+# requests) and recently served ones are kept in a local cache, so repeated citation clicks don't download them again.
 @bp.route("/content/<path>")
-def content_file(path):
-    blob_container = current_app.config[CONFIG_BLOB_CLIENT].get_container_client(AZURE_STORAGE_CONTAINER)
-    blob = blob_container.get_blob_client(path).download_blob()
-    if not blob.properties or not blob.properties.has_key("content_settings"):
+async def content_file(path):
+    blob = current_app.config[CONFIG_BLOB_CLIENT].get_container_client(AZURE_STORAGE_CONTAINER).get_blob_client(path)
+    try:
+        properties = await blob.get_blob_properties()
+    except ResourceNotFoundError:
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
+    mime_type = properties.content_settings.content_type
+    if not mime_type or mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    blob.readinto(blob_file)
-    blob_file.seek(0)
-    return send_file(blob_file, mimetype=mime_type, as_attachment=False, download_name=path)
+
+    content_cache = current_app.config[CONFIG_CONTENT_CACHE]
+    cached_file = await content_cache.get(path, properties.etag) if content_cache else None
+    if cached_file:
+        body = CachedFileBody(cached_file)
+    else:
+        body = BlobBody(blob, path, properties.size, properties.etag, content_cache)
+    response = current_app.response_class(body, mimetype=mime_type)
+    response.content_length = properties.size
+    response.set_etag(unquote_etag(properties.etag)[0])
+    response.last_modified = properties.last_modified
+    response.headers["Accept-Ranges"] = "bytes"
+    try:
+        await response.make_conditional(request, accept_ranges=True, complete_length=properties.size)
+    except Exception:
+        # The body is never sent, so it doesn't close the cached file
+        if cached_file:
+            cached_file.close()
+        raise
+    if response.status_code == 206:
+        # Quart subtracts one from the end of the range, which ContentRange already treats as exclusive
+        response.content_range = ContentRange("bytes", body.begin, body.end, properties.size)
+    elif response.status_code in (304, 412):
+        if cached_file:
+            cached_file.close()
+        response.response = current_app.response_class.iterable_body_class([])
+        response.content_length = None
+    return response
 
 @bp.route("/ask", methods=["POST"])
-def ask():
+async def ask():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
-    approach = request.json["approach"]
+    request_json = await request.get_json()
+    approach = request_json["approach"]
     try:
         impl = current_app.config[CONFIG_ASK_APPROACHES].get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["question"], request.json.get("overrides") or {})
-        return jsonify(r)
+        with current_app.config[CONFIG_METRICS].track("ask", approach) as trace, trace.activate():
+            r = await impl.run(request_json["question"], request_json.get("overrides") or {})
+        response = jsonify(r)
+        response.headers["Server-Timing"] = trace.server_timing()
+        return response
     except Exception as e:
         logging.exception("Exception in /ask")
         return jsonify({"error": str(e)}), 500
 
 @bp.route("/chat", methods=["POST"])
-def chat():
+async def chat():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
-    approach = request.json["approach"]
+    request_json = await request.get_json()
+    approach = request_json["approach"]
     try:
         impl = current_app.config[CONFIG_CHAT_APPROACHES].get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
-        return jsonify(r)
+        with current_app.config[CONFIG_METRICS].track("chat", approach) as trace, trace.activate():
+            r = await impl.run(request_json["history"], request_json.get("overrides") or {})
+        response = jsonify(r)
+        response.headers["Server-Timing"] = trace.server_timing()
+        return response
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
-@bp.before_request
-def ensure_openai_token():
-    openai_token = current_app.config[CONFIG_OPENAI_TOKEN]
-    if openai_token.expires_on < time.time() + 60:
-        openai_token = current_app.config[CONFIG_CREDENTIAL].get_token("https://cognitiveservices.azure.com/.default")
-        current_app.config[CONFIG_OPENAI_TOKEN] = openai_token
-        openai.api_key = openai_token.token
+async def traced_stream(request_metrics: RequestMetrics, endpoint: str, approach: str, r: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    # The response is sent while the stream runs, so the trace is only activated while the approach produces the next event:
+    # the server may ask for each one from a different context
+    with request_metrics.track(endpoint, approach) as trace:
+        while True:
+            with trace.activate():
+                try:
+                    event = await r.__anext__()
+                except StopAsyncIteration:
+                    break
+            yield event
 
+async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+    try:
+        async for event in r:
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    except Exception as e:
+        # The response status has already been sent, so report the error as the last line of the stream
+        logging.exception("Exception while generating response stream")
+        yield json.dumps({"error": str(e)}) + "\n"
 
-def create_app():
-    app = Flask(__name__)
+# Streaming variants of /ask and /chat: the response is newline delimited JSON, the first line holds the
+# data_points and thoughts as soon as retrieval finishes and each following line holds an answer "delta"
+@bp.route("/ask_stream", methods=["POST"])
+async def ask_stream():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    approach = request_json["approach"]
+    impl = current_app.config[CONFIG_ASK_APPROACHES].get(approach)
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    events = traced_stream(current_app.config[CONFIG_METRICS], "ask_stream", approach, impl.run_stream(request_json["question"], request_json.get("overrides") or {}))
+    response = await make_response(format_as_ndjson(events))
+    response.timeout = None
+    response.mimetype = "application/x-ndjson"
+    return response
+
+@bp.route("/chat_stream", methods=["POST"])
+async def chat_stream():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    approach = request_json["approach"]
+    impl = current_app.config[CONFIG_CHAT_APPROACHES].get(approach)
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    events = traced_stream(current_app.config[CONFIG_METRICS], "chat_stream", approach, impl.run_stream(request_json["history"], request_json.get("overrides") or {}))
+    response = await make_response(format_as_ndjson(events))
+    response.timeout = None
+    response.mimetype = "application/x-ndjson"
+    return response
 
+# Request, stage, token and agent iteration metrics of the approaches, in the Prometheus text format.
+# They are summed over the workers of the machine through METRICS_PATH (see core/metrics.py)
+@bp.route("/metrics")
+async def metrics():
+    registry = current_app.config[CONFIG_METRICS].registry
+    return await registry.render(), 200, {"Content-Type": registry.content_type}
+
+@bp.before_app_serving
+async def setup_clients():
     # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
     # keys for each service
     # If you encounter a blocking error during a DefaultAzureCredntial resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
     azure_credential = DefaultAzureCredential(exclude_shared_token_cache_credential = True)
 
-    # Set up clients for Cognitive Search and Storage
+    # Set up clients for Cognitive Search and Storage. These are the async clients, so that a single worker
+    # can keep many requests in flight while they wait on the network.
     search_client = SearchClient(
         endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
         index_name=AZURE_SEARCH_INDEX,
@@ -139,53 +279,90 @@ def create_app():
     openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
     openai.api_version = "2023-05-15"
 
-    # Comment these two lines out if using keys, set your API key in the OPENAI_API_KEY environment variable instead
+    # Comment these lines out if using keys, set your API key in the OPENAI_API_KEY environment variable instead.
+    # The token is refreshed by a background task ahead of its expiry, requests never wait for it
     openai.api_type = "azure_ad"
-    openai_token = azure_credential.get_token(
-        "https://cognitiveservices.azure.com/.default"
-    )
-    openai.api_key = openai_token.token
+    def set_openai_key(openai_token):
+        openai.api_key = openai_token.token
+    openai_token_manager = TokenManager(azure_credential, "https://cognitiveservices.azure.com/.default", set_openai_key)
+    await openai_token_manager.start()
+    current_app.config[CONFIG_OPENAI_TOKEN_MANAGER] = openai_token_manager
 
     # Store on app.config for later use inside requests
-    app.config[CONFIG_OPENAI_TOKEN] = openai_token
-    app.config[CONFIG_CREDENTIAL] = azure_credential
-    app.config[CONFIG_BLOB_CLIENT] = blob_client
+    current_app.config[CONFIG_CREDENTIAL] = azure_credential
+    current_app.config[CONFIG_BLOB_CLIENT] = blob_client
+    current_app.config[CONFIG_SEARCH_CLIENT] = search_client
+    metrics_registry = MetricsRegistry(MetricsStore(METRICS_PATH) if METRICS_PATH else None, METRICS_FLUSH_INTERVAL)
+    await metrics_registry.start()
+    current_app.config[CONFIG_METRICS] = RequestMetrics(metrics_registry)
+    current_app.config[CONFIG_CONTENT_CACHE] = ContentCache(CONTENT_CACHE_PATH, CONTENT_CACHE_MAX_BYTES) if CONTENT_CACHE_PATH else None
+
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_TTL, EMBEDDING_CACHE_MAX_ENTRIES) if EMBEDDING_CACHE_PATH else None
+
+    async def get_index_generation() -> str:
+        properties = await blob_client.get_container_client(AZURE_STORAGE_CONTAINER).get_container_properties()
+        return properties.metadata.get(INDEX_GENERATION_METADATA_KEY, "")
+
+    search_cache = None
+    if LOCAL_INDEX_PATH and not LOCAL_INDEX_FALLBACK:
+        search_client = LocalSearchClient(LocalVectorIndex(LOCAL_INDEX_PATH))
+    elif SEARCH_CACHE_TTL > 0:
+        search_cache = SearchCache(SEARCH_CACHE_PATH, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES, get_index_generation, SEARCH_CACHE_GENERATION_REFRESH)
+        search_client = CachingSearchClient(search_client, search_cache)
+    if LOCAL_INDEX_PATH and LOCAL_INDEX_FALLBACK:
+        # Around the cache, so results of the local index are never cached as those of the service
+        search_client = FallbackSearchClient(search_client, LocalSearchClient(LocalVectorIndex(LOCAL_INDEX_PATH)))
+
+    # All approaches search through the same retriever, which owns the query embedding, the search options and the formatting of the results
+    retriever = Retriever(search_client, AZURE_OPENAI_EMB_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, embedding_cache)
+
+    answer_cache = None
+    if ANSWER_CACHE_TTL > 0:
+        # Share the generation read by the search cache, if there's one
+        generation = search_cache.generation if search_cache else IndexGeneration(get_index_generation, SEARCH_CACHE_GENERATION_REFRESH).get
+        answer_cache = AnswerCache(ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, generation)
+
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
-    app.config[CONFIG_ASK_APPROACHES] = {
+    current_app.config[CONFIG_ASK_APPROACHES] = {
         "rtr": RetrieveThenReadApproach(
-            search_client,
+            retriever,
             AZURE_OPENAI_CHATGPT_DEPLOYMENT,
             AZURE_OPENAI_CHATGPT_MODEL,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
-            KB_FIELDS_SOURCEPAGE,
-            KB_FIELDS_CONTENT
+            answer_cache=answer_cache
         ),
         "rrr": ReadRetrieveReadApproach(
-            search_client,
-            AZURE_OPENAI_GPT_DEPLOYMENT,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
-            KB_FIELDS_SOURCEPAGE,
-            KB_FIELDS_CONTENT
+            retriever,
+            AZURE_OPENAI_GPT_DEPLOYMENT
         ),
-        "rda": ReadDecomposeAsk(search_client,
-            AZURE_OPENAI_GPT_DEPLOYMENT,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
-            KB_FIELDS_SOURCEPAGE,
-            KB_FIELDS_CONTENT
+        "rda": ReadDecomposeAsk(
+            retriever,
+            AZURE_OPENAI_GPT_DEPLOYMENT
         )
     }
-    app.config[CONFIG_CHAT_APPROACHES] = {
+    current_app.config[CONFIG_CHAT_APPROACHES] = {
         "rrr": ChatReadRetrieveReadApproach(
-            search_client,
+            retriever,
             AZURE_OPENAI_CHATGPT_DEPLOYMENT,
             AZURE_OPENAI_CHATGPT_MODEL,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
-            KB_FIELDS_SOURCEPAGE,
-            KB_FIELDS_CONTENT,
+            speculative_embedding=CHAT_SPECULATIVE_EMBEDDING
         )
     }
 
+@bp.after_app_serving
+async def close_clients():
+    if current_app.config.get(CONFIG_OPENAI_TOKEN_MANAGER):
+        await current_app.config[CONFIG_OPENAI_TOKEN_MANAGER].close()
+    await current_app.config[CONFIG_METRICS].registry.close()
+    await current_app.config[CONFIG_SEARCH_CLIENT].close()
+    await current_app.config[CONFIG_BLOB_CLIENT].close()
+    await current_app.config[CONFIG_CREDENTIAL].close()
+
+
+def create_app():
+    # Quart is the asyncio reimplementation of Flask, so the app returned here is an ASGI app
+    # (run it with an ASGI server, see gunicorn.conf.py) and the routes and approaches await their I/O
+    app = Quart(__name__)
     app.register_blueprint(bp)
 
     return app
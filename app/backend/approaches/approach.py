@@ -1,6 +1,10 @@
-from typing import Any
+from typing import Any, AsyncGenerator
 
 
 class Approach:
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
         raise NotImplementedError
+
+    async def run_stream(self, q: str, overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        # Approaches that can't stream their answer send the whole response as a single event
+        yield await self.run(q, overrides)
@@ -1,13 +1,15 @@
-from typing import Any, Sequence
+import asyncio
+import difflib
+import logging
+from typing import Any, AsyncGenerator, Sequence
 
 import openai
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
 
 from approaches.approach import Approach
+from core import tracing
 from core.messagebuilder import MessageBuilder
 from core.modelhelper import get_token_limit
-from text import nonewlines
+from core.retriever import Retriever
 
 
 class ChatReadRetrieveReadApproach(Approach):
@@ -48,83 +50,96 @@ If you cannot generate a search query, return just the number 0.
         {'role' : ASSISTANT, 'content' : 'Health plan cardio coverage' }
     ]
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    # Rewritten queries at least this similar to the user question reuse the embedding of the question
+    speculative_similarity_threshold = 0.9
+
+    def __init__(self, retriever: Retriever, chatgpt_deployment: str, chatgpt_model: str, speculative_embedding: bool = False):
+        self.retriever = retriever
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
-        self.embedding_deployment = embedding_deployment
-        self.sourcepage_field = sourcepage_field
-        self.content_field = content_field
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
-
-    def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
-        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
-        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+        self.speculative_embedding = speculative_embedding
+
+    async def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=False)
+        with tracing.stage("completion"):
+            chat_completion = await chat_coroutine
+        tracing.record_usage(chat_completion)
+        return {**extra_info, "answer": chat_completion.choices[0].message.content}
+
+    async def run_stream(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=True)
+        yield extra_info
+        # Streamed completions don't report their usage, only their duration (to the last event) is traced
+        with tracing.stage("completion"):
+            async for event in await chat_coroutine:
+                # Azure OpenAI sends an initial event with only the prompt filter results and no choices
+                if event["choices"]:
+                    delta = event["choices"][0]["delta"].get("content")
+                    if delta:
+                        yield {"delta": delta}
+
+    async def run_until_final_call(self, history: Sequence[dict[str, str]], overrides: dict[str, Any], should_stream: bool) -> tuple[dict[str, Any], Any]:
+        has_text, has_vector = Retriever.retrieval_mode(overrides)
 
         user_q = 'Generate search query for: ' + history[-1]["user"]
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        # The prompt budget leaves room for the completion, otherwise the request fails with a context length error
+        query_response_token_limit = 32
         messages = self.get_messages_from_history(
             self.query_prompt_template,
             self.chatgpt_model,
             history,
             user_q,
             self.query_prompt_few_shots,
-            self.chatgpt_token_limit - len(user_q)
+            self.chatgpt_token_limit - query_response_token_limit
             )
 
-        chat_completion = openai.ChatCompletion.create(
-            deployment_id=self.chatgpt_deployment,
-            model=self.chatgpt_model,
-            messages=messages,
-            temperature=0.0,
-            max_tokens=32,
-            n=1)
+        # In speculative mode, embed the user question while the query is being rewritten, since the rewrite
+        # often fails or comes back (nearly) unchanged and the embedding of the question can be used as is
+        user_question = history[-1]["user"]
+        speculative_vector = None
+        if has_vector and self.speculative_embedding:
+            speculative_vector = asyncio.create_task(self.retriever.embed(user_question))
+
+        try:
+            with tracing.stage("query_rewrite"):
+                chat_completion = await openai.ChatCompletion.acreate(
+                    deployment_id=self.chatgpt_deployment,
+                    model=self.chatgpt_model,
+                    messages=messages,
+                    temperature=0.0,
+                    max_tokens=query_response_token_limit,
+                    n=1)
+            tracing.record_usage(chat_completion)
+            query_text = chat_completion.choices[0].message.content
+        except Exception:
+            if speculative_vector is None:
+                raise
+            logging.exception("Query rewrite failed, searching for the user question instead")
+            query_text = "0"
 
-        query_text = chat_completion.choices[0].message.content
         if query_text.strip() == "0":
-            query_text = history[-1]["user"] # Use the last user input if we failed to generate a better query
+            query_text = user_question # Use the last user input if we failed to generate a better query
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        if has_vector:
-            query_vector = openai.Embedding.create(engine=self.embedding_deployment, input=query_text)["data"][0]["embedding"]
-        else:
-            query_vector = None
-
-         # Only keep the text query if the retrieval mode uses text, otherwise drop it
+        # Reuse the speculative embedding if the query is (nearly) the user question, otherwise the retriever embeds the query
+        query_vector = None
+        if speculative_vector is not None and self.is_similar_query(query_text, user_question):
+            try:
+                query_vector = await speculative_vector
+            except Exception:
+                # E.g. throttled, the retriever embeds the query again like it would have without speculation
+                logging.warning("Speculative embedding failed, embedding the query again", exc_info=True)
+        elif speculative_vector is not None:
+            self.discard_task(speculative_vector)
+
+        results = await self.retriever.retrieve(query_text, overrides, query_vector)
+        # Only keep the text query if the retrieval mode uses text, otherwise it was dropped from the search
         if not has_text:
             query_text = None
-
-        # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = self.search_client.search(query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          query_language="en-us",
-                                          query_speller="lexicon",
-                                          semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        else:
-            r = self.search_client.search(query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
         content = "\n".join(results)
 
         follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
@@ -140,45 +155,54 @@ If you cannot generate a search query, return just the number 0.
         else:
             system_message = prompt_override.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
+        response_token_limit = 1024
         messages = self.get_messages_from_history(
             system_message + "\n\nSources:\n" + content,
             self.chatgpt_model,
             history,
             history[-1]["user"],
-            max_tokens=self.chatgpt_token_limit)
+            max_tokens=self.chatgpt_token_limit - response_token_limit)
+
+        msg_to_display = '\n\n'.join([str(message) for message in messages])
 
-        chat_completion = openai.ChatCompletion.create(
+        extra_info = {"data_points": results, "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')}
+        chat_coroutine = openai.ChatCompletion.acreate(
             deployment_id=self.chatgpt_deployment,
             model=self.chatgpt_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.7,
-            max_tokens=1024,
-            n=1)
+            max_tokens=response_token_limit,
+            n=1,
+            stream=should_stream)
+        return (extra_info, chat_coroutine)
 
-        chat_content = chat_completion.choices[0].message.content
+    def is_similar_query(self, query_text: str, user_question: str) -> bool:
+        def normalize(s: str) -> str:
+            return " ".join("".join(c for c in s.casefold() if c.isalnum() or c.isspace()).split())
 
-        msg_to_display = '\n\n'.join([str(message) for message in messages])
+        return difflib.SequenceMatcher(None, normalize(query_text), normalize(user_question)).ratio() >= self.speculative_similarity_threshold
 
-        return {"data_points": results, "answer": chat_content, "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')}
+    @staticmethod
+    def discard_task(task: asyncio.Task):
+        task.cancel()
+        # Retrieve the outcome of a task that already failed, so asyncio doesn't log it as never retrieved
+        if task.done() and not task.cancelled():
+            task.exception()
 
     def get_messages_from_history(self, system_prompt: str, model_id: str, history: Sequence[dict[str, str]], user_conv: str, few_shots = [], max_tokens: int = 4096) -> []:
         message_builder = MessageBuilder(system_prompt, model_id)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in few_shots:
-            message_builder.append_message(shot.get('role'), shot.get('content'))
-
-        user_content = user_conv
-        append_index = len(few_shots) + 1
-
-        message_builder.append_message(self.USER, user_content, index=append_index)
+        message_builder.append_messages(few_shots)
 
-        for h in reversed(history[:-1]):
+        # Keep as many of the most recent turns as fit in max_tokens, followed by the new user message
+        turns = []
+        for h in history[:-1]:
+            turn = [{'role': self.USER, 'content': h.get('user')}]
             if h.get("bot"):
-                message_builder.append_message(self.ASSISTANT, h.get('bot'), index=append_index)
-            message_builder.append_message(self.USER, h.get('user'), index=append_index)
-            if message_builder.token_length > max_tokens:
-                break
+                turn.append({'role': self.ASSISTANT, 'content': h.get('bot')})
+            turns.append(turn)
+        message_builder.append_history(turns, {'role': self.USER, 'content': user_conv}, max_tokens)
 
         messages = message_builder.messages
         return messages
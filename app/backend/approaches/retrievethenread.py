@@ -1,19 +1,20 @@
-from typing import Any
+from typing import Any, AsyncGenerator, Optional
 
 import openai
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
 
 from approaches.approach import Approach
+from core import tracing
+from core.answercache import AnswerCache
 from core.messagebuilder import MessageBuilder
-from text import nonewlines
+from core.retriever import Retriever
 
 
 class RetrieveThenReadApproach(Approach):
     """
     Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
     top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion
-    (answer) with that prompt.
+    (answer) with that prompt. With an answer cache, the answer of a previous question similar enough to the new one
+    (see AnswerCache) is returned instead.
     """
 
     system_chat_template = \
@@ -36,55 +37,67 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
 """
     answer = "In-network deductibles are $500 for employee and $1000 for family [info1.txt] and Overlake is in-network for the employee plan [info2.pdf][info4.pdf]."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    def __init__(self, retriever: Retriever, openai_deployment: str, chatgpt_model: str, answer_cache: Optional[AnswerCache] = None):
+        self.retriever = retriever
         self.openai_deployment = openai_deployment
         self.chatgpt_model = chatgpt_model
-        self.embedding_deployment = embedding_deployment
-        self.sourcepage_field = sourcepage_field
-        self.content_field = content_field
-
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
-        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
-        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        # If retrieval mode includes vectors, compute an embedding for the query
-        if has_vector:
-            query_vector = openai.Embedding.create(engine=self.embedding_deployment, input=q)["data"][0]["embedding"]
-        else:
-            query_vector = None
-
-        # Only keep the text query if the retrieval mode uses text, otherwise drop it
+        self.answer_cache = answer_cache
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        scope, query_vector, cached = await self.lookup_answer(q, overrides)
+        if cached is not None:
+            return cached
+        extra_info, chat_coroutine = await self.run_until_final_call(q, overrides, should_stream=False, query_vector=query_vector)
+        with tracing.stage("completion"):
+            chat_completion = await chat_coroutine
+        tracing.record_usage(chat_completion)
+        r = {**extra_info, "answer": chat_completion.choices[0].message.content}
+        if scope is not None:
+            self.answer_cache.set(scope, query_vector, q, r)
+        return r
+
+    async def run_stream(self, q: str, overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        scope, query_vector, cached = await self.lookup_answer(q, overrides)
+        if cached is not None:
+            yield {"data_points": cached["data_points"], "thoughts": cached["thoughts"]}
+            yield {"delta": cached["answer"]}
+            return
+        extra_info, chat_coroutine = await self.run_until_final_call(q, overrides, should_stream=True, query_vector=query_vector)
+        yield extra_info
+        answer = []
+        # Streamed completions don't report their usage, only their duration (to the last event) is traced
+        with tracing.stage("completion"):
+            async for event in await chat_coroutine:
+                # Azure OpenAI sends an initial event with only the prompt filter results and no choices
+                if event["choices"]:
+                    delta = event["choices"][0]["delta"].get("content")
+                    if delta:
+                        answer.append(delta)
+                        yield {"delta": delta}
+        # Only complete answers are cached, not those of a stream the client stopped reading
+        if scope is not None:
+            self.answer_cache.set(scope, query_vector, q, {**extra_info, "answer": "".join(answer)})
+
+    async def lookup_answer(self, q: str, overrides: dict[str, Any]) -> tuple[Optional[str], Optional[list[float]], Optional[dict[str, Any]]]:
+        """
+        Returns the scope of the question in the answer cache, its embedding and the cached answer of a similar question, or
+        Nones without an answer cache. The search then reuses the embedding, computed even for text searches to look up the cache.
+        """
+        if self.answer_cache is None:
+            return None, None, None
+        query_vector = await self.retriever.embed(q)
+        with tracing.stage("answer_cache"):
+            scope = await self.answer_cache.scope(overrides)
+            cached = self.answer_cache.get(scope, query_vector)
+        if cached is None:
+            return scope, query_vector, None
+        question, answer = cached
+        return scope, query_vector, {**answer, "thoughts": f"Answer of the similar question:<br>{question}<br><br>" + answer["thoughts"]}
+
+    async def run_until_final_call(self, q: str, overrides: dict[str, Any], should_stream: bool, query_vector: Optional[list[float]] = None) -> tuple[dict[str, Any], Any]:
+        has_text, _ = Retriever.retrieval_mode(overrides)
+        results = await self.retriever.retrieve(q, overrides, query_vector)
         query_text = q if has_text else None
-
-        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = self.search_client.search(query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          query_language="en-us",
-                                          query_speller="lexicon",
-                                          semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        else:
-            r = self.search_client.search(query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
         content = "\n".join(results)
 
         message_builder = MessageBuilder(overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model)
@@ -98,12 +111,13 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         message_builder.append_message('user', self.question)
 
         messages = message_builder.messages
-        chat_completion = openai.ChatCompletion.create(
+        extra_info = {"data_points": results, "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])}
+        chat_coroutine = openai.ChatCompletion.acreate(
             deployment_id=self.openai_deployment,
             model=self.chatgpt_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.3,
             max_tokens=1024,
-            n=1)
-
-        return {"data_points": results, "answer": chat_completion.choices[0].message.content, "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])}
+            n=1,
+            stream=should_stream)
+        return (extra_info, chat_coroutine)
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import numpy as np
+
+
+class AnswerCache:
+    """
+      Answers of recently answered questions, reused for a new question whose embedding has a cosine similarity of at least
+      threshold with that of an answered one asked with the same overrides and index generation (its scope), so paraphrases
+      of a question skip the search and the completion. The entries live in the memory of the worker process: their normalized
+      embeddings are the rows of a matrix of max_entries rows, searched by brute force (a single product, well under a millisecond
+      for a few thousand entries), where each new entry replaces the oldest one. An approach has its own cache, since the
+      answers depend on its prompt and model.
+      Attributes:
+          threshold (float): The minimum cosine similarity of a question with an answered one to reuse its answer.
+          ttl (float): Seconds an answer is reused for.
+          max_entries (int): The number of answers kept.
+          generation (callable): Coroutine function returning the current index generation, or None.
+      """
+
+    def __init__(self, threshold: float, ttl: float, max_entries: int, generation: Optional[Callable[[], Awaitable[str]]] = None):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.generation = generation
+        # Allocated by the first set, once the dimensions of the embeddings are known
+        self.matrix: Optional[np.ndarray] = None
+        self.scopes = np.full(max_entries, "", dtype=object)
+        self.expires = np.zeros(max_entries)
+        self.entries: list[Optional[tuple[str, dict[str, Any]]]] = [None] * max_entries
+        self._next = 0
+
+    async def scope(self, overrides: dict[str, Any]) -> str:
+        """The scope of the answers to questions asked with the overrides, at the current index generation."""
+        generation = await self.generation() if self.generation is not None else ""
+        request = json.dumps({"generation": generation, "overrides": overrides}, sort_keys=True, default=str)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    @staticmethod
+    def normalize(vector: list[float]) -> np.ndarray:
+        query = np.asarray(vector, dtype=np.float32)
+        return query / (np.linalg.norm(query) or 1)
+
+    def get(self, scope: str, vector: list[float]) -> Optional[tuple[str, dict[str, Any]]]:
+        """The question and answer of the most similar question of the scope, if it's similar enough and not expired."""
+        query = self.normalize(vector)
+        if self.matrix is None or self.matrix.shape[1] != len(query):
+            return None
+        rows = np.flatnonzero((self.scopes == scope) & (self.expires > time.monotonic()))
+        if not len(rows):
+            return None
+        scores = self.matrix[rows] @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        question, answer = self.entries[rows[best]]
+        return question, {**answer, "data_points": list(answer.get("data_points", []))}
+
+    def set(self, scope: str, vector: list[float], question: str, answer: dict[str, Any]):
+        row = self.normalize(vector)
+        if self.matrix is None or self.matrix.shape[1] != len(row):
+            # The embedding model changed, the previous entries can't be compared with the new ones
+            self.matrix = np.zeros((self.max_entries, len(row)), dtype=np.float32)
+            self.expires[:] = 0
+        index = self._next
+        self._next = (index + 1) % self.max_entries
+        self.matrix[index] = row
+        self.scopes[index] = scope
+        self.expires[index] = time.monotonic() + self.ttl
+        self.entries[index] = (question, answer)
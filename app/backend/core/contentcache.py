@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from types import TracebackType
+from typing import Any, AsyncIterator, BinaryIO, Optional
+
+from azure.core import MatchConditions
+from quart.wrappers.response import ResponseBody
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+
+class ContentCache:
+    """
+      Content files recently served by the app, kept in a local directory shared by all workers on the machine.
+      A file is stored under its blob name and ETag, so a new upload of the same blob is never served from a stale copy.
+      Once the directory holds more than max_bytes, the least recently served files are removed.
+      Like DiskCache, the cache is best effort: file system errors are logged and never fail the request, and the file
+      system calls run in a thread instead of stalling every request of the event loop.
+      Attributes:
+          directory (str): The directory holding the files, created if it doesn't exist.
+          max_bytes (int): The maximum total size of the cached files.
+      """
+
+    SUFFIX = ".content"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str, etag: str) -> str:
+        key = hashlib.sha256(f"{name}\n{etag}".encode()).hexdigest()
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    async def get(self, name: str, etag: str) -> Optional[BinaryIO]:
+        """The cached file, opened: another worker may evict it right after, but an open file outlives its name."""
+        return await asyncio.to_thread(self._get, name, etag)
+
+    async def open(self) -> Any:
+        return await asyncio.to_thread(self._open)
+
+    async def commit(self, file: Any, name: str, etag: str):
+        await asyncio.to_thread(self._commit, file, name, etag)
+
+    async def discard(self, file: Any):
+        await asyncio.to_thread(self._discard, file)
+
+    def _get(self, name: str, etag: str) -> Optional[BinaryIO]:
+        path = self.path(name, etag)
+        try:
+            file = open(path, "rb")
+        except OSError:
+            return None
+        try:
+            # The modification time records when the file was last served, it's the order of eviction
+            os.utime(path)
+        except OSError:
+            # Evicted since it was opened, it can still be served
+            pass
+        return file
+
+    def _open(self) -> Any:
+        # Files are written under a temporary name and renamed once complete, so readers never see partial content
+        return tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False)
+
+    def _commit(self, file: Any, name: str, etag: str):
+        try:
+            os.replace(file.name, self.path(name, etag))
+            self._evict()
+        except OSError:
+            logging.warning("Content cache unavailable, not storing %s", name, exc_info=True)
+
+    def _discard(self, file: Any):
+        try:
+            os.remove(file.name)
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self.SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # Another worker evicted it already
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class CachedFileBody(ResponseBody):
+    """
+      A response body streaming a file opened by ContentCache.get, like Quart's FileBody (which opens the file by its name,
+      by then possibly evicted by another worker) with ranges. It closes the file once sent, the route closes it otherwise.
+      """
+
+    buffer_size = 64 * 1024
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.size = os.fstat(file.fileno()).st_size
+        self.begin = 0
+        self.end = self.size
+
+    async def __aenter__(self) -> "CachedFileBody":
+        await asyncio.to_thread(self.file.seek, self.begin)
+        return self
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb: TracebackType) -> None:
+        self.file.close()
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._chunks()
+
+    async def _chunks(self) -> AsyncIterator[bytes]:
+        position = self.begin
+        while position < self.end:
+            chunk = await asyncio.to_thread(self.file.read, min(self.buffer_size, self.end - position))
+            if not chunk:
+                return
+            position += len(chunk)
+            yield chunk
+
+    async def make_conditional(self, begin: int, end: Optional[int]) -> int:
+        if begin < 0 or (end is not None and end <= begin) or begin >= self.size:
+            raise RequestedRangeNotSatisfiable(self.size)
+        self.begin = begin
+        self.end = self.size if end is None else min(self.size, end)
+        return self.size
+
+
+class BlobBody(ResponseBody):
+    """
+      A response body streaming a blob chunk by chunk, so the app never holds the whole file in memory.
+      Like Quart's FileBody it supports ranges: only the requested bytes are downloaded from storage.
+      When the whole blob is sent and a ContentCache is given, the chunks are also written to the cache.
+      The download is conditioned on etag, so a blob replaced after its properties were read is not mixed in.
+      """
+
+    def __init__(self, blob_client: Any, name: str, size: int, etag: str, cache: Optional[ContentCache] = None):
+        self.blob_client = blob_client
+        self.name = name
+        self.size = size
+        self.etag = etag
+        self.cache = cache
+        self.begin = 0
+        self.end = size
+        self.cache_file = None
+        self.sent = 0
+
+    async def __aenter__(self) -> "BlobBody":
+        if self.cache is not None and self.begin == 0 and self.end == self.size:
+            try:
+                self.cache_file = await self.cache.open()
+            except OSError:
+                logging.warning("Content cache unavailable, not storing %s", self.name, exc_info=True)
+        return self
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb: TracebackType) -> None:
+        if self.cache_file is None:
+            return
+        try:
+            await asyncio.to_thread(self.cache_file.close)
+        except OSError:
+            # Flushing the last chunks failed
+            logging.warning("Content cache unavailable, not storing %s", self.name, exc_info=True)
+            exc_type = OSError
+        # A download interrupted by an error or by the client going away leaves an incomplete file
+        if exc_type is None and self.sent == self.size:
+            await self.cache.commit(self.cache_file, self.name, self.etag)
+        else:
+            await self.cache.discard(self.cache_file)
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._chunks()
+
+    async def _chunks(self) -> AsyncIterator[bytes]:
+        if self.end <= self.begin:
+            return
+        download = await self.blob_client.download_blob(
+            offset=self.begin, length=self.end - self.begin, etag=self.etag, match_condition=MatchConditions.IfNotModified)
+        async for chunk in download.chunks():
+            self.sent += len(chunk)
+            if self.cache_file is not None:
+                try:
+                    await asyncio.to_thread(self.cache_file.write, chunk)
+                except OSError:
+                    logging.warning("Content cache unavailable, not storing %s", self.name, exc_info=True)
+                    try:
+                        self.cache_file.close()
+                    except OSError:
+                        pass
+                    await self.cache.discard(self.cache_file)
+                    self.cache_file = None
+            yield chunk
+
+    async def make_conditional(self, begin: int, end: Optional[int]) -> int:
+        if begin < 0 or (end is not None and end <= begin) or begin >= self.size:
+            raise RequestedRangeNotSatisfiable(self.size)
+        self.begin = begin
+        self.end = self.size if end is None else min(self.size, end)
+        return self.size
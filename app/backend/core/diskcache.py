@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+class DiskCache:
+    """
+      A key-value cache stored in a SQLite file, so that every worker process on the machine shares the same entries.
+      Entries expire after ttl seconds, and once there are more than max_entries the oldest ones are evicted.
+      The cache is best effort: any SQLite error (e.g. the file is locked by another worker for too long) is logged
+      and reported as a miss, it never fails the request. SQLite calls block, and wait up to half a second for a lock
+      held by another worker, so they run in a thread instead of stalling every request of the event loop.
+      Attributes:
+          path (str): The SQLite file, created if it doesn't exist.
+          namespace (str): The table holding the entries, so several caches can share one file.
+          ttl (float): Seconds before an entry expires.
+          max_entries (int): The maximum number of entries kept in the namespace.
+      """
+
+    # Only trim the table every so many writes, counting rows on every write is wasteful
+    EVICT_EVERY = 100
+
+    def __init__(self, path: str, namespace: str, ttl: float, max_entries: int):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared across a fork, so each worker process opens its own
+        if self._connection is None or self._connection_pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=0.5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.namespace} (key TEXT PRIMARY KEY, value BLOB NOT NULL, created REAL NOT NULL, expires REAL NOT NULL)")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.namespace}_created ON {self.namespace} (created)")
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: bytes):
+        await asyncio.to_thread(self._set, key, value)
+
+    async def clear(self):
+        await asyncio.to_thread(self._clear)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        try:
+            with self._lock:
+                row = self._connect().execute(f"SELECT value FROM {self.namespace} WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        except sqlite3.Error:
+            logging.warning("Cache %s unavailable, treating as a miss", self.namespace, exc_info=True)
+            return None
+        return row[0] if row else None
+
+    def _set(self, key: str, value: bytes):
+        now = time.time()
+        try:
+            with self._lock:
+                connection = self._connect()
+                connection.execute(f"INSERT OR REPLACE INTO {self.namespace} (key, value, created, expires) VALUES (?, ?, ?, ?)", (key, value, now, now + self.ttl))
+                self._writes += 1
+                if self._writes % self.EVICT_EVERY == 0:
+                    self._evict(connection, now)
+        except sqlite3.Error:
+            logging.warning("Cache %s unavailable, not storing entry", self.namespace, exc_info=True)
+
+    def _clear(self):
+        try:
+            with self._lock:
+                self._connect().execute(f"DELETE FROM {self.namespace}")
+        except sqlite3.Error:
+            logging.warning("Cache %s unavailable, not cleared", self.namespace, exc_info=True)
+
+    def _evict(self, connection: sqlite3.Connection, now: float):
+        connection.execute(f"DELETE FROM {self.namespace} WHERE expires <= ?", (now,))
+        (count,) = connection.execute(f"SELECT COUNT(*) FROM {self.namespace}").fetchone()
+        if count > self.max_entries:
+            connection.execute(f"DELETE FROM {self.namespace} WHERE key IN (SELECT key FROM {self.namespace} ORDER BY created LIMIT ?)", (count - self.max_entries,))
@@ -0,0 +1,46 @@
+import array
+import hashlib
+import unicodedata
+from typing import Optional
+
+import openai
+
+from .diskcache import DiskCache
+
+
+class EmbeddingCache:
+    """
+      Query embeddings keyed by (deployment, normalized text), shared by all workers through a DiskCache.
+      Attributes:
+          cache (DiskCache): The underlying store.
+      Methods:
+          get(self, deployment: str, text: str): Coroutine returning the cached embedding, or None.
+          set(self, deployment: str, text: str, embedding: list[float]): Coroutine storing an embedding.
+      """
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.cache = DiskCache(path, "embeddings", ttl, max_entries)
+
+    @staticmethod
+    def key(deployment: str, text: str) -> str:
+        # Queries that only differ in unicode representation or whitespace get the same embedding
+        normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+        return hashlib.sha256(f"{deployment}\n{normalized}".encode()).hexdigest()
+
+    async def get(self, deployment: str, text: str) -> Optional[list[float]]:
+        value = await self.cache.get(self.key(deployment, text))
+        return array.array("d", value).tolist() if value is not None else None
+
+    async def set(self, deployment: str, text: str, embedding: list[float]):
+        await self.cache.set(self.key(deployment, text), array.array("d", embedding).tobytes())
+
+
+async def compute_embedding(deployment: str, text: str, cache: Optional[EmbeddingCache] = None) -> list[float]:
+    if cache is not None:
+        embedding = await cache.get(deployment, text)
+        if embedding is not None:
+            return embedding
+    embedding = (await openai.Embedding.acreate(engine=deployment, input=text))["data"][0]["embedding"]
+    if cache is not None:
+        await cache.set(deployment, text, embedding)
+    return embedding
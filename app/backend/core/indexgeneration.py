@@ -0,0 +1,38 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+
+class IndexGeneration:
+    """
+      The index generation, a token that the ingestion script changes whenever it uploads or removes documents, read from
+      its source at most every refresh seconds so that the caches keyed on it don't read it on every request.
+      A failed read keeps the previous generation.
+      Attributes:
+          source (callable): Coroutine function returning the current index generation, or None for a constant "".
+          refresh (float): Seconds between two reads of the index generation.
+      """
+
+    def __init__(self, source: Optional[Callable[[], Awaitable[str]]] = None, refresh: float = 30):
+        self.source = source
+        self.refresh = refresh
+        self._generation = ""
+        self._checked: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def _is_stale(self) -> bool:
+        return self._checked is None or time.monotonic() - self._checked >= self.refresh
+
+    async def get(self) -> str:
+        if self.source is None or not self._is_stale():
+            return self._generation
+        async with self._lock:
+            # Another request may have refreshed it while this one was waiting for the lock
+            if self._is_stale():
+                try:
+                    self._generation = await self.source()
+                except Exception:
+                    logging.warning("Could not read the search index generation, keeping %r", self._generation, exc_info=True)
+                self._checked = time.monotonic()
+        return self._generation
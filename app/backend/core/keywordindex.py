@@ -0,0 +1,57 @@
+import re
+import unicodedata
+from typing import Any
+
+import numpy as np
+
+# Must match TOKENIZER and tokenize in scripts/prepdocslib/keywordindex.py, which builds the index
+TOKENIZER = "nfkc-casefold-words-1"
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN.findall(unicodedata.normalize("NFKC", text).casefold())
+
+
+class KeywordIndex:
+    """
+      The BM25 inverted index built by prepdocs.py --localindex (see build_keyword_index in scripts/prepdocslib/keywordindex.py):
+      flat arrays of postings grouped by term, with the length of every document and the IDF of every term precomputed, so
+      a query gathers the postings of its terms and sums their scores per document in a single numpy.bincount.
+      Attributes:
+          terms (dict): The id of every term of the vocabulary.
+          offsets (numpy.ndarray): The postings of term i are postings_docs[offsets[i]:offsets[i + 1]].
+          postings_docs (numpy.ndarray): The document of each posting.
+          postings_tf (numpy.ndarray): The frequency of the term of each posting in its document.
+          idf (numpy.ndarray): The inverse document frequency of each term.
+          doc_norms (numpy.ndarray): The length normalization of each document, k1 * (1 - b + b * length / average length).
+      """
+
+    def __init__(self, arrays: Any, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.terms = {term: i for i, term in enumerate(arrays["terms"].tolist())}
+        self.offsets = arrays["offsets"]
+        self.postings_docs = arrays["postings_docs"]
+        self.postings_tf = arrays["postings_tf"]
+        self.idf = arrays["idf"]
+        doc_lengths = arrays["doc_lengths"]
+        average_length = doc_lengths.mean() if len(doc_lengths) and doc_lengths.mean() > 0 else 1.0
+        self.doc_norms = (k1 * (1 - b + b * doc_lengths / average_length)).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.doc_norms)
+
+    def scores(self, query: str) -> np.ndarray:
+        """The BM25 score of query for every document, 0 for those without any of its terms."""
+        term_ids = [self.terms[term] for term in dict.fromkeys(tokenize(query)) if term in self.terms]
+        if not term_ids:
+            return np.zeros(len(self), dtype=np.float32)
+        starts, ends = self.offsets[term_ids], self.offsets[np.asarray(term_ids) + 1]
+        lengths = ends - starts
+        # The positions of the postings of all the terms, and the term of each of them
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        idf = np.repeat(self.idf[term_ids], lengths)
+        docs = self.postings_docs[positions]
+        tf = self.postings_tf[positions]
+        weights = idf * tf * (self.k1 + 1) / (tf + self.doc_norms[docs])
+        return np.bincount(docs, weights=weights, minlength=len(self)).astype(np.float32)
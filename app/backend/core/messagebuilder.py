@@ -1,4 +1,8 @@
-from .modelhelper import num_tokens_from_messages
+import bisect
+import itertools
+from typing import Sequence
+
+from .modelhelper import num_tokens_from_messages, num_tokens_from_messages_batch
 
 
 class MessageBuilder:
@@ -11,6 +15,9 @@ class MessageBuilder:
       Methods:
           __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
           append_message(self, role: str, content: str, index: int = 1): Appends a new message to the conversation.
+          append_messages(self, messages: Sequence[dict[str, str]]): Appends messages to the end of the conversation.
+          append_history(self, turns: Sequence[Sequence[dict[str, str]]], last_message: dict[str, str], max_tokens: int):
+              Appends the most recent turns that fit in max_tokens, followed by last_message.
       """
 
     def __init__(self, system_content: str, chatgpt_model: str):
@@ -23,3 +30,31 @@ class MessageBuilder:
         self.messages.insert(index, {'role': role, 'content': content})
         self.token_length += num_tokens_from_messages(
             self.messages[index], self.model)
+
+    def append_messages(self, messages: Sequence[dict[str, str]]):
+        self.messages.extend(messages)
+        self.token_length += sum(num_tokens_from_messages_batch(list(messages), self.model))
+
+    def append_history(self, turns: Sequence[Sequence[dict[str, str]]], last_message: dict[str, str], max_tokens: int):
+        """
+        Append the longest suffix of turns (oldest first, each a list of messages) that keeps the conversation
+        within max_tokens once last_message is appended after it, then append last_message.
+        Older turns are dropped whole. If even last_message alone does not fit, no turns are added.
+        """
+        counts = num_tokens_from_messages_batch([message for turn in turns for message in turn] + [last_message], self.model)
+        last_message_tokens = counts.pop()
+        turn_tokens = []
+        position = 0
+        for turn in turns:
+            turn_tokens.append(sum(counts[position:position + len(turn)]))
+            position += len(turn)
+
+        # prefix_tokens[i] is the number of tokens in turns[:i], so keeping turns[i:] costs total_tokens - prefix_tokens[i]
+        prefix_tokens = list(itertools.accumulate(turn_tokens, initial=0))
+        total_tokens = prefix_tokens[-1]
+        budget = max_tokens - self.token_length - last_message_tokens
+        first_turn = min(bisect.bisect_left(prefix_tokens, total_tokens - budget), len(turns))
+
+        self.messages.extend(message for turn in turns[first_turn:] for message in turn)
+        self.messages.append(last_message)
+        self.token_length += total_tokens - prefix_tokens[first_turn] + last_message_tokens
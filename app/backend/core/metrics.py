@@ -0,0 +1,286 @@
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator, Optional, Sequence
+
+from .tracing import RequestTrace
+
+# Seconds, from a cached embedding to an agent running several completions
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+ITERATION_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+# What the worker recorded since it last flushed to the store: the amount added to each (metric name, label values, field)
+Pending = dict[tuple[str, tuple[str, ...], str], float]
+
+
+def add_pending(pending: Pending, key: tuple[str, tuple[str, ...], str], amount: float):
+    pending[key] = pending.get(key, 0) + amount
+
+
+class Counter:
+    """A monotonically increasing value per combination of label values."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), pending: Optional[Pending] = None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values: dict[tuple[str, ...], float] = {}
+        self.pending = pending if pending is not None else {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+        add_pending(self.pending, (self.name, label_values, ""), amount)
+
+    def load(self, fields: Iterator[tuple[tuple[str, ...], str, float]]) -> dict[tuple[str, ...], float]:
+        """The values of the counter from the fields of its rows in the store."""
+        return {label_values: value for label_values, _, value in fields}
+
+    def samples(self, values: Optional[dict[tuple[str, ...], float]] = None) -> Iterator[str]:
+        for label_values, value in sorted((self.values if values is None else values).items()):
+            yield f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"
+
+
+class Histogram:
+    """Counts of observed values per bucket (upper bound), with their sum and count, per combination of label values."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS, pending: Optional[Pending] = None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label values: the count of each bucket (not cumulative), the sum and the count of the observations
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+        self.pending = pending if pending is not None else {}
+
+    def observe(self, value: float, *label_values: str):
+        counts, total = self.values.setdefault(label_values, ([0] * len(self.buckets), [0.0, 0]))
+        bucket = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        counts[bucket] += 1
+        total[0] += value
+        total[1] += 1
+        # In the store, each bucket count, the sum and the count are fields of their own
+        add_pending(self.pending, (self.name, label_values, str(bucket)), 1)
+        add_pending(self.pending, (self.name, label_values, "sum"), value)
+        add_pending(self.pending, (self.name, label_values, "count"), 1)
+
+    def load(self, fields: Iterator[tuple[tuple[str, ...], str, float]]) -> dict[tuple[str, ...], tuple[list[int], list[float]]]:
+        """The values of the histogram from the fields of its rows in the store."""
+        values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+        for label_values, field, value in fields:
+            counts, total = values.setdefault(label_values, ([0] * len(self.buckets), [0.0, 0]))
+            if field == "sum":
+                total[0] = value
+            elif field == "count":
+                total[1] = int(value)
+            elif int(field) < len(counts):
+                # Buckets recorded by a version of the app with other bounds are dropped
+                counts[int(field)] = int(value)
+        return values
+
+    def samples(self, values: Optional[dict[tuple[str, ...], tuple[list[int], list[float]]]] = None) -> Iterator[str]:
+        for label_values, (counts, total) in sorted((self.values if values is None else values).items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, f'le="{format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.label_names, label_values)
+            yield f"{self.name}_sum{labels} {format_value(total[0])}"
+            yield f"{self.name}_count{labels} {total[1]}"
+
+
+class MetricsStore:
+    """
+      The values of the metrics in a SQLite file shared by every worker process on the machine, so that a scrape sees their
+      sum (including the workers that gunicorn already recycled) whichever worker answers it. Each worker adds what it
+      recorded since its previous flush to the rows, one per metric, label values and field.
+      Attributes:
+          path (str): The SQLite file, created if it doesn't exist.
+          namespace (str): The table holding the values.
+      """
+
+    def __init__(self, path: str, namespace: str = "metrics"):
+        self.path = path
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared across a fork, so each worker process opens its own
+        if self._connection is None or self._connection_pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.namespace} (name TEXT NOT NULL, labels TEXT NOT NULL, field TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (name, labels, field))")
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def add(self, pending: Pending):
+        rows = [(name, json.dumps(label_values), field, amount) for (name, label_values, field), amount in pending.items()]
+        with self._lock:
+            connection = self._connect()
+            # A single transaction, so a scrape never sees part of a request
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.executemany(f"INSERT INTO {self.namespace} (name, labels, field, value) VALUES (?, ?, ?, ?) "
+                                       "ON CONFLICT (name, labels, field) DO UPDATE SET value = value + excluded.value", rows)
+
+    def read(self) -> dict[str, list[tuple[tuple[str, ...], str, float]]]:
+        """The fields of the rows of each metric."""
+        with self._lock:
+            rows = self._connect().execute(f"SELECT name, labels, field, value FROM {self.namespace}").fetchall()
+        metrics: dict[str, list[tuple[tuple[str, ...], str, float]]] = {}
+        for name, labels, field, value in rows:
+            metrics.setdefault(name, []).append((tuple(json.loads(labels)), field, value))
+        return metrics
+
+
+class MetricsRegistry:
+    """
+      Metrics rendered in the Prometheus text exposition format (version 0.0.4), without depending on a client library.
+      Without a store, the values live in the memory of the worker process, so with several workers every scrape sees those
+      of the worker that answered it. With a store, the workers flush what they recorded to it every flush_interval seconds
+      (from start() to close()) and render the values summed over all of them, at most flush_interval seconds old for the
+      other workers. The store is written and read in a thread, like DiskCache, not to stall the requests of the event loop.
+      Methods:
+          counter(self, name, documentation, label_names): Registers and returns a Counter.
+          histogram(self, name, documentation, label_names, buckets): Registers and returns a Histogram.
+          render(self): Returns the text of all the metrics.
+      """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, store: Optional[MetricsStore] = None, flush_interval: float = 5):
+        self.metrics: list = []
+        self.store = store
+        self.flush_interval = flush_interval
+        self.pending: Pending = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        counter = Counter(name, documentation, label_names, self.pending)
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS) -> Histogram:
+        histogram = Histogram(name, documentation, label_names, buckets, self.pending)
+        self.metrics.append(histogram)
+        return histogram
+
+    async def start(self):
+        if self.store is not None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # What the worker recorded since its last flush would be lost once it exits
+        await self.flush()
+
+    async def flush(self):
+        if self.store is None or not self.pending:
+            return
+        pending = dict(self.pending)
+        self.pending.clear()
+        try:
+            await asyncio.to_thread(self.store.add, pending)
+        except sqlite3.Error:
+            logging.warning("Metrics store unavailable, flushing later", exc_info=True)
+            # Recorded again for the next flush, along with what the requests recorded in the meantime
+            for key, amount in pending.items():
+                add_pending(self.pending, key, amount)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def render(self) -> str:
+        values = {}
+        if self.store is not None:
+            await self.flush()
+            # A failed read fails the scrape, rather than rendering the values of this worker alone as if they were the total
+            fields = await asyncio.to_thread(self.store.read)
+            values = {metric.name: metric.load(fields.get(metric.name, [])) for metric in self.metrics}
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples(values.get(metric.name)))
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    """
+      The metrics of the requests to the approaches, per endpoint and approach: their duration and outcome, the duration of
+      their stages, the tokens of their completions and the iterations of their agents, recorded from a RequestTrace.
+      Attributes:
+          registry (MetricsRegistry): The registry to render for /metrics.
+      """
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        self.registry = registry or MetricsRegistry()
+        labels = ("endpoint", "approach")
+        self.requests = self.registry.counter("app_requests_total", "Requests to the approaches by outcome.", (*labels, "status"))
+        self.request_duration = self.registry.histogram("app_request_duration_seconds", "Duration of the requests to the approaches.", labels)
+        self.stage_duration = self.registry.histogram("app_stage_duration_seconds", "Duration of each stage of a request, summed over the request.", (*labels, "stage"))
+        self.tokens = self.registry.counter("app_openai_tokens_total", "Tokens of the completions reported by Azure OpenAI.", (*labels, "type"))
+        self.agent_iterations = self.registry.histogram("app_agent_iterations", "Completions of the agent per request.", labels, ITERATION_BUCKETS)
+
+    def observe(self, endpoint: str, approach: str, trace: RequestTrace, duration: float, status: str):
+        self.requests.inc(endpoint, approach, status)
+        self.request_duration.observe(duration, endpoint, approach)
+        for name, stage_duration in trace.stage_durations().items():
+            self.stage_duration.observe(stage_duration, endpoint, approach, name)
+        self.tokens.inc(endpoint, approach, "prompt", amount=trace.prompt_tokens)
+        self.tokens.inc(endpoint, approach, "completion", amount=trace.completion_tokens)
+        if trace.agent_iterations is not None:
+            self.agent_iterations.observe(trace.agent_iterations, endpoint, approach)
+
+    @contextlib.contextmanager
+    def track(self, endpoint: str, approach: str) -> Iterator[RequestTrace]:
+        """Time the block as a request and record the stages of the trace it yields (which the block activates) when it ends."""
+        trace = RequestTrace()
+        status = "error"
+        start = time.perf_counter()
+        try:
+            yield trace
+            status = "ok"
+        finally:
+            duration = time.perf_counter() - start
+            logging.debug("%s %s took %.1fms (%s)", endpoint, approach, duration * 1000, trace.server_timing())
+            self.observe(endpoint, approach, trace, duration, status)
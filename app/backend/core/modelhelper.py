@@ -1,5 +1,10 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+
 import tiktoken
 
 MODELS_2_TOKEN_LIMITS = {
@@ -16,6 +21,12 @@ AOAI_2_OAI = {
     "gpt-35-turbo-16k": "gpt-3.5-turbo-16k"
 }
 
+# Number of (encoding, content hash) -> token count entries kept per process
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+_token_counts: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+_token_counts_lock = threading.Lock()
+
 
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
@@ -37,13 +48,54 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         num_tokens_from_messages(message, model)
         output: 11
     """
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
-    num_tokens = 2  # For "role" and "content" keys
-    for key, value in message.items():
-        num_tokens += len(encoding.encode(value))
+    return num_tokens_from_messages_batch([message], model)[0]
+
+
+def num_tokens_from_messages_batch(messages: list[dict[str, str]], model: str) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each message of a list in one call.
+    Values that were counted before are served from the per-process token count cache, the others are encoded once and cached.
+    Args:
+        messages (list): The messages to encode, each represented as a dictionary.
+        model (str): The name of the model to use for encoding.
+    Returns:
+        list: The number of tokens required to encode each message, in the same order as messages.
+    """
+    encoding = get_encoding(model)
+    counts = _count_tokens([value for message in messages for value in message.values()], encoding)
+    num_tokens = []
+    position = 0
+    for message in messages:
+        num_tokens.append(2 + sum(counts[position:position + len(message)]))  # 2 for "role" and "content" keys
+        position += len(message)
     return num_tokens
 
 
+def _count_tokens(texts: list[str], encoding: tiktoken.Encoding) -> list[int]:
+    keys = [(encoding.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()) for text in texts]
+    counts: list[int | None] = [None] * len(texts)
+    with _token_counts_lock:
+        for i, key in enumerate(keys):
+            if key in _token_counts:
+                _token_counts.move_to_end(key)
+                counts[i] = _token_counts[key]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        # Encoding.encode_batch spins up a thread pool per call, which costs more than it saves for a few messages
+        encoded = [len(encoding.encode(texts[i])) for i in missing]
+        with _token_counts_lock:
+            for i, num_tokens in zip(missing, encoded):
+                counts[i] = _token_counts[keys[i]] = num_tokens
+            while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+                _token_counts.popitem(last=False)
+    return counts
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
@@ -0,0 +1,136 @@
+import contextlib
+import logging
+import time
+from typing import Any, Callable, Iterator, Optional
+
+from azure.search.documents.models import QueryType
+
+from text import nonewlines
+
+from . import tracing
+from .embeddings import EmbeddingCache, compute_embedding
+
+
+class Retriever:
+    """
+      Runs the searches of all the approaches: reads the retrieval options from the overrides, computes the query embedding,
+      queries the index and formats the documents as "sourcepage: content" lines for the prompts.
+      The search client and embedding cache are shared by every approach, so a caching or connection change applies to all of them,
+      and each stage ("embedding", "search", "lookup") is timed, reported to on_stage and added to the trace of the request.
+      Attributes:
+          search_client: The async SearchClient, or a wrapper with the same search method (e.g. CachingSearchClient).
+          embedding_deployment (str): The Azure OpenAI deployment computing the query embeddings.
+          sourcepage_field (str): The index field naming the source of a document, used for citations.
+          content_field (str): The index field holding the text of a document.
+          embedding_cache (EmbeddingCache): Cache of query embeddings, or None.
+          on_stage (callable): Called with the name and duration in seconds of every stage, or None.
+      """
+
+    def __init__(self, search_client: Any, embedding_deployment: str, sourcepage_field: str, content_field: str, embedding_cache: Optional[EmbeddingCache] = None, on_stage: Optional[Callable[[str, float], None]] = None):
+        self.search_client = search_client
+        self.embedding_deployment = embedding_deployment
+        self.sourcepage_field = sourcepage_field
+        self.content_field = content_field
+        self.embedding_cache = embedding_cache
+        self.on_stage = on_stage
+
+    @staticmethod
+    def retrieval_mode(overrides: dict[str, Any]) -> tuple[bool, bool]:
+        """Returns whether the retrieval mode of the overrides uses text and vectors, both of them by default (hybrid)."""
+        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
+        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        return has_text, has_vector
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            with tracing.stage(name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            logging.debug("Retrieval stage %s took %.1fms", name, elapsed * 1000)
+            if self.on_stage is not None:
+                self.on_stage(name, elapsed)
+
+    async def embed(self, text: str) -> list[float]:
+        with self.stage("embedding"):
+            return await compute_embedding(self.embedding_deployment, text, self.embedding_cache)
+
+    async def search(self, query_text: Optional[str], overrides: dict[str, Any], query_vector: Optional[list[float]] = None) -> list[dict[str, Any]]:
+        """
+        Search the index for query_text with the options of the overrides, and return the documents.
+        If the retrieval mode uses vectors and no query_vector is given, the embedding of query_text is computed first.
+        """
+        has_text, has_vector = self.retrieval_mode(overrides)
+        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
+        top = overrides.get("top") or 3
+        exclude_category = overrides.get("exclude_category") or None
+        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+
+        # If retrieval mode includes vectors, compute an embedding for the query
+        if not has_vector:
+            query_vector = None
+        elif query_vector is None:
+            query_vector = await self.embed(query_text)
+
+        # Only keep the text query if the retrieval mode uses text, otherwise drop it
+        if not has_text:
+            query_text = None
+
+        with self.stage("search"):
+            # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
+            if overrides.get("semantic_ranker") and has_text:
+                r = await self.search_client.search(query_text,
+                                                    filter=filter,
+                                                    query_type=QueryType.SEMANTIC,
+                                                    query_language="en-us",
+                                                    query_speller="lexicon",
+                                                    semantic_configuration_name="default",
+                                                    top=top,
+                                                    query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                                    vector=query_vector,
+                                                    top_k=50 if query_vector else None,
+                                                    vector_fields="embedding" if query_vector else None)
+            else:
+                r = await self.search_client.search(query_text,
+                                                    filter=filter,
+                                                    top=top,
+                                                    vector=query_vector,
+                                                    top_k=50 if query_vector else None,
+                                                    vector_fields="embedding" if query_vector else None)
+            return [doc async for doc in r]
+
+    async def lookup(self, query_text: str) -> Optional[str]:
+        """Look up query_text with a semantic search of the top document, and return its extractive answer, or its content if it has none."""
+        with self.stage("lookup"):
+            r = await self.search_client.search(query_text,
+                                                top=1,
+                                                include_total_count=True,
+                                                query_type=QueryType.SEMANTIC,
+                                                query_language="en-us",
+                                                query_speller="lexicon",
+                                                semantic_configuration_name="default",
+                                                query_answer="extractive|count-1",
+                                                query_caption="extractive|highlight-false")
+            answers = await r.get_answers()
+            if answers:
+                return answers[0].text
+            if await r.get_count() > 0:
+                return "\n".join([doc[self.content_field] async for doc in r])
+            return None
+
+    def format(self, doc: dict[str, Any], use_semantic_captions: bool, separator: str = ": ", caption_separator: str = " . ", max_length: Optional[int] = None) -> str:
+        """Format a document as a source line of a prompt: its source page, separator and its captions or (truncated) content."""
+        if use_semantic_captions:
+            content = caption_separator.join([c.text for c in doc['@search.captions']])
+        else:
+            content = doc[self.content_field][:max_length]
+        return doc[self.sourcepage_field] + separator + nonewlines(content)
+
+    async def retrieve(self, query_text: Optional[str], overrides: dict[str, Any], query_vector: Optional[list[float]] = None, **format_options: Any) -> list[str]:
+        """Search like search() and return the documents formatted like format(), see there for the format_options."""
+        has_text, _ = self.retrieval_mode(overrides)
+        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
+        docs = await self.search(query_text, overrides, query_vector)
+        return [self.format(doc, use_semantic_captions, **format_options) for doc in docs]
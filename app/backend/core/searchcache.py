@@ -0,0 +1,90 @@
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Optional
+
+from azure.search.documents.models import CaptionResult
+
+from .diskcache import DiskCache
+from .indexgeneration import IndexGeneration
+
+
+class SearchCache:
+    """
+      Search results shared by all workers through a DiskCache. Every key includes the index generation, a token
+      that the ingestion script changes whenever it uploads or removes documents, so cached results stop being
+      served as soon as the corpus changes instead of lingering until their TTL.
+      Attributes:
+          cache (DiskCache): The underlying store.
+          index_generation (IndexGeneration): The index generation, read from generation_source every generation_refresh seconds.
+      """
+
+    def __init__(self, path: str, ttl: float, max_entries: int, generation_source: Optional[Callable[[], Awaitable[str]]] = None, generation_refresh: float = 30):
+        self.cache = DiskCache(path, "searchresults", ttl, max_entries)
+        self.index_generation = IndexGeneration(generation_source, generation_refresh)
+
+    async def generation(self) -> str:
+        return await self.index_generation.get()
+
+    @staticmethod
+    def key(generation: str, search_text: Optional[str], options: dict[str, Any]) -> str:
+        request = json.dumps({"generation": generation, "search_text": search_text, **options}, sort_keys=True, default=str)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[list[dict[str, Any]]]:
+        value = await self.cache.get(key)
+        if value is None:
+            return None
+        documents = json.loads(value)
+        for doc in documents:
+            if doc.get("@search.captions") is not None:
+                doc["@search.captions"] = [CaptionResult.from_dict(c) for c in doc["@search.captions"]]
+        return documents
+
+    async def set(self, key: str, documents: list[dict[str, Any]]):
+        def serialize(value):
+            if isinstance(value, CaptionResult):
+                return value.as_dict()
+            raise TypeError(f"Cannot cache a {type(value).__name__} in search results")
+
+        await self.cache.set(key, json.dumps(documents, default=serialize).encode())
+
+
+class CachedSearchResults:
+    """Documents of a cached search, iterated like the results of SearchClient.search."""
+
+    def __init__(self, documents: list[dict[str, Any]]):
+        self.documents = documents
+
+    async def __aiter__(self):
+        for doc in self.documents:
+            yield doc
+
+
+class CachingSearchClient:
+    """
+      Wraps the async SearchClient so that repeated searches with the same text and options are answered from a SearchCache.
+      Searches asking for counts, answers or facets are not cached and go straight to the service, as do all other methods.
+      Fields in exclude_fields (the vectors, by default) are dropped from cached documents to keep entries small.
+      """
+
+    UNCACHED_OPTIONS = ("include_total_count", "query_answer", "facets")
+
+    def __init__(self, search_client: Any, cache: SearchCache, exclude_fields: tuple[str, ...] = ("embedding",)):
+        self.search_client = search_client
+        self.cache = cache
+        self.exclude_fields = exclude_fields
+
+    async def search(self, search_text: Optional[str] = None, **kwargs: Any) -> Any:
+        if any(kwargs.get(option) for option in self.UNCACHED_OPTIONS):
+            return await self.search_client.search(search_text, **kwargs)
+
+        key = self.cache.key(await self.cache.generation(), search_text, kwargs)
+        documents = await self.cache.get(key)
+        if documents is None:
+            results = await self.search_client.search(search_text, **kwargs)
+            documents = [{k: v for k, v in doc.items() if k not in self.exclude_fields} async for doc in results]
+            await self.cache.set(key, documents)
+        return CachedSearchResults(documents)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.search_client, name)
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Optional
+
+from azure.core.credentials import AccessToken
+
+
+class TokenManager:
+    """
+      Keeps an access token fresh from a background task, so that requests never wait for the identity endpoint.
+      The token is refreshed refresh_margin seconds before it expires (or retry_interval seconds after a failed attempt, or after
+      one returning a token that already expires within the margin), and a lock makes sure a single get_token call is in flight
+      per worker, whoever asks for the refresh.
+      Attributes:
+          credential: The async credential issuing the tokens.
+          scope (str): The scope of the tokens.
+          on_refresh (callable): Called with every new token, e.g. to hand it to a client library.
+          token (AccessToken): The current token, None until start() returns.
+      """
+
+    def __init__(self, credential: Any, scope: str, on_refresh: Callable[[AccessToken], None], refresh_margin: float = 300, retry_interval: float = 10):
+        self.credential = credential
+        self.scope = scope
+        self.on_refresh = on_refresh
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.token: Optional[AccessToken] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def needs_refresh(self) -> bool:
+        return self.token is None or self.token.expires_on - self.refresh_margin <= time.time()
+
+    async def start(self):
+        # The first token is fetched before serving, every later one in the background
+        await self.refresh()
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def refresh(self) -> AccessToken:
+        async with self._lock:
+            # Another caller may have refreshed it while this one was waiting for the lock
+            if self.needs_refresh():
+                token = await self.credential.get_token(self.scope)
+                self.token = token
+                self.on_refresh(token)
+        return self.token
+
+    async def _refresh_loop(self):
+        while True:
+            delay = self.token.expires_on - self.refresh_margin - time.time()
+            await asyncio.sleep(max(delay, 0))
+            try:
+                await self.refresh()
+            except Exception:
+                logging.warning("Could not refresh the token for %s, retrying in %ss", self.scope, self.retry_interval, exc_info=True)
+                await asyncio.sleep(self.retry_interval)
+                continue
+            if self.needs_refresh():
+                # The credential handed back a token expiring within the margin, e.g. the cached one when azure-identity
+                # couldn't refresh it (it doesn't raise), so retry later instead of asking for it again right away
+                logging.warning("The token for %s expires in %ds, retrying in %ss", self.scope, self.token.expires_on - time.time(), self.retry_interval)
+                await asyncio.sleep(self.retry_interval)
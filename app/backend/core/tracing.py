@@ -0,0 +1,89 @@
+import contextlib
+import contextvars
+import threading
+import time
+from typing import Any, Iterator, Optional
+
+
+class RequestTrace:
+    """
+      The stages of one request to an approach and what they used: a span (name, duration in seconds) for every query rewrite,
+      embedding, search or completion, the prompt and completion tokens reported in the usage of the completions, and the
+      number of iterations of the agent of the langchain approaches (None for the others).
+      The trace of the current request is found through a context variable, set by activate(), so the approaches and the
+      retriever record their stages without passing the trace around. Langchain callbacks run in threads where the context
+      is not set, they are given the trace instead (see TracingCallbackHandler), hence the lock.
+      Attributes:
+          spans (list): The (stage name, duration) of every stage, in the order they finished.
+          prompt_tokens (int): Tokens of the prompts of all the completions.
+          completion_tokens (int): Tokens generated by all the completions.
+          agent_iterations (int): Completions of the agent, or None if no agent ran.
+      """
+
+    def __init__(self):
+        self.spans: list[tuple[str, float]] = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.agent_iterations: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, duration: float):
+        with self._lock:
+            self.spans.append((name, duration))
+
+    def add_usage(self, usage: Optional[dict[str, Any]]):
+        """Add the tokens of the usage of a completion, e.g. {"prompt_tokens": 950, "completion_tokens": 80, "total_tokens": 1030}."""
+        if not usage:
+            return
+        with self._lock:
+            self.prompt_tokens += usage.get("prompt_tokens") or 0
+            self.completion_tokens += usage.get("completion_tokens") or 0
+
+    def add_agent_iteration(self):
+        with self._lock:
+            self.agent_iterations = (self.agent_iterations or 0) + 1
+
+    def stage_durations(self) -> dict[str, float]:
+        """The total duration of each stage, e.g. of all the searches of an agent."""
+        durations: dict[str, float] = {}
+        for name, duration in self.spans:
+            durations[name] = durations.get(name, 0.0) + duration
+        return durations
+
+    def server_timing(self) -> str:
+        """The stages as a Server-Timing header value (durations in milliseconds), shown by the network tab of browsers."""
+        return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in self.stage_durations().items())
+
+    @contextlib.contextmanager
+    def activate(self) -> Iterator["RequestTrace"]:
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+
+_current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar("current_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the block as a stage of the current trace, if there is one (outside of requests, e.g. in tests, there isn't)."""
+    trace = current_trace()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.add_span(name, time.perf_counter() - start)
+
+
+def record_usage(completion: Any):
+    """Add the token usage of a (non streamed) completion response to the current trace."""
+    trace = current_trace()
+    if trace is not None:
+        trace.add_usage(completion.get("usage"))
@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, Optional
+
+import numpy as np
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from azure.search.documents.aio import AsyncSearchItemPaged
+from azure.search.documents.models import CaptionResult
+
+from .keywordindex import TOKENIZER, KeywordIndex
+
+# The only filter the retriever builds, see Retriever.search
+CATEGORY_FILTER = re.compile(r"^category ne '((?:[^']|'')*)'$")
+# Constant of reciprocal rank fusion, the value of the paper (and of hybrid queries in Cognitive Search)
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = RRF_K) -> list[tuple[int, float]]:
+    """Merge rankings of the same documents into one, scoring each document by the sum of 1 / (k + rank) over the rankings."""
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            scores[doc] = scores.get(doc, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LocalVectorIndex:
+    """
+      The sections and embeddings written by prepdocs.py --localindex (see scripts/prepdocslib/vectorindex.py), searched in-process
+      by brute force: the embedding matrix is memory-mapped read-only, so every worker of the machine shares the same pages, and
+      its rows (normalized by prepdocs) are scored against the query in blocks of block_size rows converted to float32, so a
+      float16 matrix is never copied whole. Scoring reads the whole matrix, about 3ms per 5000 sections of 1536 float32 values
+      (benchmarks/local_vector_index.py), a fraction of a round trip to Cognitive Search for the corpora it's meant for.
+      Text queries are scored with BM25 by the KeywordIndex written alongside (by prepdocs since it builds one).
+      The index is reloaded when prepdocs writes a new one, checked at most every refresh_interval seconds.
+      Attributes:
+          directory (str): The directory written by prepdocs.
+          sections (list): The fields of the section of each row of the matrix.
+          matrix (numpy.ndarray): The memory-mapped embeddings, one row per section.
+          keywords (KeywordIndex): The BM25 index of the content of the sections, or None for an index written without one.
+      """
+
+    def __init__(self, directory: str, block_size: int = 4096, refresh_interval: float = 30):
+        self.directory = directory
+        self.block_size = block_size
+        self.refresh_interval = refresh_interval
+        self.sections: list[dict[str, Any]] = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.categories = np.array([], dtype=object)
+        self.keywords: Optional[KeywordIndex] = None
+        self._mtime_ns: Optional[int] = None
+        self._checked = 0.0
+        self.load()
+
+    @property
+    def metadata_path(self) -> str:
+        return os.path.join(self.directory, "index.json")
+
+    def load(self):
+        # prepdocs removes the previous files after replacing index.json, read it again if the files it names are already gone
+        for attempt in range(3):
+            mtime_ns = os.stat(self.metadata_path).st_mtime_ns
+            with open(self.metadata_path, encoding="utf-8") as f:
+                metadata = json.load(f)
+            try:
+                matrix = np.load(os.path.join(self.directory, metadata["matrix"]), mmap_mode="r") if metadata["sections"] else np.zeros((0, 0), dtype=np.float32)
+                keywords = None
+                if metadata.get("keywords"):
+                    if metadata.get("tokenizer") != TOKENIZER:
+                        raise ValueError(f"The keyword index in {self.directory} was built with the {metadata.get('tokenizer')} tokenizer instead of {TOKENIZER}")
+                    # The postings are a fraction of the size of the embeddings, they're read in memory
+                    with np.load(os.path.join(self.directory, metadata["keywords"])) as arrays:
+                        keywords = KeywordIndex(arrays)
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+        if len(matrix) != len(metadata["sections"]) or (keywords is not None and len(keywords) != len(metadata["sections"])):
+            raise ValueError(f"The local index in {self.directory} doesn't have one embedding and one keyword entry for each of its {len(metadata['sections'])} sections")
+        self.sections = metadata["sections"]
+        self.matrix = matrix
+        self.keywords = keywords
+        self.categories = np.array([section.get("category") for section in self.sections], dtype=object)
+        self._mtime_ns = mtime_ns
+        logging.info("Loaded %d sections from local index %s", len(self.sections), self.directory)
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._checked < self.refresh_interval:
+            return
+        self._checked = now
+        try:
+            if os.stat(self.metadata_path).st_mtime_ns != self._mtime_ns:
+                self.load()
+        except (OSError, ValueError):
+            # Keep answering from the index already loaded, e.g. while prepdocs is writing a new one
+            logging.exception("Failed to reload local index %s", self.directory)
+
+    def scores(self, vector: list[float]) -> np.ndarray:
+        """The cosine similarity of vector with every section."""
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+        scores = np.empty(len(self.matrix), dtype=np.float32)
+        for start in range(0, len(self.matrix), self.block_size):
+            block = self.matrix[start:start + self.block_size]
+            scores[start:start + len(block)] = np.asarray(block, dtype=np.float32) @ query
+        return scores
+
+    def top_rows(self, scores: np.ndarray, top: int, exclude_category: Optional[str] = None, minimum: float = -np.inf) -> list[int]:
+        """The rows of the top scores above minimum, best first, leaving out the sections of exclude_category."""
+        if exclude_category is not None:
+            scores[self.categories == exclude_category] = -np.inf
+        top = min(top, len(scores))
+        if top <= 0:
+            return []
+        # Only the top rows are sorted, argpartition finds them in linear time
+        rows = np.argpartition(-scores, top - 1)[:top]
+        rows = rows[np.argsort(-scores[rows], kind="stable")]
+        return rows[scores[rows] > minimum].tolist()
+
+    def search(self, vector: list[float], top: int, exclude_category: Optional[str] = None) -> list[tuple[dict[str, Any], float]]:
+        """The top sections most similar to vector, with their score, best first."""
+        self.refresh()
+        if not self.sections:
+            return []
+        scores = self.scores(vector)
+        rows = self.top_rows(scores, top, exclude_category)
+        return list(zip([self.sections[row] for row in rows], scores[rows].tolist()))
+
+    def keyword_search(self, text: str, top: int, exclude_category: Optional[str] = None) -> list[tuple[dict[str, Any], float]]:
+        """The top sections by BM25 score for text, with their score, best first, only those with at least one of its terms."""
+        self.refresh()
+        if self.keywords is None:
+            raise ValueError("The local index has no keyword index, write it again with the current prepdocs.py to search text")
+        if not self.sections:
+            return []
+        scores = self.keywords.scores(text)
+        rows = self.top_rows(scores, top, exclude_category, minimum=0)
+        return list(zip([self.sections[row] for row in rows], scores[rows].tolist()))
+
+
+class LocalSearchResults:
+    """Documents of a local search, iterated like the results of SearchClient.search."""
+
+    def __init__(self, documents: list[dict[str, Any]]):
+        self.documents = documents
+
+    async def __aiter__(self):
+        for doc in self.documents:
+            yield doc
+
+    async def get_count(self) -> int:
+        return len(self.documents)
+
+    async def get_answers(self) -> Optional[list]:
+        return None
+
+
+class LocalSearchClient:
+    """
+      Answers the searches of the Retriever from a LocalVectorIndex instead of Cognitive Search, for small corpora, offline
+      development and reproducible retrieval benchmarks. Text queries are scored with BM25 and vector queries by cosine
+      similarity, hybrid queries fuse the top_k results of both by reciprocal rank like Cognitive Search does. There is no
+      semantic ranking, so the captions of a document are its whole content, and lookups get no answers.
+      """
+
+    def __init__(self, index: LocalVectorIndex):
+        self.index = index
+
+    async def search(self, search_text: Optional[str] = None, filter: Optional[str] = None, top: Optional[int] = None,
+                     vector: Optional[list[float]] = None, top_k: Optional[int] = None, query_caption: Optional[str] = None,
+                     **kwargs: Any) -> LocalSearchResults:
+        top = top or 50
+        exclude_category = None
+        if filter is not None:
+            match = CATEGORY_FILTER.match(filter)
+            if not match:
+                raise ValueError(f"Unsupported filter for the local index: {filter}")
+            exclude_category = match.group(1).replace("''", "'")
+
+        if search_text and vector is not None:
+            candidates = max(top, top_k or 0)
+            vector_results = self.index.search(vector, candidates, exclude_category)
+            text_results = self.index.keyword_search(search_text, candidates, exclude_category)
+            sections = {section["id"]: section for section, _ in vector_results + text_results}
+            fused = reciprocal_rank_fusion([[section["id"] for section, _ in vector_results], [section["id"] for section, _ in text_results]])
+            results = [(sections[id], score) for id, score in fused[:top]]
+        elif vector is not None:
+            results = self.index.search(vector, top, exclude_category)
+        elif search_text:
+            results = self.index.keyword_search(search_text, top, exclude_category)
+        else:
+            raise ValueError("The local index needs a text or vector query")
+
+        documents = []
+        for section, score in results:
+            document = {**section, "@search.score": score}
+            if query_caption:
+                document["@search.captions"] = [CaptionResult.from_dict({"text": section["content"]})]
+            documents.append(document)
+        return LocalSearchResults(documents)
+
+    async def close(self):
+        pass
+
+
+class FallbackSearchClient:
+    """
+      Sends searches to Cognitive Search, and answers them from a LocalSearchClient when the service is throttling (429),
+      unavailable (503) or unreachable, so users get results from the same content (without semantic ranking) instead of an error.
+      All other methods go to the search client.
+      """
+
+    FALLBACK_STATUS_CODES = (429, 503)
+
+    def __init__(self, search_client: Any, fallback: LocalSearchClient):
+        self.search_client = search_client
+        self.fallback = fallback
+
+    async def search(self, search_text: Optional[str] = None, **kwargs: Any) -> Any:
+        try:
+            results = await self.search_client.search(search_text, **kwargs)
+            # The SDK only sends the request when the results are first read, which get_count does
+            if isinstance(results, AsyncSearchItemPaged):
+                await results.get_count()
+            return results
+        except HttpResponseError as e:
+            if e.status_code not in self.FALLBACK_STATUS_CODES:
+                raise
+            logging.warning("Search failed with status %s, answering from the local index", e.status_code)
+        except ServiceRequestError as e:
+            logging.warning("Search failed (%s), answering from the local index", e)
+        return await self.fallback.search(search_text, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.search_client, name)
@@ -5,8 +5,8 @@ max_requests_jitter = 50
 log_file = "-"
 bind = "0.0.0.0"
 
+timeout = 600
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
-threads = 1 if num_cpus == 1 else 2
-timeout = 600
-worker_class = "gthread"
+# The app is ASGI, each worker runs an event loop that keeps many requests in flight while they wait on I/O
+worker_class = "uvicorn.workers.UvicornWorker"
@@ -1,8 +1,12 @@
+import time
 from typing import Any, Dict, List, Optional, Union
+from uuid import UUID
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
+from core.tracing import RequestTrace
+
 
 def ch(text: Union[str, object]) -> str:
     s = text if isinstance(text, str) else str(text)
@@ -88,3 +92,33 @@ class HtmlCallbackHandler (BaseCallbackHandler):
     ) -> None:
         """Run on agent end."""
         self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+
+class TracingCallbackHandler (BaseCallbackHandler):
+    """
+    Adds every completion of an agent to a RequestTrace: its duration as a "completion" span, its token usage and an iteration
+    of the agent. Langchain runs the callbacks of synchronous handlers in threads, where the context of the request is not
+    set, so the trace is given here rather than looked up.
+    """
+
+    def __init__(self, trace: Optional[RequestTrace]):
+        self.trace = trace
+        self.starts: Dict[UUID, float] = {}
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self.starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        start = self.starts.pop(run_id, None)
+        if self.trace is None:
+            return
+        if start is not None:
+            self.trace.add_span("completion", time.perf_counter() - start)
+        self.trace.add_usage((response.llm_output or {}).get("token_usage"))
+        self.trace.add_agent_iteration()
+
+    def on_llm_error(self, error: Exception, *, run_id: UUID, **kwargs: Any) -> None:
+        start = self.starts.pop(run_id, None)
+        if self.trace is not None and start is not None:
+            self.trace.add_span("completion", time.perf_counter() - start)
@@ -57,7 +57,7 @@ echo ""
 
 cd ../backend
 xdg-open http://127.0.0.1:5000
-./backend_env/bin/python -m flask run --port=5000 --reload --debug
+./backend_env/bin/python -m quart --app app:create_app run --port=5000 --reload
 if [ $? -ne 0 ]; then
     echo "Failed to start backend"
     exit $?
@@ -0,0 +1,213 @@
+"""
+Local stand-ins for the Azure OpenAI (chat completions, completions and embeddings), Azure Cognitive Search and Blob Storage
+endpoints used by the backend, answering with payloads of a configurable size after a configurable latency, so the backend
+can be load tested without calling (and being throttled by) the real services. Used by benchmarks/loadtest.py.
+
+Run on its own with:
+    python benchmarks/fakeservices.py --port 8100 [--openai-latency lognormal:400:0.5] [--search-latency 50] ...
+Latencies are in milliseconds, either a fixed value or a distribution: normal:MEAN:STDEV, lognormal:MEDIAN:SIGMA or uniform:MIN:MAX.
+The completions follow the formats of the langchain agents of the ask approaches, so they finish after one search.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from email.utils import formatdate
+
+from aiohttp import web
+
+WORDS = ["Northwind", "Health", "Plus", "covers", "preventive", "care", "vision", "dental", "in-network", "deductible", "employees",
+         "plan", "benefits", "mental", "health", "services", "copay", "coverage", "emergency", "prescription"]
+
+
+class Latency:
+    """A latency distribution in milliseconds, parsed from "200", "normal:200:50", "lognormal:200:0.5" or "uniform:100:300"."""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, *params = spec.split(":") if ":" in spec else ("fixed", spec)
+        values = [float(p) for p in params]
+        if kind == "fixed":
+            self.sample_ms = lambda: values[0]
+        elif kind == "normal":
+            self.sample_ms = lambda: random.gauss(values[0], values[1])
+        elif kind == "lognormal":
+            self.sample_ms = lambda: random.lognormvariate(math.log(values[0]), values[1])
+        elif kind == "uniform":
+            self.sample_ms = lambda: random.uniform(values[0], values[1])
+        else:
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        """A latency in seconds, never negative."""
+        return max(0.0, self.sample_ms()) / 1000
+
+    async def wait(self):
+        await asyncio.sleep(self.sample())
+
+
+def words(count: int) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(count))
+
+
+class FakeServices:
+    def __init__(self, openai_latency: Latency, token_latency: Latency, embedding_latency: Latency, search_latency: Latency,
+                 completion_tokens: int, content_length: int, embedding_dimensions: int):
+        self.openai_latency = openai_latency
+        self.token_latency = token_latency
+        self.embedding_latency = embedding_latency
+        self.search_latency = search_latency
+        self.completion_tokens = completion_tokens
+        self.content_length = content_length
+        # The same vector for every input, serialized once, so the fake spends its time waiting rather than formatting floats
+        self.embedding_json = json.dumps([round(random.uniform(-0.05, 0.05), 6) for _ in range(embedding_dimensions)])
+        self.requests: dict[str, int] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/openai/deployments/{deployment}/chat/completions", self.chat_completions)
+        app.router.add_post("/openai/deployments/{deployment}/completions", self.completions)
+        app.router.add_post("/openai/deployments/{deployment}/embeddings", self.embeddings)
+        app.router.add_post("/search/{path:.*}", self.search)
+        app.router.add_get("/blob/{container}", self.container_properties)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    def count(self, name: str):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    def usage(self, prompt: str, completion: str) -> dict:
+        # About 4 characters per token, good enough for load testing
+        prompt_tokens, completion_tokens = len(prompt) // 4, len(completion) // 4
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    async def generation_delay(self, tokens: int):
+        await self.openai_latency.wait()
+        await asyncio.sleep(sum(self.token_latency.sample() for _ in range(tokens)))
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.count("chat")
+        body = await request.json()
+        prompt = "\n".join(message.get("content") or "" for message in body["messages"])
+        answer = f"{words(self.completion_tokens)} [benefits-{random.randint(0, 9)}.pdf]"
+        if not body.get("stream"):
+            await self.generation_delay(self.completion_tokens)
+            return web.json_response({
+                "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": "gpt-35-turbo",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer}}],
+                "usage": self.usage(prompt, answer)})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await self.openai_latency.wait()
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        for i, token in enumerate(answer.split(" ")):
+            await asyncio.sleep(self.token_latency.sample())
+            delta = {"role": "assistant", "content": token} if i == 0 else {"content": " " + token}
+            chunk = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": "gpt-35-turbo",
+                     "choices": [{"index": 0, "finish_reason": None, "delta": delta}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        done = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": "gpt-35-turbo",
+                "choices": [{"index": 0, "finish_reason": "stop", "delta": {}}]}
+        await response.write(f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n".encode())
+        await response.write_eof()
+        return response
+
+    def agent_step(self, prompt: str) -> str:
+        """The next step of the agent of the prompt: a search, or the final answer once the prompt holds an observation."""
+        scratchpad = prompt[prompt.rfind("Question:"):]
+        question = scratchpad.split("\n", 1)[0].removeprefix("Question:").strip()
+        answer = f"{words(self.completion_tokens)} [benefits-{random.randint(0, 9)}.pdf]"
+        if "Action Input:" in prompt:
+            # ZeroShotAgent (ask rrr)
+            if "Observation:" in scratchpad:
+                return f" I now know the final answer.\nFinal Answer: {answer}"
+            return f" I need to search for {question}\nAction: CognitiveSearch\nAction Input: {question}"
+        # ReActDocstoreAgent (ask rda)
+        if "Observation:" in scratchpad:
+            return f"Thought: I can answer now.\nAction: Finish[{answer}]"
+        return f"Thought: I need to search {question}.\nAction: Search[{question}]"
+
+    async def completions(self, request: web.Request) -> web.Response:
+        self.count("completions")
+        body = await request.json()
+        prompts = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+        texts = [self.agent_step(prompt) for prompt in prompts]
+        await self.generation_delay(max(len(text) // 4 for text in texts))
+        return web.json_response({
+            "id": f"cmpl-{uuid.uuid4().hex}", "object": "text_completion", "created": int(time.time()), "model": "text-davinci-003",
+            "choices": [{"index": i, "text": text, "finish_reason": "stop", "logprobs": None} for i, text in enumerate(texts)],
+            "usage": self.usage("".join(prompts), "".join(texts))})
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        self.count("embeddings")
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await self.embedding_latency.wait()
+        data = ",".join(f'{{"object": "embedding", "index": {i}, "embedding": {self.embedding_json}}}' for i in range(len(inputs)))
+        tokens = sum(len(str(text)) // 4 for text in inputs)
+        return web.Response(content_type="application/json",
+                            text=f'{{"object": "list", "model": "ada", "data": [{data}], "usage": {{"prompt_tokens": {tokens}, "total_tokens": {tokens}}}}}')
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.count("search")
+        body = await request.json()
+        top = body.get("top") or 50
+        await self.search_latency.wait()
+        documents = []
+        for i in range(top):
+            content = words(self.content_length // 8)
+            document = {"@search.score": 1.0 / (i + 1), "id": f"file-benefits-page-{i}", "content": content,
+                        "category": None, "sourcepage": f"benefits-{i}.pdf", "sourcefile": "benefits.pdf"}
+            if body.get("captions"):
+                document["@search.rerankerScore"] = 3.0 - i / top
+                document["@search.captions"] = [{"text": content[:200], "highlights": None}]
+            documents.append(document)
+        result = {"value": documents}
+        if body.get("count"):
+            result["@odata.count"] = len(documents)
+        if body.get("answers"):
+            result["@search.answers"] = []
+        return web.json_response(result)
+
+    async def container_properties(self, request: web.Request) -> web.Response:
+        self.count("blob")
+        if request.query.get("restype") != "container":
+            raise web.HTTPNotFound()
+        return web.Response(headers={"ETag": '"0x8D0"', "Last-Modified": formatdate(usegmt=True), "x-ms-version": "2021-08-06",
+                                     "x-ms-lease-status": "unlocked", "x-ms-lease-state": "available",
+                                     "x-ms-has-immutability-policy": "false", "x-ms-has-legal-hold": "false"})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.requests)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--openai-latency", default="lognormal:300:0.4", help="Time to the first token of a completion (default: lognormal:300:0.4)")
+    parser.add_argument("--token-latency", default="15", help="Time of each further token of a completion (default: 15)")
+    parser.add_argument("--embedding-latency", default="lognormal:60:0.3", help="Latency of embeddings (default: lognormal:60:0.3)")
+    parser.add_argument("--search-latency", default="lognormal:80:0.4", help="Latency of searches (default: lognormal:80:0.4)")
+    parser.add_argument("--completion-tokens", type=int, default=60, help="Tokens (words) of each answer (default: 60)")
+    parser.add_argument("--content-length", type=int, default=1000, help="Characters of each search result (default: 1000)")
+    parser.add_argument("--embedding-dimensions", type=int, default=1536, help="Dimensions of the embeddings (default: 1536)")
+
+
+def services_from_args(args: argparse.Namespace) -> FakeServices:
+    return FakeServices(Latency(args.openai_latency), Latency(args.token_latency), Latency(args.embedding_latency), Latency(args.search_latency),
+                        args.completion_tokens, args.content_length, args.embedding_dimensions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve fake Azure OpenAI, Cognitive Search and Blob Storage endpoints for load tests.")
+    parser.add_argument("--port", type=int, default=8100, help="Port to listen on (default: 8100)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    # aiohttp logs every request, which costs more than the fake responses themselves
+    web.run_app(services_from_args(args).app(), host="127.0.0.1", port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Load test of the backend against local stand-ins for Azure OpenAI and Cognitive Search (benchmarks/fakeservices.py), so
+throughput can be measured, and a server or approach change compared with the previous one, without calling the real services.
+
+The backend (create_app() through benchmarks/loadtest_app.py) is served by uvicorn or gunicorn with --workers processes, and
+/ask and /chat are called for every approach with a ramp of concurrent clients, each sending its next request as soon as the
+previous one is answered. Every step reports the latency percentiles, the requests per second, and the CPU and memory of each
+worker process (read from /proc, so only on Linux).
+
+Run from the repository root, with the backend requirements installed:
+    python benchmarks/loadtest.py [--workers 2] [--concurrency 1,8,32] [--duration 10] [--scenarios ask:rtr,chat:rrr] [--output results.json]
+The latencies and payload sizes of the fake services are set with the options of fakeservices.py (see --help), and the
+embedding and search caches of the backend are disabled unless --caches is given.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import aiohttp
+import fakeservices
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BACKEND = os.path.join(ROOT, "app", "backend")
+SCENARIOS = ["ask:rtr", "ask:rrr", "ask:rda", "chat:rrr"]
+QUESTIONS = ["What is included in my Northwind Health Plus plan that is not in standard?", "What happens in a performance review?",
+             "Does my plan cover annual eye exams?", "What is the deductible for prescription drugs?", "How do I file a claim?"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def request_body(endpoint: str, approach: str) -> dict:
+    question = random.choice(QUESTIONS)
+    overrides = {"retrieval_mode": "hybrid", "semantic_ranker": True, "semantic_captions": False, "top": 3}
+    if endpoint.startswith("chat"):
+        return {"history": [{"user": question}], "approach": approach, "overrides": overrides}
+    return {"question": question, "approach": approach, "overrides": overrides}
+
+
+def child_pids(pid: int) -> list[int]:
+    children = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # The parent pid is the 2nd field after the command name, which is in parentheses and can contain spaces
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        children.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    return children
+
+
+def worker_pids(server_pid: int) -> list[int]:
+    # uvicorn and gunicorn workers are children of the server process, except the helpers of multiprocessing
+    pids = []
+    for pid in child_pids(server_pid):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if b"multiprocessing.resource_tracker" not in f.read():
+                    pids.append(pid)
+        except OSError:
+            pass
+    return pids
+
+
+def wait_for_workers(process: subprocess.Popen, workers: int, timeout: float = 60) -> list[int]:
+    """The pids of the workers of the server, once it started all of them: its port accepts connections as soon as the first one listens."""
+    deadline = time.monotonic() + timeout
+    pids: list[int] = []
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with code {process.returncode}")
+        pids = worker_pids(process.pid)
+        if len(pids) >= workers:
+            return pids
+        time.sleep(0.2)
+    raise TimeoutError(f"{len(pids)} of {workers} workers started after {timeout}s")
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime, the 14th and 15th fields of the whole line
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class ProcessSampler:
+    """Measures the CPU time of processes over a step, and samples their RSS every interval seconds to keep the peak."""
+
+    def __init__(self, pids: list[int], interval: float = 0.25):
+        self.pids = pids
+        self.interval = interval
+        self.peak_rss = {pid: 0 for pid in pids}
+        self.stopped = threading.Event()
+
+    def sample(self):
+        for pid in self.pids:
+            try:
+                self.peak_rss[pid] = max(self.peak_rss[pid], rss_bytes(pid))
+            except OSError:
+                pass
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.start_cpu = {pid: cpu_seconds(pid) for pid in self.pids}
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        elapsed = time.perf_counter() - self.start
+        self.cpu_percent = {pid: 100 * (cpu_seconds(pid) - self.start_cpu[pid]) / elapsed for pid in self.pids}
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    """Latency percentiles in milliseconds and throughput of the requests of a step."""
+    summary = {"requests": len(latencies), "errors": errors, "rps": len(latencies) / elapsed if elapsed > 0 else 0.0}
+    for percentile in (50, 95, 99):
+        summary[f"p{percentile}_ms"] = float(np.percentile(latencies, percentile)) * 1000 if latencies else None
+    return summary
+
+
+async def run_step(url: str, endpoint: str, approach: str, concurrency: int, duration: float, warmup: float) -> dict:
+    """Send requests from concurrency clients for warmup + duration seconds, and summarize those that started after the warmup."""
+    latencies: list[float] = []
+    errors = 0
+    start = time.perf_counter()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+
+    async def client(session: aiohttp.ClientSession):
+        nonlocal errors
+        while (request_start := time.perf_counter()) < stop_at:
+            try:
+                async with session.post(f"{url}/{endpoint}", json=request_body(endpoint, approach)) as response:
+                    await response.read()
+                    ok = response.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            if request_start >= measure_from:
+                if ok:
+                    latencies.append(time.perf_counter() - request_start)
+                else:
+                    errors += 1
+
+    timeout = aiohttp.ClientTimeout(total=600)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), timeout=timeout) as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    # Requests still running at stop_at are waited for, and counted in the time of the step
+    return summarize(latencies, errors, max(time.perf_counter() - measure_from, 1e-6))
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def start_fake_services(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(ROOT, "benchmarks", "fakeservices.py"), "--port", str(port),
+               "--openai-latency", args.openai_latency, "--token-latency", args.token_latency,
+               "--embedding-latency", args.embedding_latency, "--search-latency", args.search_latency,
+               "--completion-tokens", str(args.completion_tokens), "--content-length", str(args.content_length),
+               "--embedding-dimensions", str(args.embedding_dimensions)]
+    return subprocess.Popen(command)
+
+
+def start_server(args: argparse.Namespace, port: int, fake_services_url: str) -> subprocess.Popen:
+    env = {**os.environ, "LOADTEST_FAKE_SERVICES_URL": fake_services_url}
+    if not args.caches:
+        env.update({"EMBEDDING_CACHE_PATH": "", "SEARCH_CACHE_TTL": "0"})
+    benchmarks = os.path.join(ROOT, "benchmarks")
+    if args.server == "gunicorn":
+        # The deployed configuration (worker class, timeouts), with the number of workers and the address of the load test
+        command = [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "--workers", str(args.workers),
+                   "--bind", f"127.0.0.1:{port}", "--pythonpath", benchmarks, "--log-level", "warning", "loadtest_app:app"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "loadtest_app:app", "--app-dir", benchmarks, "--workers", str(args.workers),
+                   "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning", "--no-access-log"]
+    return subprocess.Popen(command, cwd=BACKEND, env=env, stdout=subprocess.DEVNULL if not args.verbose else None)
+
+
+def format_row(result: dict) -> str:
+    def ms(value):
+        return f"{value:8.0f}" if value is not None else "       -"
+    cpu = "/".join(f"{value:.0f}" for value in result["cpu_percent"])
+    rss = "/".join(f"{value / 2**20:.0f}" for value in result["peak_rss"])
+    return (f"{result['scenario']:<10} {result['concurrency']:>5} {result['requests']:>8} {result['errors']:>6} {result['rps']:>8.1f} "
+            f"{ms(result['p50_ms'])} {ms(result['p95_ms'])} {ms(result['p99_ms'])}   {cpu:<16} {rss}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the backend against fake Azure OpenAI and Cognitive Search services.")
+    parser.add_argument("--server", choices=["uvicorn", "gunicorn"], default="uvicorn", help="ASGI server running the backend (default: uvicorn)")
+    parser.add_argument("--workers", type=int, default=2, help="Number of worker processes of the server (default: 2)")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma separated numbers of concurrent clients of the ramp (default: 1,8,32)")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds measured at each concurrency (default: 10)")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds of requests before measuring at each concurrency (default: 2)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma separated endpoint:approach pairs, endpoints ask, chat, ask_stream or chat_stream (default: {','.join(SCENARIOS)})")
+    parser.add_argument("--caches", action="store_true", help="Keep the embedding and search caches of the backend enabled")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Show the logs of the server")
+    fakeservices.add_arguments(parser)
+    args = parser.parse_args()
+
+    fake_port, server_port = free_port(), free_port()
+    fake_services = start_fake_services(args, fake_port)
+    server = None
+    results = []
+    try:
+        wait_for_port(fake_port, fake_services)
+        server = start_server(args, server_port, f"http://127.0.0.1:{fake_port}")
+        wait_for_port(server_port, server)
+        # uvicorn serves from its own process with a single worker, gunicorn always forks its workers
+        pids = wait_for_workers(server, args.workers) if args.server == "gunicorn" or args.workers > 1 else [server.pid]
+        print(f"{args.server} with {args.workers} workers (pids {', '.join(map(str, pids))}), fake services on port {fake_port}")
+        print(f"{'scenario':<10} {'conc':>5} {'requests':>8} {'errors':>6} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}   {'cpu % per worker':<16} rss MB per worker")
+        for scenario in args.scenarios.split(","):
+            endpoint, approach = scenario.split(":")
+            for concurrency in (int(c) for c in args.concurrency.split(",")):
+                with ProcessSampler(pids) as sampler:
+                    summary = asyncio.run(run_step(f"http://127.0.0.1:{server_port}", endpoint, approach, concurrency, args.duration, args.warmup))
+                result = {"scenario": scenario, "concurrency": concurrency, **summary,
+                          "cpu_percent": [sampler.cpu_percent[pid] for pid in pids], "peak_rss": [sampler.peak_rss[pid] for pid in pids]}
+                results.append(result)
+                print(format_row(result), flush=True)
+    finally:
+        for process in (server, fake_services):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"server": args.server, "workers": args.workers, "caches": args.caches,
+                       "fake_services": {name: getattr(args, name) for name in ("openai_latency", "token_latency", "embedding_latency", "search_latency",
+                                                                                "completion_tokens", "content_length", "embedding_dimensions")},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+ASGI entry point of the backend for benchmarks/loadtest.py: the app of create_app(), with its Azure clients pointed at the fake
+services of benchmarks/fakeservices.py (whose URL is in LOADTEST_FAKE_SERVICES_URL) and a credential that needs no login.
+Served from app/backend like the real app, e.g.:
+    cd app/backend && LOADTEST_FAKE_SERVICES_URL=http://127.0.0.1:8100 python -m uvicorn loadtest_app:app --app-dir ../../benchmarks
+"""
+import os
+import time
+
+import openai
+from azure.core.credentials import AccessToken, AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.storage.blob.aio import BlobServiceClient
+
+import app as backend_app
+
+FAKE_SERVICES_URL = os.environ["LOADTEST_FAKE_SERVICES_URL"]
+
+
+class FakeCredential:
+    async def get_token(self, *scopes, **kwargs):
+        return AccessToken("fake-token", int(time.time()) + 3600)
+
+    async def close(self):
+        pass
+
+
+# The fake services are plain HTTP, where the SDKs refuse to send bearer tokens, so search uses a key and blobs anonymous access
+backend_app.DefaultAzureCredential = lambda **kwargs: FakeCredential()
+backend_app.SearchClient = lambda endpoint, index_name, credential: SearchClient(f"{FAKE_SERVICES_URL}/search", index_name, AzureKeyCredential("fake-key"))
+backend_app.BlobServiceClient = lambda account_url, credential: BlobServiceClient(f"{FAKE_SERVICES_URL}/blob")
+
+app = backend_app.create_app()
+
+
+@app.before_serving
+async def use_fake_openai():
+    # Runs after setup_clients, which sets the Azure OpenAI endpoint
+    openai.api_base = FAKE_SERVICES_URL
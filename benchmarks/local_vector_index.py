@@ -0,0 +1,92 @@
+"""
+Benchmark of the in-process search of the backend (core/vectorindex.py): the latency of a query against an index of --sections
+random embeddings written by prepdocs (prepdocslib/vectorindex.py), in float16 and float32, and the overlap of the results with
+the exact top results, then the latency of BM25 keyword queries and hybrid queries (both, fused by reciprocal rank) over the
+random text of the sections. The inputs come from a fixed seed, so runs are comparable.
+
+Run from the repository root, with the backend and scripts requirements installed:
+    python benchmarks/local_vector_index.py [--sections 5000] [--dimensions 1536] [--top 3] [--queries 200]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from core.vectorindex import LocalSearchClient, LocalVectorIndex  # noqa: E402
+from prepdocslib.vectorindex import VectorIndexWriter  # noqa: E402
+
+
+def write_index(directory: str, embeddings: np.ndarray, contents: list[str], dtype: str):
+    writer = VectorIndexWriter(directory, dtype)
+    writer.upsert({"id": f"section-{i}", "content": content, "category": None, "sourcepage": f"doc-{i}.pdf", "sourcefile": "doc.pdf", "embedding": embedding}
+                  for i, (embedding, content) in enumerate(zip(embeddings, contents)))
+    writer.save()
+
+
+def percentiles(latencies: list[float]) -> str:
+    return f"p50 {np.percentile(latencies, 50) * 1000:.3f}ms, p99 {np.percentile(latencies, 99) * 1000:.3f}ms"
+
+
+async def measure_client(client: LocalSearchClient, queries: list[dict]) -> list[float]:
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        results = await client.search(**query)
+        [doc async for doc in results]
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the latency of the local vector index of the backend.")
+    parser.add_argument("--sections", type=int, default=5000, help="Number of sections in the index (default: 5000)")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Dimensions of the embeddings (default: 1536, text-embedding-ada-002)")
+    parser.add_argument("--top", type=int, default=3, help="Number of results of each query (default: 3)")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries measured (default: 200)")
+    parser.add_argument("--words", type=int, default=150, help="Words of the text of each section (default: 150)")
+    parser.add_argument("--vocabulary", type=int, default=20000, help="Number of distinct words, drawn with a Zipf distribution (default: 20000)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(args.sections, args.dimensions)).astype(np.float32)
+    # Word frequencies of natural text roughly follow Zipf's law, which sets the length of the postings of the query terms
+    word_ids = np.minimum(rng.zipf(1.2, size=(args.sections, args.words)), args.vocabulary) - 1
+    contents = [" ".join(f"w{i}" for i in row) for row in word_ids]
+    text_queries = [" ".join(f"w{i}" for i in np.minimum(rng.zipf(1.2, size=4), args.vocabulary) - 1) for _ in range(args.queries)]
+    queries = rng.normal(size=(args.queries, args.dimensions)).astype(np.float32)
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    exact = [set(np.argsort(-(normalized @ query))[:args.top]) for query in queries]
+
+    print(f"{args.sections} sections of {args.dimensions} dimensions, top {args.top}")
+    for dtype in ("float16", "float32"):
+        with tempfile.TemporaryDirectory() as directory:
+            write_index(directory, embeddings, contents, dtype)
+            index = LocalVectorIndex(directory, refresh_interval=3600)
+            index.search(queries[0].tolist(), args.top)
+            latencies, overlap = [], 0
+            for query, expected in zip(queries, exact):
+                vector = query.tolist()
+                start = time.perf_counter()
+                results = index.search(vector, args.top)
+                latencies.append(time.perf_counter() - start)
+                overlap += len(expected & {int(section["id"].removeprefix("section-")) for section, _ in results})
+            size = os.path.getsize(os.path.join(directory, next(name for name in os.listdir(directory) if name.endswith(".npy"))))
+            print(f"{dtype}: {percentiles(latencies)}, {size / 2**20:.1f}MB, {100 * overlap / (args.top * args.queries):.1f}% of the exact top results")
+            if dtype == "float32":
+                client = LocalSearchClient(index)
+                keyword_latencies = asyncio.run(measure_client(client, [{"search_text": text, "top": args.top} for text in text_queries]))
+                print(f"BM25: {percentiles(keyword_latencies)}")
+                hybrid_queries = [{"search_text": text, "vector": query.tolist(), "top": args.top, "top_k": 50} for text, query in zip(text_queries, queries)]
+                hybrid_latencies = asyncio.run(measure_client(client, hybrid_queries))
+                print(f"Hybrid (vectors, BM25 and fusion): {percentiles(hybrid_latencies)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark of the prepdocs page assembly from Form Recognizer results (build_page_text and table_to_html) against the character
+by character implementation it replaced, which is kept below as the reference: both must produce exactly the same page text.
+
+Run from the repository root, with the scripts requirements installed:
+    python benchmarks/page_assembly.py [--pages 200] [--tables 6] [--rows 30]
+The pages are synthetic, each with --tables tables of --rows rows laid out like the results of the prebuilt-layout model.
+"""
+import argparse
+import html
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from prepdocs import build_page_text  # noqa: E402
+
+
+def reference_table_to_html(table):
+    table_html = "<table>"
+    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html +="</tr>"
+    table_html += "</table>"
+    return table_html
+
+
+def reference_build_page_text(content, page_offset, page_length, tables_on_page):
+    # mark all positions of the table spans in the page
+    table_chars = [-1]*page_length
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            # replace all table spans with "table_id" in table_chars array
+            for i in range(span.length):
+                idx = span.offset - page_offset + i
+                if idx >=0 and idx < page_length:
+                    table_chars[idx] = table_id
+
+    # build page text by replacing charcters in table spans with table html
+    page_text = ""
+    added_tables = set()
+    for idx, table_id in enumerate(table_chars):
+        if table_id == -1:
+            page_text += content[page_offset + idx]
+        elif table_id not in added_tables:
+            page_text += reference_table_to_html(tables_on_page[table_id])
+            added_tables.add(table_id)
+    return page_text
+
+
+def generate_page(rng, page_offset, tables, rows, columns=4):
+    """Returns the content of a page starting at page_offset and its tables, each table taking one or two spans of the content."""
+    parts = []
+    position = page_offset
+    page_tables = []
+    for _ in range(tables):
+        text = " ".join(rng.choice(["Northwind", "Health", "Plus", "covers", "eye", "exams", "&", "<preventive>", "care."]) for _ in range(rng.randint(20, 200))) + "\n"
+        parts.append(text)
+        position += len(text)
+        cells = []
+        table_text = []
+        for row in range(rows):
+            for column in range(columns):
+                cell_content = f"Plan {row}.{column} ${rng.randint(0, 5000)}"
+                cells.append(SimpleNamespace(row_index=row, column_index=column, kind="columnHeader" if row == 0 else "content",
+                                             column_span=rng.choice([1, 1, 1, 2]), row_span=1, content=cell_content))
+                table_text.append(cell_content)
+        rng.shuffle(cells)
+        table_text = "\n".join(table_text) + "\n"
+        split = rng.randint(1, len(table_text) - 1)
+        spans = [SimpleNamespace(offset=position, length=split), SimpleNamespace(offset=position + split, length=len(table_text) - split)]
+        page_tables.append(SimpleNamespace(row_count=rows, cells=cells, spans=spans))
+        parts.append(table_text)
+        position += len(table_text)
+    return "".join(parts), page_tables
+
+
+def generate_document(pages, tables, rows, seed=0):
+    rng = random.Random(seed)
+    content = ""
+    document_pages = []
+    for _ in range(pages):
+        page_content, page_tables = generate_page(rng, len(content), tables, rows)
+        document_pages.append((len(content), len(page_content), page_tables))
+        content += page_content
+    return content, document_pages
+
+
+def measure(build, content, document_pages):
+    start = time.perf_counter()
+    texts = [build(content, page_offset, page_length, page_tables) for page_offset, page_length, page_tables in document_pages]
+    return texts, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the speed and output of the prepdocs page assembly with the reference implementation.")
+    parser.add_argument("--pages", type=int, default=200, help="Number of pages (default: 200)")
+    parser.add_argument("--tables", type=int, default=6, help="Number of tables per page (default: 6)")
+    parser.add_argument("--rows", type=int, default=30, help="Number of rows per table (default: 30)")
+    args = parser.parse_args()
+
+    content, document_pages = generate_document(args.pages, args.tables, args.rows)
+    print(f"Assembling {args.pages} pages, {len(content)} characters, {args.pages * args.tables} tables")
+    texts, elapsed = measure(build_page_text, content, document_pages)
+    print(f"build_page_text: {elapsed:.3f}s")
+    reference_texts, reference_elapsed = measure(reference_build_page_text, content, document_pages)
+    print(f"Reference:       {reference_elapsed:.3f}s ({reference_elapsed / elapsed:.1f}x slower)")
+
+    if texts != reference_texts:
+        mismatch = next(i for i, (a, b) in enumerate(zip(texts, reference_texts)) if a != b)
+        print(f"Page texts differ from page {mismatch}")
+        sys.exit(1)
+    print("Page texts are identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark of the prepdocs section splitter (prepdocslib.textsplitter.TextSplitter) against the character by character
+implementation it replaced, which is kept below as the reference: both must produce exactly the same sections.
+
+Run from the repository root, with the scripts requirements installed:
+    python benchmarks/split_text.py [--pages 1000] [files ...]
+By default the documents in data/ are used, repeated until they have --pages pages to measure a large manual.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+from pypdf import PdfReader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from prepdocslib.textsplitter import TextSplitter  # noqa: E402
+
+MAX_SECTION_LENGTH = 1000
+SENTENCE_SEARCH_LIMIT = 100
+SECTION_OVERLAP = 100
+
+
+def reference_split_text(page_map):
+    SENTENCE_ENDINGS = [".", "!", "?"]
+    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+    def find_page(offset):
+        num_pages = len(page_map)
+        for i in range(num_pages - 1):
+            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+                return i
+        return num_pages - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            # Try to find the end of the sentence
+            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
+                if all_text[end] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word # Fall back to at least keeping a whole word
+        if end < length:
+            end += 1
+
+        # Try to find the start of the sentence or at least a whole word boundary
+        last_word = -1
+        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
+            if all_text[start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+
+def load_page_map(filenames, pages):
+    texts = [page.extract_text() for filename in filenames for page in PdfReader(filename).pages]
+    page_map = []
+    offset = 0
+    for page_num in range(pages):
+        page_text = texts[page_num % len(texts)]
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+
+def measure(split, page_map):
+    start = time.perf_counter()
+    sections = list(split(page_map))
+    return sections, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the speed and output of the prepdocs section splitter with the reference implementation.")
+    parser.add_argument("files", nargs="*", help="PDF files to split (default: data/*.pdf)")
+    parser.add_argument("--pages", type=int, default=1000, help="Number of pages to split, the pages of the files are repeated as needed (default: 1000)")
+    args = parser.parse_args()
+
+    filenames = args.files or sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "data", "*.pdf")))
+    page_map = load_page_map(filenames, args.pages)
+    print(f"Splitting {len(page_map)} pages, {sum(len(text) for _, _, text in page_map)} characters")
+
+    splitter = TextSplitter(MAX_SECTION_LENGTH, SENTENCE_SEARCH_LIMIT, SECTION_OVERLAP)
+    sections, elapsed = measure(splitter.split_pages, page_map)
+    print(f"TextSplitter: {len(sections)} sections in {elapsed:.3f}s")
+    reference_sections, reference_elapsed = measure(reference_split_text, page_map)
+    print(f"Reference:    {len(reference_sections)} sections in {reference_elapsed:.3f}s ({reference_elapsed / elapsed:.1f}x slower)")
+
+    if sections != reference_sections:
+        mismatch = next(i for i, (a, b) in enumerate(zip(sections, reference_sections + [None] * len(sections))) if a != b)
+        print(f"Sections differ from section {mismatch}")
+        sys.exit(1)
+    print("Sections are identical")
+
+
+if __name__ == "__main__":
+    main()
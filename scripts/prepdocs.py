@@ -2,10 +2,10 @@ import argparse
 import base64
 import glob
 import html
-import io
 import os
 import re
-import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 import openai
 from azure.ai.formrecognizer import DocumentAnalysisClient
@@ -28,73 +28,129 @@ from azure.search.documents.indexes.models import (
     VectorSearchAlgorithmConfiguration,
 )
 from azure.storage.blob import BlobServiceClient
-from pypdf import PdfReader, PdfWriter
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from pypdf import PdfReader
+
+from prepdocslib.analysiscache import AnalysisCache
+from prepdocslib.blobmanager import BlobManager, blob_name_from_file_page
+from prepdocslib.embeddings import BatchEmbedder
+from prepdocslib.indexer import SearchIndexer
+from prepdocslib.manifest import Manifest
+from prepdocslib.pipeline import Pipeline, PipelineStage
+from prepdocslib.textsplitter import TextSplitter
+from prepdocslib.vectorindex import VectorIndexWriter
 
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
-
-def blob_name_from_file_page(filename, page = 0):
-    if os.path.splitext(filename)[1].lower() == ".pdf":
-        return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + ".pdf"
-    else:
-        return os.path.basename(filename)
+FORM_RECOGNIZER_MODEL = "prebuilt-layout"
 
 def upload_blobs(filename):
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
-    if not blob_container.exists():
-        blob_container.create_container()
-
-    # if file is PDF split into pages and upload each page as a separate blob
-    if os.path.splitext(filename)[1].lower() == ".pdf":
-        reader = PdfReader(filename)
-        pages = reader.pages
-        for i in range(len(pages)):
-            blob_name = blob_name_from_file_page(filename, i)
-            if args.verbose: print(f"\tUploading blob for page {i} -> {blob_name}")
-            f = io.BytesIO()
-            writer = PdfWriter()
-            writer.add_page(pages[i])
-            writer.write(f)
-            f.seek(0)
-            blob_container.upload_blob(blob_name, f, overwrite=True)
-    else:
-        blob_name = blob_name_from_file_page(filename)
-        with open(filename,"rb") as data:
-            blob_container.upload_blob(blob_name, data, overwrite=True)
+    uploaded = blob_manager.upload_file(filename)
+    if args.verbose: print(f"Uploaded {uploaded} blobs for '{filename}'")
 
 def remove_blobs(filename):
     if args.verbose: print(f"Removing blobs for '{filename or '<all>'}'")
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
-    if blob_container.exists():
-        if filename is None:
-            blobs = blob_container.list_blob_names()
-        else:
-            prefix = os.path.splitext(os.path.basename(filename))[0]
-            blobs = filter(lambda b: re.match(f"{prefix}-\d+\.pdf", b), blob_container.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0]))
-        for b in blobs:
-            if args.verbose: print(f"\tRemoving blob {b}")
-            blob_container.delete_blob(b)
+    removed = blob_manager.remove_file(filename)
+    if args.verbose: print(f"Removed {removed} blobs for '{filename or '<all>'}'")
+
+def index_generation_metadata_key(index):
+    # Must match INDEX_GENERATION_METADATA_KEY in app/backend/app.py, metadata names can't contain dashes
+    return "indexgeneration_" + index.replace("-", "_")
+
+def bump_index_generation():
+    # The backend caches search results per index generation, so changing it invalidates every cached result for this index
+    if args.index is None:
+        # Only a local index was written, the app reloads it when it changes
+        if args.verbose: print("Search index not provided, not updating the index generation")
+        return
+    if args.storageaccount is None or args.container is None:
+        print(f"Storage account or container not provided, cached search results for index '{args.index}' will only be refreshed when they expire")
+        return
+    blob_manager.ensure_container()
+    blob_container = blob_manager.container_client
+    metadata = blob_container.get_container_properties().metadata
+    metadata[index_generation_metadata_key(args.index)] = uuid.uuid4().hex
+    blob_container.set_container_metadata(metadata)
+    if args.verbose: print(f"Updated generation of search index '{args.index}'")
 
 def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    # Bucket the cells by row once, rather than scanning all the cells for every row
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        if 0 <= cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
+    table_html = ["<table>"]
     for row_cells in rows:
-        table_html += "<tr>"
-        for cell in row_cells:
+        table_html.append("<tr>")
+        for cell in sorted(row_cells, key=lambda cell: cell.column_index):
             tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
             cell_spans = ""
             if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
             if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
-
-def get_document_text(filename):
+            table_html.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        table_html.append("</tr>")
+    table_html.append("</table>")
+    return "".join(table_html)
+
+def build_page_text(content, page_offset, page_length, tables_on_page):
+    """
+    Build the text of a page from the document content, with each table replaced by its html at the position of its first character.
+    Works on the table spans rather than on characters: the page is cut at every span boundary, and each piece is either a slice of
+    the content or belongs to a table (the last one listed if tables overlap).
+    """
+    # Span boundaries within the page, as (position, table_id, +1 at the start of the span or -1 at its end)
+    events = []
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            start = max(span.offset - page_offset, 0)
+            end = min(span.offset - page_offset + span.length, page_length)
+            if start < end:
+                events.append((start, table_id, 1))
+                events.append((end, table_id, -1))
+    boundaries = sorted({0, page_length, *(position for position, _, _ in events)})
+    events.sort()
+
+    parts = []
+    added_tables = set()
+    active_spans = {}
+    next_event = 0
+    for piece_start, piece_end in zip(boundaries, boundaries[1:]):
+        while next_event < len(events) and events[next_event][0] == piece_start:
+            _, table_id, change = events[next_event]
+            active_spans[table_id] = active_spans.get(table_id, 0) + change
+            if active_spans[table_id] == 0:
+                del active_spans[table_id]
+            next_event += 1
+        if not active_spans:
+            parts.append(content[page_offset + piece_start:page_offset + piece_end])
+        else:
+            table_id = max(active_spans)
+            if table_id not in added_tables:
+                parts.append(table_to_html(tables_on_page[table_id]))
+                added_tables.add(table_id)
+    return "".join(parts)
+
+def analyze_document(filename, file_hash=None):
+    # The layout analysis is the slowest and most expensive step, so its results can be cached by file content,
+    # per Form Recognizer service so that runs against different services never share results
+    analysis_cache = AnalysisCache(os.path.join(args.analysiscache, args.formrecognizerservice)) if args.analysiscache else None
+    if analysis_cache is not None:
+        file_hash = file_hash or Manifest.file_hash(filename)
+        form_recognizer_results = analysis_cache.get(file_hash, FORM_RECOGNIZER_MODEL)
+        if form_recognizer_results is not None:
+            if args.verbose: print(f"Using cached Azure Form Recognizer results for '{filename}'")
+            return form_recognizer_results
+
+    if args.verbose: print(f"Extracting text from '{filename}' using Azure Form Recognizer")
+    form_recognizer_client = DocumentAnalysisClient(endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/", credential=formrecognizer_creds, headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"})
+    with open(filename, "rb") as f:
+        poller = form_recognizer_client.begin_analyze_document(FORM_RECOGNIZER_MODEL, document = f)
+    form_recognizer_results = poller.result()
+    if analysis_cache is not None:
+        analysis_cache.set(file_hash, FORM_RECOGNIZER_MODEL, form_recognizer_results)
+    return form_recognizer_results
+
+def get_document_text(filename, file_hash=None):
     offset = 0
     page_map = []
     if args.localpdfparser:
@@ -105,37 +161,15 @@ def get_document_text(filename):
             page_map.append((page_num, offset, page_text))
             offset += len(page_text)
     else:
-        if args.verbose: print(f"Extracting text from '{filename}' using Azure Form Recognizer")
-        form_recognizer_client = DocumentAnalysisClient(endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/", credential=formrecognizer_creds, headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"})
-        with open(filename, "rb") as f:
-            poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f)
-        form_recognizer_results = poller.result()
+        form_recognizer_results = analyze_document(filename, file_hash)
 
-        for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing charcters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif table_id not in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
+        tables_by_page = {}
+        for table in form_recognizer_results.tables:
+            tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table)
 
+        for page_num, page in enumerate(form_recognizer_results.pages):
+            tables_on_page = tables_by_page.get(page_num + 1, [])
+            page_text = build_page_text(form_recognizer_results.content, page.spans[0].offset, page.spans[0].length, tables_on_page)
             page_text += " "
             page_map.append((page_num, offset, page_text))
             offset += len(page_text)
@@ -143,90 +177,75 @@ def get_document_text(filename):
     return page_map
 
 def split_text(page_map):
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
-    if args.verbose: print(f"Splitting '{filename}' into sections")
-
-    def find_page(offset):
-        num_pages = len(page_map)
-        for i in range(num_pages - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return num_pages - 1
-
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
-    start = 0
-    end = length
-    while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
-
-        if end > length:
-            end = length
-        else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
-        if end < length:
-            end += 1
-
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
-        if start > 0:
-            start += 1
-
-        section_text = all_text[start:end]
-        yield (section_text, find_page(start))
-
-        last_table_start = section_text.rfind("<table")
-        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
-            # If the section ends with an unclosed table, we need to start the next section with the table.
-            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-            # If last table starts inside SECTION_OVERLAP, keep overlapping
-            if args.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
-
-    if start + SECTION_OVERLAP < end:
-        yield (all_text[start:end], find_page(start))
+    splitter = TextSplitter(MAX_SECTION_LENGTH, SENTENCE_SEARCH_LIMIT, SECTION_OVERLAP, verbose=args.verbose)
+    return splitter.split_pages(page_map)
 
 def filename_to_id(filename):
     filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)
     filename_hash = base64.b16encode(filename.encode('utf-8')).decode('ascii')
     return f"file-{filename_ascii}-{filename_hash}"
 
-def create_sections(filename, page_map, use_vectors):
+def create_sections(filename, page_map):
+    if args.verbose: print(f"Splitting '{filename}' into sections")
     file_id = filename_to_id(filename)
-    for i, (content, pagenum) in enumerate(split_text(page_map)):
-        section = {
+    return [{
             "id": f"{file_id}-page-{i}",
             "content": content,
             "category": args.category,
             "sourcepage": blob_name_from_file_page(filename, pagenum),
             "sourcefile": filename
-        }
-        if use_vectors:
-            section["embedding"] = compute_embedding(content)
-        yield section
-
-def before_retry_sleep(retry_state):
-    if args.verbose: print("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
-
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(15), before_sleep=before_retry_sleep)
-def compute_embedding(text):
-    return openai.Embedding.create(engine=args.openaideployment, input=text)["data"][0]["embedding"]
+        } for i, (content, pagenum) in enumerate(split_text(page_map))]
+
+def embed_sections(filename, sections):
+    # Embed all the sections of the file together, so they're sent in as few requests as possible
+    if args.verbose: print(f"Computing embeddings for {len(sections)} sections of '{filename}'")
+    embeddings = embedder.embed([section["content"] for section in sections])
+    for section, embedding in zip(sections, embeddings):
+        section["embedding"] = embedding
+
+def init_extract_worker(parent_args):
+    # Spawned worker processes don't run the __main__ block, so they get the arguments and credentials here
+    global args, formrecognizer_creds
+    args = parent_args
+    if not args.localpdfparser:
+        if args.formrecognizerkey is not None:
+            formrecognizer_creds = AzureKeyCredential(args.formrecognizerkey)
+        else:
+            formrecognizer_creds = AzureDeveloperCliCredential() if args.tenantid is None else AzureDeveloperCliCredential(tenant_id=args.tenantid, process_timeout=60)
+
+def extract_files(filenames, file_hashes=None):
+    """
+    Extract the text of the files, in args.workers processes if there are more than one.
+    file_hashes has the hashes of the files already computed (by the manifest), so they're not read again to compute them.
+    Yields (filename, page map, error) for every file as soon as its text is extracted, error is None if extraction succeeded.
+    """
+    file_hashes = file_hashes or {}
+    if args.workers <= 1:
+        for filename in filenames:
+            try:
+                yield filename, get_document_text(filename, file_hashes.get(filename)), None
+            except Exception as e:
+                yield filename, None, e
+        return
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_extract_worker, initargs=(args,)) as executor:
+        # Only a couple of files per worker are submitted ahead, so extracted files don't pile up while the next stages catch up
+        pending_filenames = iter(filenames)
+        futures = {}
+        while True:
+            for filename in pending_filenames:
+                futures[executor.submit(get_document_text, filename, file_hashes.get(filename))] = filename
+                if len(futures) >= 2 * args.workers:
+                    break
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename = futures.pop(future)
+                try:
+                    yield filename, future.result(), None
+                except Exception as e:
+                    yield filename, None, e
 
 def create_search_index():
     if args.verbose: print(f"Ensuring search index {args.index} exists")
@@ -267,40 +286,88 @@ def create_search_index():
 
 def index_sections(filename, sections):
     if args.verbose: print(f"Indexing sections from '{filename}' into search index '{args.index}'")
-    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
-                                    index_name=args.index,
-                                    credential=search_creds)
-    i = 0
-    batch = []
-    for s in sections:
-        batch.append(s)
-        i += 1
-        if i % 1000 == 0:
-            results = search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-            batch = []
-
-    if len(batch) > 0:
-        results = search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
-        if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+    search_indexer.upload_documents(sections)
 
 def remove_from_index(filename):
+    if local_index is not None:
+        removed = local_index.remove_file(None if filename is None else os.path.basename(filename))
+        if args.verbose: print(f"\tRemoved {removed} sections from local vector index")
+    if args.searchservice is None:
+        return
     if args.verbose: print(f"Removing sections from '{filename or '<all>'}' from search index '{args.index}'")
-    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
-                                    index_name=args.index,
-                                    credential=search_creds)
-    while True:
-        filter = None if filename is None else f"sourcefile eq '{os.path.basename(filename)}'"
-        r = search_client.search("", filter=filter, top=1000, include_total_count=True)
-        if r.get_count() == 0:
-            break
-        r = search_client.delete_documents(documents=[{ "id": d["id"] } for d in r])
-        if args.verbose: print(f"\tRemoved {len(r)} sections from index")
-        # It can take a few seconds for search results to reflect changes, so wait a bit
-        time.sleep(2)
-
+    filter = None if filename is None else f"sourcefile eq '{os.path.basename(filename)}'"
+    # The manifest knows the ids of the sections, so they can be deleted before searching for any that are left
+    known_ids = []
+    if manifest is not None:
+        files = manifest.files.values() if filename is None else [manifest.files.get(os.path.basename(filename), {})]
+        known_ids = [id for entry in files for id in entry.get("sections", {})]
+    removed = search_indexer.remove_documents(filter, known_ids)
+    if args.verbose: print(f"\tRemoved {removed} sections from index")
+
+def remove_sections(filename, ids):
+    if args.verbose: print(f"Removing {len(ids)} sections of '{filename}' that are no longer in the file from search index '{args.index}'")
+    search_indexer.delete_documents(ids)
+
+def plan_file(filename, sections, file_hash=None):
+    """Start the ingestion job of a split file, with only the sections that changed since the last run if there's a manifest."""
+    job = {"filename": filename, "name": os.path.basename(filename), "sections": sections, "changed": sections, "removed": []}
+    if manifest is not None:
+        job["file_hash"] = file_hash or manifest.file_hash(filename)
+        job["changed"], job["removed"] = manifest.diff(job["name"], sections)
+        if args.verbose: print(f"{len(job['changed'])} of {len(sections)} sections of '{filename}' changed, {len(job['removed'])} removed")
+    return job
+
+def split_file(job):
+    sections = create_sections(job["name"], job.pop("pages"))
+    return plan_file(job["filename"], sections, job["file_hash"])
+
+def upload_file_blobs(job):
+    if not args.skipblobs:
+        upload_blobs(job["filename"])
+    return job
+
+def embed_file(job):
+    if use_vectors and job["changed"]:
+        embed_sections(job["name"], job["changed"])
+    return job
+
+def index_file(job):
+    if local_index is not None:
+        # Without a manifest, sections that are no longer in the file are only known by their absence
+        if manifest is None:
+            local_index.remove_file(job["name"])
+        local_index.upsert(job["changed"])
+        local_index.delete(job["removed"])
+    if args.searchservice is not None:
+        if job["changed"]:
+            index_sections(job["name"], job["changed"])
+        if job["removed"]:
+            remove_sections(job["name"], job["removed"])
+    if manifest is not None:
+        manifest.update(job["name"], job["file_hash"], job["sections"])
+    return job
+
+def ingest_files(filenames, file_hashes=None):
+    """
+    Extract, split, upload, embed and index the files in a pipeline where every stage works on a different file at the same time.
+    Yields (job, error) for every file as soon as it's indexed, or failed, error is None if it succeeded.
+    file_hashes has the hashes of the files already computed, if any.
+    """
+    file_hashes = file_hashes or {}
+    def extracted_jobs():
+        for filename, pages, error in extract_files(filenames, file_hashes):
+            job = {"filename": filename, "name": os.path.basename(filename), "file_hash": file_hashes.get(filename), "pages": pages, "sections": None}
+            yield job, error
+
+    pipeline = Pipeline("extract", [PipelineStage("split", split_file),
+                                    PipelineStage("blobs", upload_file_blobs),
+                                    PipelineStage("embed", embed_file),
+                                    PipelineStage("index", index_file)],
+                        size=lambda job: len(job["sections"]),
+                        source_size=lambda job: len(job["pages"]), source_unit="pages")
+    yield from pipeline.run(extracted_jobs())
+    for line in pipeline.report("sections"):
+        print(f"\t{line}")
 
 if __name__ == "__main__":
 
@@ -314,19 +381,29 @@ if __name__ == "__main__":
     parser.add_argument("--storageaccount", help="Azure Blob Storage account name")
     parser.add_argument("--container", help="Azure Blob Storage container name")
     parser.add_argument("--storagekey", required=False, help="Optional. Use this Azure Blob Storage account key instead of the current user identity to login (use az login to set current user for Azure)")
+    parser.add_argument("--storageconcurrency", type=int, default=8, help="Optional. Maximum number of blobs uploaded or removed at once (default: 8)")
     parser.add_argument("--tenantid", required=False, help="Optional. Use this to define the Azure directory where to authenticate)")
     parser.add_argument("--searchservice", help="Name of the Azure Cognitive Search service where content should be indexed (must exist already)")
     parser.add_argument("--index", help="Name of the Azure Cognitive Search index where content should be indexed (will be created if it doesn't exist)")
     parser.add_argument("--searchkey", required=False, help="Optional. Use this Azure Cognitive Search account key instead of the current user identity to login (use az login to set current user for Azure)")
+    parser.add_argument("--searchconcurrency", type=int, default=4, help="Optional. Maximum number of indexing requests in flight (default: 4)")
     parser.add_argument("--openaiservice", help="Name of the Azure OpenAI service used to compute embeddings")
     parser.add_argument("--openaideployment", help="Name of the Azure OpenAI model deployment for an embedding model ('text-embedding-ada-002' recommended)")
     parser.add_argument("--novectors", action="store_true", help="Don't compute embeddings for the sections (e.g. don't call the OpenAI embeddings API during indexing)")
+    parser.add_argument("--openaitpm", type=int, default=30000, help="Optional. Tokens per minute quota of the embedding deployment, embedding requests are scheduled to stay under it (default: 30000, the capacity deployed by infra/main.bicep)")
+    parser.add_argument("--openairpm", type=int, required=False, help="Optional. Requests per minute quota of the embedding deployment (default: 6 per 1000 tokens per minute, the Azure OpenAI ratio)")
+    parser.add_argument("--openaiconcurrency", type=int, default=4, help="Optional. Maximum number of embedding requests in flight (default: 4)")
     parser.add_argument("--openaikey", required=False, help="Optional. Use this Azure OpenAI account key instead of the current user identity to login (use az login to set current user for Azure)")
     parser.add_argument("--remove", action="store_true", help="Remove references to this document from blob storage and the search index")
     parser.add_argument("--removeall", action="store_true", help="Remove all blobs from blob storage and documents from the search index")
     parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
     parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
     parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+    parser.add_argument("--analysiscache", required=False, help="Optional. Directory where Azure Form Recognizer results are cached by file content (and service), so that processing the same files again doesn't analyze them again (default: no cache)")
+    parser.add_argument("--manifest", required=False, help="Optional. Path of a manifest file recording the files and sections indexed in this index, so that later runs skip unchanged files and only re-embed and upload the sections that changed (created if it doesn't exist)")
+    parser.add_argument("--localindex", required=False, help="Optional. Directory where the sections are also written as a local vector and BM25 keyword index, which the app searches in-process when LOCAL_INDEX_PATH is set to it (updated if it exists). Without --searchservice, only the local index is written")
+    parser.add_argument("--localindexdtype", choices=["float32", "float16"], default="float32", help="Optional. Precision of the embeddings in the local vector index (default: float32). float16 halves its size with the same rankings in practice, but searches are several times slower since NumPy converts the rows to float32")
+    parser.add_argument("--workers", type=int, default=1, help="Optional. Number of processes extracting the text of the files (default: 1, no extra processes)")
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     args = parser.parse_args()
 
@@ -336,8 +413,12 @@ if __name__ == "__main__":
     search_creds = default_creds if args.searchkey is None else AzureKeyCredential(args.searchkey)
     use_vectors = not args.novectors
 
-    if not args.skipblobs:
-        storage_creds = default_creds if args.storagekey is None else args.storagekey
+    storage_creds = default_creds if args.storagekey is None else args.storagekey
+    # One client for all the blob operations of the run, so its connections are reused
+    blob_manager = None
+    if args.storageaccount is not None and args.container is not None:
+        blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
+        blob_manager = BlobManager(blob_service.get_container_client(args.container), max_concurrency=args.storageconcurrency, verbose=args.verbose)
     if not args.localpdfparser:
         # check if Azure Form Recognizer credentials are provided
         if args.formrecognizerservice is None:
@@ -354,27 +435,83 @@ if __name__ == "__main__":
             openai.api_key = args.openaikey
 
         openai.api_base = f"https://{args.openaiservice}.openai.azure.com"
-        openai.api_version = "2022-12-01"
+        # Earlier API versions only accept one input per embeddings request
+        openai.api_version = "2023-05-15"
+
+        embedder = BatchEmbedder(args.openaideployment,
+                                 tokens_per_minute=args.openaitpm,
+                                 requests_per_minute=args.openairpm or args.openaitpm * 6 // 1000,
+                                 max_in_flight=args.openaiconcurrency,
+                                 verbose=args.verbose)
+
+    if args.searchservice is None and not args.localindex:
+        print("Error: Azure Cognitive Search service is not provided. Please provide searchservice, or localindex to only write a local vector index.")
+        exit(1)
+    # One client for all the indexing requests of the run, so its connections are reused
+    search_indexer = None
+    if args.searchservice is not None:
+        search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/", index_name=args.index, credential=search_creds)
+        search_indexer = SearchIndexer(search_client, max_concurrency=args.searchconcurrency, verbose=args.verbose)
+    local_index = None
+    if args.localindex:
+        if not use_vectors:
+            print("Error: The local vector index needs the embeddings of the sections, it can't be written with --novectors.")
+            exit(1)
+        local_index = VectorIndexWriter(args.localindex, args.localindexdtype, verbose=args.verbose)
+
+    # The manifest records what was indexed, so the next runs only process what changed
+    manifest = None
+    if args.manifest:
+        options = {"category": args.category, "localpdfparser": args.localpdfparser, "vectors": use_vectors, "openaideployment": args.openaideployment if use_vectors else None}
+        # Files recorded before the local index was written (or by a run writing another one) are processed again to add them to it
+        if local_index is not None:
+            options["localindex"] = os.path.abspath(args.localindex)
+        manifest = Manifest(args.manifest, args.index, options)
 
     if args.removeall:
         remove_blobs(None)
         remove_from_index(None)
+        if manifest is not None:
+            manifest.remove()
+        if local_index is not None:
+            local_index.save()
+        bump_index_generation()
     else:
-        if not args.remove:
+        if not args.remove and args.searchservice is not None:
             create_search_index()
 
         print("Processing files...")
-        for filename in glob.glob(args.files):
-            if args.verbose: print(f"Processing '{filename}'")
-            if args.remove:
+        filenames = glob.glob(args.files)
+        if args.remove:
+            for filename in filenames:
+                if args.verbose: print(f"Processing '{filename}'")
                 remove_blobs(filename)
                 remove_from_index(filename)
-            elif args.removeall:
-                remove_blobs(None)
-                remove_from_index(None)
-            else:
-                if not args.skipblobs:
-                    upload_blobs(filename)
-                page_map = get_document_text(filename)
-                sections = create_sections(os.path.basename(filename), page_map, use_vectors)
-                index_sections(os.path.basename(filename), sections)
+                if manifest is not None:
+                    manifest.remove(os.path.basename(filename))
+        else:
+            # Files are extracted in parallel when there are several workers, while the files extracted before are split, uploaded, embedded and indexed
+            failed = []
+            # Each file is read once to hash it, the hash is passed on to the manifest and the analysis cache
+            file_hashes = {}
+            if manifest is not None:
+                file_hashes = {filename: manifest.file_hash(filename) for filename in filenames}
+                unchanged = [filename for filename in filenames if manifest.is_unchanged(os.path.basename(filename), file_hashes[filename])]
+                for filename in unchanged:
+                    if args.verbose: print(f"Skipping '{filename}', unchanged since it was last indexed")
+                print(f"Skipping {len(unchanged)} of {len(filenames)} files, unchanged since they were last indexed")
+                filenames = [filename for filename in filenames if filename not in unchanged]
+            for i, (job, error) in enumerate(ingest_files(filenames, file_hashes)):
+                if error is None:
+                    print(f"[{i + 1}/{len(filenames)}] Processed '{job['filename']}' ({len(job['sections'])} sections)")
+                else:
+                    print(f"[{i + 1}/{len(filenames)}] Failed to process '{job['filename']}': {error!r}")
+                    failed.append(job["filename"])
+
+        if filenames:
+            if local_index is not None:
+                local_index.save()
+            bump_index_generation()
+        if not args.remove and failed:
+            print(f"{len(failed)} of {len(filenames)} files failed: {', '.join(failed)}")
+            exit(1)
@@ -0,0 +1,41 @@
+import json
+import os
+import tempfile
+from typing import Optional
+
+from azure.ai.formrecognizer import AnalyzeResult
+
+
+class AnalysisCache:
+    """
+    Directory of Form Recognizer analysis results, keyed by the hash of the content of the analyzed file and the model that
+    analyzed it, so that running prepdocs again on the same files (e.g. after a failure later in the pipeline, or to try other
+    section lengths) reuses the results instead of paying for the analysis of every page again.
+    The cache is best effort: a result that can't be read or written is analyzed again.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, file_hash: str, model_id: str) -> str:
+        return os.path.join(self.directory, f"{model_id}-{file_hash}.json")
+
+    def get(self, file_hash: str, model_id: str) -> Optional[AnalyzeResult]:
+        try:
+            with open(self.path(file_hash, model_id), encoding="utf-8") as f:
+                return AnalyzeResult.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable cached analysis result: {e}")
+            return None
+
+    def set(self, file_hash: str, model_id: str, result: AnalyzeResult):
+        # Write a new file and rename it, so a concurrent worker or an interrupted run never reads a truncated result
+        try:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self.directory, suffix=".tmp", delete=False) as f:
+                json.dump(result.to_dict(), f)
+            os.replace(f.name, self.path(file_hash, model_id))
+        except OSError as e:
+            print(f"Failed to cache analysis result: {e}")
@@ -0,0 +1,111 @@
+import hashlib
+import io
+import mimetypes
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator, Optional
+
+from azure.storage.blob import ContainerClient, ContentSettings
+from pypdf import PdfReader, PdfWriter
+
+
+def blob_name_from_file_page(filename: str, page: int = 0) -> str:
+    if os.path.splitext(filename)[1].lower() == ".pdf":
+        return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + ".pdf"
+    else:
+        return os.path.basename(filename)
+
+
+class BlobManager:
+    """
+    Uploads the files (each page of a PDF as its own blob, so citations can link to the page) to a container and removes them,
+    through one container client whose connections are reused for every file.
+    Up to max_concurrency blobs are uploaded or deleted at once, and blobs whose stored MD5 matches the content are not uploaded again.
+    """
+
+    def __init__(self, container_client: ContainerClient, max_concurrency: int = 8, verbose: bool = False):
+        self.container_client = container_client
+        self.max_concurrency = max_concurrency
+        self.verbose = verbose
+        self.container_exists: Optional[bool] = None
+
+    def ensure_container(self):
+        if not self.container_exists:
+            if not self.container_client.exists():
+                self.container_client.create_container()
+            self.container_exists = True
+
+    def file_blobs(self, filename: str) -> Iterator[tuple[str, bytes]]:
+        """Yields (blob name, content) for the blobs of a file, one per page for PDFs."""
+        if os.path.splitext(filename)[1].lower() == ".pdf":
+            reader = PdfReader(filename)
+            for i, page in enumerate(reader.pages):
+                f = io.BytesIO()
+                writer = PdfWriter()
+                writer.add_page(page)
+                writer.write(f)
+                yield blob_name_from_file_page(filename, i), f.getvalue()
+        else:
+            with open(filename, "rb") as f:
+                yield blob_name_from_file_page(filename), f.read()
+
+    def stored_md5s(self, filename: str) -> dict[str, bytes]:
+        # One listing of the blobs of the file returns the MD5s of all of them, instead of a request per blob
+        prefix = os.path.splitext(os.path.basename(filename))[0]
+        return {blob.name: bytes(blob.content_settings.content_md5)
+                for blob in self.container_client.list_blobs(name_starts_with=prefix)
+                if blob.content_settings.content_md5}
+
+    def upload_blob(self, blob_name: str, data: bytes, md5: bytes):
+        if self.verbose: print(f"\tUploading blob {blob_name}")
+        content_settings = ContentSettings(content_type=mimetypes.guess_type(blob_name)[0], content_md5=bytearray(md5))
+        self.container_client.upload_blob(blob_name, data, overwrite=True, content_settings=content_settings)
+
+    def upload_file(self, filename: str) -> int:
+        """Uploads the blobs of a file that changed, returns how many were uploaded."""
+        self.ensure_container()
+        stored_md5s = self.stored_md5s(filename)
+
+        def uploads():
+            for blob_name, data in self.file_blobs(filename):
+                md5 = hashlib.md5(data).digest()
+                if stored_md5s.get(blob_name) == md5:
+                    if self.verbose: print(f"\tSkipping unchanged blob {blob_name}")
+                    continue
+                yield self.upload_blob, blob_name, data, md5
+
+        return self.run_concurrently(uploads())
+
+    def remove_file(self, filename: Optional[str]) -> int:
+        """Removes the blobs of a file, or all the blobs of the container if filename is None, returns how many were removed."""
+        if not self.container_client.exists():
+            return 0
+        if filename is None:
+            blob_names: Iterable[str] = self.container_client.list_blob_names()
+        else:
+            prefix = os.path.splitext(os.path.basename(filename))[0]
+            blob_names = filter(lambda b: re.match(rf"{re.escape(prefix)}-\d+\.pdf", b), self.container_client.list_blob_names(name_starts_with=prefix))
+
+        def deletions():
+            for blob_name in blob_names:
+                if self.verbose: print(f"\tRemoving blob {blob_name}")
+                yield self.container_client.delete_blob, blob_name
+
+        return self.run_concurrently(deletions())
+
+    def run_concurrently(self, calls: Iterable[tuple]) -> int:
+        # Submit calls as slots free up rather than all at once, so only about max_concurrency pages are held in memory
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            pending = set()
+            for function, *call_args in calls:
+                if len(pending) >= self.max_concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(function, *call_args))
+                count += 1
+            for future in pending:
+                future.result()
+        return count
@@ -0,0 +1,100 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence
+
+import openai
+import tiktoken
+from tenacity import retry, stop_after_attempt, wait_random_exponential
+
+
+class TokenBucket:
+    """
+    Rate limiter refilled continuously with per_minute units a minute, holding at most capacity units.
+    acquire() blocks until the units are available, so callers stay under a quota instead of running into it.
+    The default capacity is ten seconds' worth of units, since Azure OpenAI also enforces its quotas over 10 second windows.
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or per_minute / 6
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount: float = 1):
+        # A single request larger than the bucket waits for a full bucket rather than forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait = (amount - self.available) / self.rate
+            time.sleep(wait)
+
+
+class BatchEmbedder:
+    """
+    Computes the embeddings of many texts with as few round trips as possible: the texts are packed into requests of at most
+    max_batch_size inputs and max_batch_tokens tokens, up to max_in_flight requests are sent concurrently, and every request
+    first waits for its share of the deployment's tokens-per-minute and requests-per-minute quotas in token buckets.
+    Requests that are rate limited anyway (e.g. because another client uses the same deployment) are retried with backoff.
+    """
+
+    def __init__(self, deployment: str, tokens_per_minute: Optional[int] = None, requests_per_minute: Optional[int] = None,
+                 max_batch_size: int = 16, max_batch_tokens: int = 8191, max_in_flight: int = 4, verbose: bool = False):
+        self.deployment = deployment
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_in_flight = max_in_flight
+        self.verbose = verbose
+        self.encoding = tiktoken.encoding_for_model("text-embedding-ada-002")
+
+    def create_batches(self, texts: Sequence[str]) -> list[tuple[list[int], int]]:
+        """Group the indexes of texts into batches, returned with their token count, keeping the order of the texts."""
+        batches = []
+        indexes, tokens = [], 0
+        for i, text_tokens in enumerate(len(t) for t in self.encoding.encode_batch(list(texts))):
+            if indexes and (len(indexes) == self.max_batch_size or tokens + text_tokens > self.max_batch_tokens):
+                batches.append((indexes, tokens))
+                indexes, tokens = [], 0
+            indexes.append(i)
+            tokens += text_tokens
+        if indexes:
+            batches.append((indexes, tokens))
+        return batches
+
+    def embed(self, texts: Sequence[str]) -> list[list[float]]:
+        embeddings: list[Optional[list[float]]] = [None] * len(texts)
+
+        def embed_batch(batch: tuple[list[int], int]):
+            indexes, tokens = batch
+            for index, embedding in zip(indexes, self.create_embeddings([texts[i] for i in indexes], tokens)):
+                embeddings[index] = embedding
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            # list() re-raises the first error of any batch
+            list(executor.map(embed_batch, self.create_batches(texts)))
+        return embeddings
+
+    def before_retry_sleep(self, retry_state):
+        if self.verbose: print("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
+
+    def create_embeddings(self, texts: list[str], tokens: int) -> list[list[float]]:
+        @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(15), before_sleep=self.before_retry_sleep)
+        def create():
+            if self.request_bucket is not None:
+                self.request_bucket.acquire()
+            if self.token_bucket is not None:
+                self.token_bucket.acquire(tokens)
+            response = openai.Embedding.create(engine=self.deployment, input=texts)
+            # The embeddings come back with the index of their input, which is not guaranteed to be their position
+            return [data["embedding"] for data in sorted(response["data"], key=lambda data: data["index"])]
+
+        return create()
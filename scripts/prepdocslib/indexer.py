@@ -0,0 +1,134 @@
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Optional, Sequence
+
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents import SearchClient
+
+# Status codes of the documents of a batch that are worth sending again: conflicts with a concurrent update, and throttling
+RETRYABLE_STATUS_CODES = {409, 422, 429, 503}
+
+
+class IndexingError(Exception):
+    def __init__(self, failed: dict[str, str]):
+        super().__init__(f"{len(failed)} documents failed: " + "; ".join(f"{key}: {message}" for key, message in list(failed.items())[:5]))
+        self.failed = failed
+
+
+class SearchIndexer:
+    """
+    Sends documents to a search index in batches sized by their serialized length, since a document with an embedding is around
+    30KB of JSON and a fixed number of them can go over the request size limit of the service (16MB), with up to max_concurrency
+    batches in flight.
+    The documents of a batch that failed (or the whole batch, if the request failed) are sent again with exponential backoff,
+    and an IndexingError lists the ones that still failed after max_attempts.
+    Documents are removed by key the same way, searching only for the keys of the documents to remove.
+    """
+
+    def __init__(self, search_client: SearchClient, key_field: str = "id", max_batch_size: int = 1000, max_batch_bytes: int = 8 * 1024 * 1024,
+                 max_concurrency: int = 4, max_attempts: int = 5, max_search_results: int = 100000, verbose: bool = False):
+        self.search_client = search_client
+        self.key_field = key_field
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        # Searches can't skip more than 100000 results, larger indexes are removed over several searches
+        self.max_search_results = max_search_results
+        self.verbose = verbose
+
+    def create_batches(self, documents: Sequence[dict[str, Any]]) -> list[list[dict[str, Any]]]:
+        """Group documents into batches of at most max_batch_size documents and about max_batch_bytes of JSON, keeping their order."""
+        batches: list[list[dict[str, Any]]] = []
+        batch: list[dict[str, Any]] = []
+        batch_bytes = 0
+        for document in documents:
+            document_bytes = len(json.dumps(document).encode("utf-8"))
+            if batch and (len(batch) == self.max_batch_size or batch_bytes + document_bytes > self.max_batch_bytes):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(document)
+            batch_bytes += document_bytes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def backoff(self, attempt: int):
+        time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+
+    def send_batch(self, action: Callable[..., list], batch: list[dict[str, Any]]) -> dict[str, str]:
+        """Send a batch until all its documents succeed or max_attempts, returns the error of the documents that failed by key."""
+        failed: dict[str, str] = {}
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                self.backoff(attempt)
+            try:
+                results = action(documents=batch)
+            except HttpResponseError as e:
+                if e.status_code == 413 and len(batch) > 1:
+                    # Still too large for the service (e.g. a lower limit than expected): send each half on its own
+                    middle = len(batch) // 2
+                    return {**self.send_batch(action, batch[:middle]), **self.send_batch(action, batch[middle:])}
+                failed.update({document[self.key_field]: str(e.message) for document in batch})
+                if e.status_code is not None and e.status_code < 500 and e.status_code not in RETRYABLE_STATUS_CODES:
+                    break
+                continue
+            # Documents that failed on an earlier attempt and weren't sent again keep their error
+            for document in batch:
+                failed.pop(document[self.key_field], None)
+            failed.update({r.key: f"{r.status_code} {r.error_message}" for r in results if not r.succeeded})
+            retryable = {r.key for r in results if not r.succeeded and r.status_code in RETRYABLE_STATUS_CODES}
+            if self.verbose and retryable and attempt + 1 < self.max_attempts: print(f"\t{len(retryable)} of {len(batch)} documents failed, sending them again")
+            batch = [document for document in batch if document[self.key_field] in retryable]
+            if not batch:
+                break
+        return failed
+
+    def run(self, action: Callable[..., list], documents: Sequence[dict[str, Any]], verb: str) -> int:
+        start = time.perf_counter()
+        batches = self.create_batches(documents)
+        failed: dict[str, str] = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            for batch_failed in executor.map(lambda batch: self.send_batch(action, batch), batches):
+                failed.update(batch_failed)
+        elapsed = time.perf_counter() - start
+        if self.verbose: print(f"\t{verb} {len(documents) - len(failed)} documents in {len(batches)} batches in {elapsed:.2f}s ({len(documents) / max(elapsed, 1e-6):.0f} documents/s)")
+        if failed:
+            raise IndexingError(failed)
+        return len(documents)
+
+    def upload_documents(self, documents: Sequence[dict[str, Any]]) -> int:
+        return self.run(self.search_client.upload_documents, documents, "Indexed")
+
+    def delete_documents(self, keys: Iterable[str]) -> int:
+        return self.run(self.search_client.delete_documents, [{self.key_field: key} for key in keys], "Removed")
+
+    def find_keys(self, filter: Optional[str]) -> list[str]:
+        # Only the keys are returned, not the documents and their embeddings, in pages of 1000 (the maximum of the service)
+        results = self.search_client.search("", filter=filter, select=[self.key_field], top=self.max_search_results)
+        return [document[self.key_field] for document in results]
+
+    def remove_documents(self, filter: Optional[str], known_keys: Iterable[str] = (), verify_interval: float = 1, max_verify_attempts: int = 30) -> int:
+        """
+        Remove the documents matching filter (all of them if it's None), and the documents with known_keys (e.g. from a manifest).
+        The keys are deleted in concurrent batches as soon as they're found, then the search is repeated until it's empty, only
+        waiting for deleted documents to disappear from search results (which takes a few seconds) at the end.
+        """
+        known_keys = list(dict.fromkeys(known_keys))
+        if known_keys:
+            self.delete_documents(known_keys)
+        deleted = set(known_keys)
+        for _ in range(max_verify_attempts):
+            keys = self.find_keys(filter)
+            if not keys:
+                return len(deleted)
+            new_keys = [key for key in keys if key not in deleted]
+            if new_keys:
+                self.delete_documents(new_keys)
+                deleted.update(new_keys)
+            else:
+                time.sleep(verify_interval)
+        print(f"Documents matching {filter or '<all>'} are still in search results after removing {len(deleted)} documents")
+        return len(deleted)
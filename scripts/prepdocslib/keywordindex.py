@@ -0,0 +1,56 @@
+import re
+import unicodedata
+from collections import Counter
+from typing import Iterable
+
+import numpy as np
+
+# Must match TOKENIZER and tokenize in app/backend/core/keywordindex.py, the app refuses an index built with another tokenizer
+TOKENIZER = "nfkc-casefold-words-1"
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN.findall(unicodedata.normalize("NFKC", text).casefold())
+
+
+def build_keyword_index(contents: Iterable[str]) -> dict[str, np.ndarray]:
+    """
+    Build the BM25 inverted index of the contents (one per document) as flat arrays, saved with numpy.savez:
+     - terms: the vocabulary, sorted
+     - offsets: the postings of terms[i] are postings_docs[offsets[i]:offsets[i + 1]], by increasing document
+     - postings_docs, postings_tf: the document of each posting and the frequency of the term in it
+     - doc_lengths: the number of tokens of each document
+     - idf: the inverse document frequency of each term, ln(1 + (N - df + 0.5) / (df + 0.5)) as in Lucene
+    """
+    term_ids: dict[str, int] = {}
+    posting_terms: list[int] = []
+    posting_docs: list[int] = []
+    posting_tfs: list[int] = []
+    doc_lengths: list[int] = []
+    for doc, content in enumerate(contents):
+        tokens = tokenize(content)
+        doc_lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+            posting_docs.append(doc)
+            posting_tfs.append(tf)
+
+    # Renumber the terms in sorted order, then group the postings by term (a stable sort keeps them by document)
+    terms = sorted(term_ids)
+    rank = np.empty(len(terms), dtype=np.int64)
+    rank[[term_ids[term] for term in terms]] = np.arange(len(terms))
+    posting_terms_array = rank[np.asarray(posting_terms, dtype=np.int64)]
+    order = np.argsort(posting_terms_array, kind="stable")
+    df = np.bincount(posting_terms_array, minlength=len(terms))
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(df, out=offsets[1:])
+    count = len(doc_lengths)
+    return {
+        "terms": np.asarray(terms, dtype=str),
+        "offsets": offsets,
+        "postings_docs": np.asarray(posting_docs, dtype=np.int32)[order],
+        "postings_tf": np.asarray(posting_tfs, dtype=np.float32)[order],
+        "doc_lengths": np.asarray(doc_lengths, dtype=np.float32),
+        "idf": np.log(1 + (count - df + 0.5) / (df + 0.5)).astype(np.float32) if count else np.zeros(0, dtype=np.float32),
+    }
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+
+class Manifest:
+    """
+    Record of what prepdocs indexed in a search index: for every file, a hash of its content and of the options it was
+    processed with, and the hash of each of its sections. With it, unchanged files are skipped, and only the sections of
+    changed files that differ are embedded and uploaded again, while the sections that disappeared are deleted.
+    The manifest is saved after every file, so an interrupted run resumes with the files it didn't finish.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str, index: str, options: dict[str, Any]):
+        self.path = path
+        self.index = index
+        # Processing options that change the sections or their embeddings (e.g. the parser), a change re-processes all files
+        self.options = options
+        self.files: dict[str, dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and data.get("index") == index:
+                self.files = data["files"]
+
+    @staticmethod
+    def file_hash(filename: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def section_hash(section: dict[str, Any]) -> str:
+        fields = {k: v for k, v in section.items() if k != "embedding"}
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    def is_unchanged(self, name: str, file_hash: str) -> bool:
+        entry = self.files.get(name)
+        return entry is not None and entry["hash"] == file_hash and entry["options"] == self.options
+
+    def diff(self, name: str, sections: list[dict[str, Any]]) -> tuple[list[dict[str, Any]], list[str]]:
+        """Returns the sections that are new or changed since the file was last indexed, and the ids of the sections that are gone."""
+        entry = self.files.get(name)
+        if entry is None:
+            return sections, []
+        previous = entry["sections"] if entry["options"] == self.options else {}
+        changed = [section for section in sections if previous.get(section["id"]) != self.section_hash(section)]
+        ids = {section["id"] for section in sections}
+        removed = [id for id in entry["sections"] if id not in ids]
+        return changed, removed
+
+    def update(self, name: str, file_hash: str, sections: list[dict[str, Any]]):
+        self.files[name] = {
+            "hash": file_hash,
+            "options": self.options,
+            "sections": {section["id"]: self.section_hash(section) for section in sections}
+        }
+        self.save()
+
+    def remove(self, name: Optional[str] = None):
+        """Forget a file, or all of them if name is None."""
+        if name is None:
+            self.files.clear()
+        else:
+            self.files.pop(name, None)
+        self.save()
+
+    def save(self):
+        # Write a new file and rename it, so an interrupted run never leaves a truncated manifest
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, "index": self.index, "files": self.files}, f)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+# Marks the end of the items in a queue
+END = object()
+
+
+class PipelineStage:
+    """
+    A step of a Pipeline: function is called on each item by workers threads, and returns the item for the next stage.
+    The stage counts the items it processed and their size, and the time its workers spent on them, to report its throughput,
+    and counts the items it failed apart. size (and the unit of the sizes) replaces those of the pipeline for this stage.
+    """
+
+    def __init__(self, name: str, function: Callable[[Any], Any], workers: int = 1, size: Optional[Callable[[Any], int]] = None, unit: Optional[str] = None):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.size_of = size
+        self.unit = unit
+        self.items = 0
+        self.size = 0
+        self.busy = 0.0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def record(self, size: int, elapsed: float):
+        with self.lock:
+            self.items += 1
+            self.size += size
+            self.busy += elapsed
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+    def report(self, unit: str) -> str:
+        unit = self.unit or unit
+        rate = f"{self.size / self.busy:.1f} {unit}/s" if self.busy > 0 else "-"
+        failures = f", {self.failures} failed" if self.failures else ""
+        return f"{self.name}: {self.items} items, {self.size} {unit} in {self.busy:.1f}s busy ({rate}){failures}"
+
+
+class Pipeline:
+    """
+    Runs items through stages that all work at the same time, each on a different item, connected by queues of at most
+    queue_size items: a stage that's ahead waits for the next one to catch up instead of piling up items in memory, and the
+    total time is about that of the slowest stage rather than the sum of all of them.
+    Items are (item, error) pairs: an item whose error is set (by the source, or by a stage that raised) skips the stages
+    after it, and every item comes out of run() with its error, in the order they complete. The throughput of the stages
+    only counts the items they processed, failed ones are counted apart.
+    """
+
+    def __init__(self, source_name: str, stages: list[PipelineStage], queue_size: int = 2, size: Callable[[Any], int] = lambda item: 1,
+                 source_size: Optional[Callable[[Any], int]] = None, source_unit: Optional[str] = None):
+        # The source is measured like a stage, by the time spent waiting for each of its items
+        self.source = PipelineStage(source_name, lambda item: item, size=source_size, unit=source_unit)
+        self.stages = stages
+        self.queue_size = queue_size
+        self.size = size
+        self.source_error: Optional[BaseException] = None
+
+    def size_of(self, stage: PipelineStage, item: Any) -> int:
+        return (stage.size_of or self.size)(item)
+
+    def report(self, unit: str = "items") -> list[str]:
+        return [stage.report(unit) for stage in [self.source, *self.stages]]
+
+    def run(self, source: Iterable[tuple[Any, Optional[BaseException]]]) -> Iterator[tuple[Any, Optional[BaseException]]]:
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self.feed, args=(source, queues[0]), daemon=True)]
+        for stage, input_queue, output_queue in zip(self.stages, queues, queues[1:]):
+            finished = [0]
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self.work, args=(stage, input_queue, output_queue, finished), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        while (entry := queues[-1].get()) is not END:
+            yield entry
+        for thread in threads:
+            thread.join()
+        if self.source_error is not None:
+            raise self.source_error
+
+    def feed(self, source: Iterable[tuple[Any, Optional[BaseException]]], output_queue: queue.Queue):
+        try:
+            entries = iter(source)
+            while True:
+                start = time.perf_counter()
+                entry = next(entries, END)
+                if entry is END:
+                    break
+                item, error = entry
+                if error is None:
+                    self.source.record(self.size_of(self.source, item), time.perf_counter() - start)
+                else:
+                    self.source.record_failure()
+                output_queue.put(entry)
+        except BaseException as e:
+            self.source_error = e
+        finally:
+            output_queue.put(END)
+
+    def work(self, stage: PipelineStage, input_queue: queue.Queue, output_queue: queue.Queue, finished: list[int]):
+        while (entry := input_queue.get()) is not END:
+            item, error = entry
+            if error is None:
+                start = time.perf_counter()
+                try:
+                    item = stage.function(item)
+                    stage.record(self.size_of(stage, item), time.perf_counter() - start)
+                except Exception as e:
+                    error = e
+                    stage.record_failure()
+            output_queue.put((item, error))
+        # Let the other workers of the stage see the end too, the last one to stop passes it on to the next stage
+        input_queue.put(END)
+        with stage.lock:
+            finished[0] += 1
+            last = finished[0] == stage.workers
+        if last:
+            output_queue.put(END)
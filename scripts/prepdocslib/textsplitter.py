@@ -0,0 +1,111 @@
+import bisect
+from typing import Generator
+
+import numpy as np
+
+SENTENCE_ENDINGS = [".", "!", "?"]
+WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+
+class TextSplitter:
+    """
+    Splits the text of a document into overlapping sections of about max_section_length characters, ending them at the end of
+    a sentence (or at least of a word) when there's one within sentence_search_limit characters, and starting the next section
+    at a table when the section ends inside one.
+    The positions of all sentence endings and word breaks are found once over an array of the code points of the text, so finding
+    the boundaries of a section is a couple of binary searches instead of a scan of the text, and so is finding the page of a section.
+    """
+
+    sentence_ending_codes = np.array([ord(c) for c in SENTENCE_ENDINGS], dtype=np.uint32)
+    word_break_codes = np.array([ord(c) for c in WORDS_BREAKS], dtype=np.uint32)
+
+    def __init__(self, max_section_length: int = 1000, sentence_search_limit: int = 100, section_overlap: int = 100, verbose: bool = False):
+        self.max_section_length = max_section_length
+        self.sentence_search_limit = sentence_search_limit
+        self.section_overlap = section_overlap
+        self.verbose = verbose
+
+    def split_pages(self, page_map: list[tuple[int, int, str]]) -> Generator[tuple[str, int], None, None]:
+        """Yields (section text, index of the page where the section starts) for the pages of page_map, (page number, offset, text) tuples."""
+        page_offsets = [offset for _, offset, _ in page_map]
+        all_text = "".join(p[2] for p in page_map)
+        # pypdf can extract lone surrogates, surrogatepass encodes them as one code each too, so the offsets stay those of the str
+        codes = np.frombuffer(all_text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        sentence_ends = np.flatnonzero(np.isin(codes, self.sentence_ending_codes))
+        word_breaks = np.flatnonzero(np.isin(codes, self.word_break_codes))
+
+        def find_page(offset):
+            # The last page starting at or before offset (empty pages start at the same offset as the next one)
+            i = bisect.bisect_right(page_offsets, offset) - 1
+            return i if i >= 0 else len(page_map) - 1
+
+        def first_sentence_end(lo, hi):
+            # The first sentence ending in [lo, hi), or None
+            i = int(sentence_ends.searchsorted(lo))
+            return int(sentence_ends[i]) if i < len(sentence_ends) and sentence_ends[i] < hi else None
+
+        def last_sentence_end(lo, hi):
+            # The last sentence ending in [lo, hi), or None
+            i = int(sentence_ends.searchsorted(hi)) - 1
+            return int(sentence_ends[i]) if i >= 0 and sentence_ends[i] >= lo else None
+
+        def last_word_break(lo, hi):
+            # The last word break in [lo, hi), or -1
+            i = int(word_breaks.searchsorted(hi)) - 1
+            return int(word_breaks[i]) if i >= 0 and word_breaks[i] >= lo else -1
+
+        def first_word_break(lo, hi):
+            # The first word break in [lo, hi), or -1
+            i = int(word_breaks.searchsorted(lo))
+            return int(word_breaks[i]) if i < len(word_breaks) and word_breaks[i] < hi else -1
+
+        length = len(all_text)
+        start = 0
+        end = length
+        while start + self.section_overlap < length:
+            end = start + self.max_section_length
+
+            if end > length:
+                end = length
+            else:
+                # Try to find the end of the sentence within sentence_search_limit characters
+                search_end = min(length, start + self.max_section_length + self.sentence_search_limit)
+                sentence_end = first_sentence_end(end, search_end)
+                if sentence_end is not None:
+                    end = sentence_end
+                else:
+                    last_word = last_word_break(end, search_end)
+                    end = search_end
+                    if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                        end = last_word # Fall back to at least keeping a whole word
+            if end < length:
+                end += 1
+
+            # Try to find the start of the sentence or at least a whole word boundary, looking back from start down to
+            # (excluding) floor, where the search stops
+            floor = max(0, end - self.max_section_length - 2 * self.sentence_search_limit)
+            if start > floor:
+                sentence_start = last_sentence_end(floor + 1, start + 1)
+                stop = sentence_start if sentence_start is not None else floor
+                last_word = first_word_break(stop + 1, start + 1)
+                start = stop
+                if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+                    start = last_word
+            if start > 0:
+                start += 1
+
+            section_text = all_text[start:end]
+            yield (section_text, find_page(start))
+
+            last_table_start = section_text.rfind("<table")
+            if (last_table_start > 2 * self.sentence_search_limit and last_table_start > section_text.rfind("</table")):
+                # If the section ends with an unclosed table, we need to start the next section with the table.
+                # If table starts inside sentence_search_limit, we ignore it, as that will cause an infinite loop for tables longer than max_section_length
+                # If last table starts inside section_overlap, keep overlapping
+                if self.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
+                start = min(end - self.section_overlap, start + last_table_start)
+            else:
+                start = end - self.section_overlap
+
+        if start + self.section_overlap < end:
+            yield (all_text[start:end], find_page(start))
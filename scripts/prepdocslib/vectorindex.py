@@ -0,0 +1,106 @@
+import glob
+import json
+import os
+import tempfile
+import threading
+import uuid
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+from .keywordindex import TOKENIZER, build_keyword_index
+
+# The fields of the sections kept in the index, the same as in the search index except the embedding
+SECTION_FIELDS = ("id", "content", "category", "sourcepage", "sourcefile")
+
+
+class VectorIndexWriter:
+    """
+    Writes the sections and their embeddings to a directory the app can search in-process (see app/backend/core/vectorindex.py),
+    instead of or as well as a Cognitive Search index:
+     - embeddings-<generation>.npy: the embeddings as an .npy matrix of float16 or float32 rows, normalized so that the dot
+       product of two rows is their cosine similarity, which the app memory-maps (so its workers share the pages)
+     - keywords-<generation>.npz: the BM25 inverted index of the content of the sections (see build_keyword_index)
+     - index.json: the names of those files, and the fields of the section of each row of the matrix, in the same order
+    Each save writes new files and then replaces index.json, so the app never reads rows that don't match the sections.
+    The previous index is loaded first, so runs that only process some files (or only the sections that changed) update it.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory: str, dtype: str = "float32", verbose: bool = False):
+        self.directory = directory
+        self.dtype = dtype
+        self.verbose = verbose
+        self.sections: dict[str, dict[str, Any]] = {}
+        self.embeddings: dict[str, np.ndarray] = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    @property
+    def metadata_path(self) -> str:
+        return os.path.join(self.directory, "index.json")
+
+    def load(self):
+        if not os.path.exists(self.metadata_path):
+            return
+        with open(self.metadata_path, encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata.get("version") != self.VERSION or not metadata["sections"]:
+            return
+        matrix = np.load(os.path.join(self.directory, metadata["matrix"]))
+        for section, embedding in zip(metadata["sections"], matrix):
+            self.sections[section["id"]] = section
+            self.embeddings[section["id"]] = embedding.astype(np.float32)
+
+    def upsert(self, sections: Iterable[dict[str, Any]]):
+        with self.lock:
+            for section in sections:
+                self.sections[section["id"]] = {field: section.get(field) for field in SECTION_FIELDS}
+                self.embeddings[section["id"]] = np.asarray(section["embedding"], dtype=np.float32)
+
+    def delete(self, ids: Iterable[str]):
+        with self.lock:
+            for id in ids:
+                self.sections.pop(id, None)
+                self.embeddings.pop(id, None)
+
+    def remove_file(self, sourcefile: Optional[str] = None) -> int:
+        """Remove the sections of sourcefile, or all of them if it's None, returns how many were removed."""
+        ids = [id for id, section in self.sections.items() if sourcefile is None or section["sourcefile"] == sourcefile]
+        self.delete(ids)
+        return len(ids)
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            ids = list(self.sections)
+            sections = [self.sections[id] for id in ids]
+            matrix = np.stack([self.embeddings[id] for id in ids]) if ids else np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = (matrix / np.where(norms == 0, 1, norms)).astype(self.dtype)
+
+        # Write new files and rename them, so the app never reads a truncated file, nor an index.json without its files
+        generation = uuid.uuid4().hex
+        matrix_name = f"embeddings-{generation}.npy"
+        with tempfile.NamedTemporaryFile("wb", dir=self.directory, suffix=".tmp", delete=False) as f:
+            np.save(f, matrix)
+        os.replace(f.name, os.path.join(self.directory, matrix_name))
+        keywords_name = f"keywords-{generation}.npz"
+        with tempfile.NamedTemporaryFile("wb", dir=self.directory, suffix=".tmp", delete=False) as f:
+            np.savez(f, **build_keyword_index(section["content"] for section in sections))
+        os.replace(f.name, os.path.join(self.directory, keywords_name))
+        metadata = {"version": self.VERSION, "matrix": matrix_name, "dimensions": matrix.shape[1], "dtype": self.dtype,
+                    "keywords": keywords_name, "tokenizer": TOKENIZER, "sections": sections}
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self.directory, suffix=".tmp", delete=False) as f:
+            json.dump(metadata, f, ensure_ascii=False)
+        os.replace(f.name, self.metadata_path)
+        # Workers that still map a previous matrix keep reading it until they reload (on Windows it can't be removed until then)
+        for path in glob.glob(os.path.join(self.directory, "embeddings-*.npy")) + glob.glob(os.path.join(self.directory, "keywords-*.npz")):
+            if os.path.basename(path) not in (matrix_name, keywords_name):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        if self.verbose: print(f"Saved {len(sections)} sections to local vector index '{self.directory}'")
+
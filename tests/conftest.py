@@ -1,7 +1,9 @@
 from collections import namedtuple
 from unittest import mock
 
+import openai
 import pytest
+import pytest_asyncio
 
 import app as backend_app
 from approaches.approach import Approach
@@ -9,7 +11,7 @@ from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 
 
 class MockedAskApproach(Approach):
-    def run(self, question, overrides):
+    async def run(self, question, overrides):
         assert question == "What is the capital of France?"
         return {"answer": "Paris"}
 
@@ -18,44 +20,109 @@ class MockedChatApproach(ChatReadRetrieveReadApproach):
     def __init__(self):
         pass
 
-    def run(self, history, overrides):
+    async def run(self, history, overrides):
         messages = ChatReadRetrieveReadApproach.get_messages_from_history(self, ChatReadRetrieveReadApproach.query_prompt_template, "gpt-3.5-turbo", history, "Generate search query")
         assert messages[0]["role"] == "system"
         assert messages[1]["content"] == "Generate search query"
         assert messages[1]["role"] == "user"
         return {"answer": "Paris", "data_points": [], "thoughts": ""}
 
+    async def run_stream(self, history, overrides):
+        yield {"data_points": [], "thoughts": ""}
+        yield {"delta": "Par"}
+        yield {"delta": "is"}
+
+
+class MockSearchResults:
+    def __init__(self, documents, answers=None):
+        self.documents = documents
+        self.answers = answers
+
+    async def __aiter__(self):
+        for doc in self.documents:
+            yield doc
+
+    async def get_count(self):
+        return len(self.documents)
+
+    async def get_answers(self):
+        return self.answers
+
+
+class MockSearchClient:
+    """Returns the same documents (and semantic answers) for every search, and records the searches."""
+
+    def __init__(self, documents=None, answers=None):
+        self.documents = documents if documents is not None else [{"sourcepage": "Benefit_Options-2.pdf", "content": "Northwind Plus covers eye exams."}]
+        self.answers = answers
+        self.searches = []
+
+    async def search(self, search_text, **kwargs):
+        self.searches.append((search_text, kwargs))
+        return MockSearchResults(self.documents, self.answers)
+
+
+class MockCompletion(dict):
+    """A chat completion answering content, read like an OpenAIObject: as a dict or through its choices."""
+
+    def __init__(self, content):
+        super().__init__(choices=[{"message": {"content": content}}], usage={"prompt_tokens": 100, "completion_tokens": len(content.split())})
+        self.choices = [type("Choice", (), {"message": type("Message", (), {"content": content})})]
+
+
+@pytest.fixture
+def mock_embeddings(monkeypatch):
+    """
+    Patches openai.Embedding.acreate to return embedding(input, embedded) for every input, where embedded lists the inputs
+    embedded so far (including this one), and returns that list.
+    """
+    def mock(embedding=lambda input, embedded: [0.5, 0.5]):
+        embedded = []
+
+        async def mock_embedding_acreate(engine, input):
+            embedded.append(input)
+            return {"data": [{"embedding": embedding(input, embedded)}]}
+
+        monkeypatch.setattr(openai.Embedding, "acreate", mock_embedding_acreate)
+        return embedded
+
+    return mock
+
+
+@pytest.fixture
+def embedded(mock_embeddings):
+    return mock_embeddings()
+
 
 MockToken = namedtuple("MockToken", ["token", "expires_on"])
 
 
 class MockAzureCredential:
-    def get_token(self, uri):
+    async def get_token(self, uri):
         return MockToken("mock_token", 9999999999)
 
+    async def close(self):
+        pass
 
-@pytest.fixture()
-def app():
-    # mock the DefaultAzureCredential
-    with mock.patch("app.DefaultAzureCredential") as mock_default_azure_credential:
+
+@pytest_asyncio.fixture()
+async def app(tmp_path):
+    # mock the DefaultAzureCredential, and keep the metrics of each test apart
+    with mock.patch("app.DefaultAzureCredential") as mock_default_azure_credential, mock.patch("app.METRICS_PATH", str(tmp_path / "metrics.sqlite3")):
         mock_default_azure_credential.return_value = MockAzureCredential()
         _app = backend_app.create_app()
-    _app.config.update(
-        {
-            "TESTING": True,
-            backend_app.CONFIG_ASK_APPROACHES: {"mock": MockedAskApproach()},
-            backend_app.CONFIG_CHAT_APPROACHES: {"mock": MockedChatApproach()},
-        }
-    )
+        async with _app.test_app() as test_app:
+            _app.config.update(
+                {
+                    "TESTING": True,
+                    backend_app.CONFIG_ASK_APPROACHES: {"mock": MockedAskApproach()},
+                    backend_app.CONFIG_CHAT_APPROACHES: {"mock": MockedChatApproach()},
+                }
+            )
 
-    yield _app
+            yield test_app
 
 
 @pytest.fixture()
 def client(app):
     return app.test_client()
-
-
-@pytest.fixture()
-def runner(app):
-    return app.test_cli_runner()
@@ -0,0 +1,101 @@
+import openai
+import pytest
+from conftest import MockCompletion, MockSearchClient
+
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.answercache import AnswerCache
+from core.retriever import Retriever
+
+ANSWER = {"data_points": ["Benefit_Options-2.pdf: Northwind Plus covers eye exams."], "answer": "Eye exams are covered [Benefit_Options-2.pdf]", "thoughts": "Prompt"}
+
+
+@pytest.mark.asyncio
+async def test_similar_question_gets_cached_answer():
+    cache = AnswerCache(threshold=0.95, ttl=60, max_entries=10)
+    scope = await cache.scope({"top": 3})
+    cache.set(scope, [1.0, 0.0], "what does Northwind Plus cover for eye exams", ANSWER)
+    assert cache.get(scope, [0.99, 0.05]) == ("what does Northwind Plus cover for eye exams", ANSWER)
+    assert cache.get(scope, [0.7, 0.7]) is None
+
+
+@pytest.mark.asyncio
+async def test_answers_are_scoped_by_overrides_and_generation():
+    generations = iter(["1", "1", "1", "2"])
+
+    async def get_generation():
+        return next(generations)
+
+    cache = AnswerCache(threshold=0.95, ttl=60, max_entries=10, generation=get_generation)
+    cache.set(await cache.scope({"top": 3}), [1.0, 0.0], "eye exams", ANSWER)
+    assert cache.get(await cache.scope({"top": 3}), [1.0, 0.0]) is not None
+    assert cache.get(await cache.scope({"top": 5}), [1.0, 0.0]) is None
+    assert cache.get(await cache.scope({"top": 3}), [1.0, 0.0]) is None
+
+
+def test_expired_and_oldest_answers_are_not_returned():
+    cache = AnswerCache(threshold=0.95, ttl=0, max_entries=2)
+    cache.set("scope", [1.0, 0.0], "eye exams", ANSWER)
+    assert cache.get("scope", [1.0, 0.0]) is None
+
+    cache = AnswerCache(threshold=0.95, ttl=60, max_entries=2)
+    for vector in ([1.0, 0.0], [0.0, 1.0], [-1.0, 0.0]):
+        cache.set("scope", vector, "question", ANSWER)
+    assert cache.get("scope", [1.0, 0.0]) is None
+    assert cache.get("scope", [0.0, 1.0]) is not None
+    assert cache.get("scope", [-1.0, 0.0]) is not None
+
+
+@pytest.fixture
+def completions(monkeypatch, mock_embeddings):
+    completions = []
+    embeddings = {"what does Northwind Plus cover for eye exams": [1.0, 0.0], "eye exam coverage Northwind Plus": [0.99, 0.05], "what is the deductible": [0.0, 1.0]}
+    mock_embeddings(lambda input, embedded: embeddings[input])
+
+    async def mock_chat_acreate(**kwargs):
+        completions.append(kwargs)
+        if kwargs["stream"]:
+            async def events():
+                for delta in ["Eye exams are ", "covered [Benefit_Options-2.pdf]"]:
+                    yield {"choices": [{"delta": {"content": delta}}]}
+            return events()
+        return MockCompletion("Eye exams are covered [Benefit_Options-2.pdf]")
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_chat_acreate)
+    return completions
+
+
+def approach(search_client):
+    retriever = Retriever(search_client, "embedding", "sourcepage", "content")
+    return RetrieveThenReadApproach(retriever, "chat", "gpt-35-turbo", answer_cache=AnswerCache(threshold=0.95, ttl=60, max_entries=10))
+
+
+@pytest.mark.asyncio
+async def test_paraphrase_skips_search_and_completion(completions):
+    search_client = MockSearchClient()
+    rtr = approach(search_client)
+    first = await rtr.run("what does Northwind Plus cover for eye exams", {})
+    assert search_client.searches[0][1]["vector"] == [1.0, 0.0]
+
+    second = await rtr.run("eye exam coverage Northwind Plus", {})
+    assert len(search_client.searches) == 1
+    assert len(completions) == 1
+    assert second["answer"] == first["answer"]
+    assert second["data_points"] == first["data_points"]
+    assert "what does Northwind Plus cover for eye exams" in second["thoughts"]
+
+    await rtr.run("what is the deductible", {})
+    await rtr.run("eye exam coverage Northwind Plus", {"retrieval_mode": "text"})
+    assert len(completions) == 3
+
+
+@pytest.mark.asyncio
+async def test_streamed_answer_is_cached(completions):
+    rtr = approach(MockSearchClient())
+    events = [event async for event in rtr.run_stream("what does Northwind Plus cover for eye exams", {})]
+    assert "".join(event.get("delta", "") for event in events) == "Eye exams are covered [Benefit_Options-2.pdf]"
+
+    events = [event async for event in rtr.run_stream("eye exam coverage Northwind Plus", {})]
+    assert len(completions) == 1
+    assert events[0]["data_points"] == ["Benefit_Options-2.pdf: Northwind Plus covers eye exams."]
+    assert events[1:] == [{"delta": "Eye exams are covered [Benefit_Options-2.pdf]"}]
+    assert (await rtr.run("eye exam coverage Northwind Plus", {}))["answer"] == "Eye exams are covered [Benefit_Options-2.pdf]"
@@ -1,38 +1,50 @@
-def test_index(client):
-    response = client.get("/")
+import json
+
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_index(client):
+    response = await client.get("/")
     assert response.status_code == 200
 
 
-def test_ask_request_must_be_json(client):
-    response = client.post("/ask")
+@pytest.mark.asyncio
+async def test_ask_request_must_be_json(client):
+    response = await client.post("/ask")
     assert response.status_code == 415
-    assert response.json["error"] == "request must be json"
+    assert (await response.get_json())["error"] == "request must be json"
 
 
-def test_ask_with_unknown_approach(client):
-    response = client.post("/ask", json={"approach": "test"})
+@pytest.mark.asyncio
+async def test_ask_with_unknown_approach(client):
+    response = await client.post("/ask", json={"approach": "test"})
     assert response.status_code == 400
 
 
-def test_ask_mock_approach(client):
-    response = client.post("/ask", json={"approach": "mock", "question": "What is the capital of France?"})
+@pytest.mark.asyncio
+async def test_ask_mock_approach(client):
+    response = await client.post("/ask", json={"approach": "mock", "question": "What is the capital of France?"})
     assert response.status_code == 200
-    assert response.json["answer"] == "Paris"
+    assert (await response.get_json())["answer"] == "Paris"
 
 
-def test_chat_request_must_be_json(client):
-    response = client.post("/chat")
+@pytest.mark.asyncio
+async def test_chat_request_must_be_json(client):
+    response = await client.post("/chat")
     assert response.status_code == 415
-    assert response.json["error"] == "request must be json"
+    assert (await response.get_json())["error"] == "request must be json"
 
 
-def test_chat_with_unknown_approach(client):
-    response = client.post("/chat", json={"approach": "test"})
+@pytest.mark.asyncio
+async def test_chat_with_unknown_approach(client):
+    response = await client.post("/chat", json={"approach": "test"})
     assert response.status_code == 400
 
 
-def test_chat_mock_approach(client):
-    response = client.post(
+@pytest.mark.asyncio
+async def test_chat_mock_approach(client):
+    response = await client.post(
         "/chat",
         json={
             "approach": "mock",
@@ -40,4 +52,57 @@ def test_chat_mock_approach(client):
         },
     )
     assert response.status_code == 200
-    assert response.json["answer"] == "Paris"
+    assert (await response.get_json())["answer"] == "Paris"
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_with_unknown_approach(client):
+    response = await client.post("/ask_stream", json={"approach": "test"})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_mock_approach(client):
+    response = await client.post("/ask_stream", json={"approach": "mock", "question": "What is the capital of France?"})
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = (await response.get_data(as_text=True)).splitlines()
+    assert [json.loads(line) for line in lines] == [{"answer": "Paris"}]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_request_must_be_json(client):
+    response = await client.post("/chat_stream")
+    assert response.status_code == 415
+    assert (await response.get_json())["error"] == "request must be json"
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_mock_approach(client):
+    response = await client.post(
+        "/chat_stream",
+        json={
+            "approach": "mock",
+            "history": [{"user": "What is the capital of France?"}],
+        },
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0] == {"data_points": [], "thoughts": ""}
+    assert "".join(e["delta"] for e in events[1:]) == "Paris"
+
+
+@pytest.mark.asyncio
+async def test_metrics(client):
+    response = await client.post("/ask", json={"approach": "mock", "question": "What is the capital of France?"})
+    assert "Server-Timing" in response.headers
+    response = await client.post("/chat_stream", json={"approach": "mock", "history": [{"user": "What is the capital of France?"}]})
+    await response.get_data()
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    text = await response.get_data(as_text=True)
+    assert 'app_requests_total{endpoint="ask",approach="mock",status="ok"} 1' in text
+    assert 'app_requests_total{endpoint="chat_stream",approach="mock",status="ok"} 1' in text
+    assert 'app_request_duration_seconds_count{endpoint="ask",approach="mock"} 1' in text
@@ -0,0 +1,101 @@
+import openai
+import pytest
+from conftest import MockCompletion, MockSearchClient
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.retriever import Retriever
+from core.tracing import RequestTrace
+
+
+@pytest.fixture
+def embedded(mock_embeddings):
+    # A different embedding for every input, to tell which one the search used
+    return mock_embeddings(lambda input, embedded: [float(len(embedded))])
+
+
+def mock_rewrite(monkeypatch, rewrite):
+    async def mock_chat_acreate(**kwargs):
+        if kwargs["max_tokens"] == 32:
+            if isinstance(rewrite, Exception):
+                raise rewrite
+            return MockCompletion(rewrite)
+        return MockCompletion("Eye exams are covered [Benefit_Options-2.pdf]")
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_chat_acreate)
+
+
+def approach(search_client, speculative_embedding=True):
+    retriever = Retriever(search_client, "embedding", "sourcepage", "content")
+    return ChatReadRetrieveReadApproach(retriever, "chat", "gpt-35-turbo", speculative_embedding=speculative_embedding)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("rewrite", ["0", "Does Northwind Plus cover eye exams"])
+async def test_speculative_embedding_used_for_unchanged_query(monkeypatch, embedded, rewrite):
+    mock_rewrite(monkeypatch, rewrite)
+    search_client = MockSearchClient()
+    r = await approach(search_client).run([{"user": "Does Northwind Plus cover eye exams?"}], {})
+    assert r["answer"] == "Eye exams are covered [Benefit_Options-2.pdf]"
+    assert embedded == ["Does Northwind Plus cover eye exams?"]
+    assert search_client.searches[0][1]["vector"] == [1.0]
+
+
+@pytest.mark.asyncio
+async def test_speculative_embedding_discarded_for_rewritten_query(monkeypatch, embedded):
+    mock_rewrite(monkeypatch, "Northwind Plus eye exam coverage")
+    search_client = MockSearchClient()
+    await approach(search_client).run([{"user": "Does Northwind Plus cover eye exams?"}], {})
+    assert embedded[-1] == "Northwind Plus eye exam coverage"
+    assert search_client.searches[0][0] == "Northwind Plus eye exam coverage"
+    assert search_client.searches[0][1]["vector"] == [float(len(embedded))]
+
+
+@pytest.mark.asyncio
+async def test_speculative_embedding_used_when_rewrite_fails(monkeypatch, embedded):
+    mock_rewrite(monkeypatch, openai.error.Timeout("timed out"))
+    search_client = MockSearchClient()
+    await approach(search_client).run([{"user": "Does Northwind Plus cover eye exams?"}], {})
+    assert embedded == ["Does Northwind Plus cover eye exams?"]
+    assert search_client.searches[0][0] == "Does Northwind Plus cover eye exams?"
+
+
+@pytest.mark.asyncio
+async def test_rewrite_failure_raises_without_speculation(monkeypatch, embedded):
+    mock_rewrite(monkeypatch, openai.error.Timeout("timed out"))
+    with pytest.raises(openai.error.Timeout):
+        await approach(MockSearchClient(), speculative_embedding=False).run([{"user": "Does Northwind Plus cover eye exams?"}], {})
+    assert embedded == []
+
+
+@pytest.mark.asyncio
+async def test_no_speculation_for_text_retrieval(monkeypatch, embedded):
+    mock_rewrite(monkeypatch, "0")
+    await approach(MockSearchClient()).run([{"user": "Does Northwind Plus cover eye exams?"}], {"retrieval_mode": "text"})
+    assert embedded == []
+
+
+@pytest.mark.asyncio
+async def test_stages_and_usage_are_traced(monkeypatch, embedded):
+    mock_rewrite(monkeypatch, "Northwind Plus eye exam coverage")
+    with RequestTrace().activate() as trace:
+        await approach(MockSearchClient(), speculative_embedding=False).run([{"user": "Does Northwind Plus cover eye exams?"}], {})
+    assert [name for name, _ in trace.spans] == ["query_rewrite", "embedding", "search", "completion"]
+    assert trace.prompt_tokens == 200
+    assert trace.completion_tokens == 5 + 5
+    assert trace.agent_iterations is None
+
+
+@pytest.mark.asyncio
+async def test_failed_speculative_embedding_is_computed_again(monkeypatch, mock_embeddings):
+    def embedding(input, embedded):
+        if len(embedded) == 1:
+            raise openai.error.RateLimitError("throttled")
+        return [1.0]
+
+    embedded = mock_embeddings(embedding)
+    mock_rewrite(monkeypatch, "0")
+    search_client = MockSearchClient()
+    r = await approach(search_client).run([{"user": "Does Northwind Plus cover eye exams?"}], {})
+    assert r["answer"] == "Eye exams are covered [Benefit_Options-2.pdf]"
+    assert embedded == ["Does Northwind Plus cover eye exams?"] * 2
+    assert search_client.searches[0][1]["vector"] == [1.0]
@@ -0,0 +1,166 @@
+import os
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+import app as backend_app
+from core.contentcache import ContentCache
+
+PDF = b"%PDF-1.4 " + bytes(range(256)) * 4
+ETAG = '"0x8DB8F1E1A2B3C4D"'
+
+
+class MockDownload:
+    def __init__(self, data):
+        self.data = data
+
+    async def chunks(self):
+        for i in range(0, len(self.data), 100):
+            yield self.data[i:i + 100]
+
+
+class MockBlobClient:
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.downloads = []
+
+    def get_container_client(self, container):
+        return self
+
+    def get_blob_client(self, name):
+        self.name = name
+        return self
+
+    async def get_blob_properties(self):
+        if self.name not in self.blobs:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return SimpleNamespace(
+            size=len(self.blobs[self.name]),
+            etag=ETAG,
+            last_modified=datetime(2023, 7, 1, tzinfo=timezone.utc),
+            content_settings=SimpleNamespace(content_type="application/pdf"))
+
+    async def download_blob(self, offset, length, etag, match_condition):
+        assert etag == ETAG
+        self.downloads.append((offset, length))
+        return MockDownload(self.blobs[self.name][offset:offset + length])
+
+
+@pytest.fixture
+def content_cache(app, tmp_path, monkeypatch):
+    content_cache = ContentCache(str(tmp_path / "content"), max_bytes=10 * len(PDF))
+    monkeypatch.setitem(app.app.config, backend_app.CONFIG_CONTENT_CACHE, content_cache)
+    return content_cache
+
+
+@pytest.fixture
+def blob_client(app, content_cache, monkeypatch):
+    blob_client = MockBlobClient({"Benefit_Options-2.pdf": PDF})
+    monkeypatch.setitem(app.app.config, backend_app.CONFIG_BLOB_CLIENT, blob_client)
+    return blob_client
+
+
+@pytest.mark.asyncio
+async def test_content_file_streamed_then_cached(client, blob_client):
+    response = await client.get("/content/Benefit_Options-2.pdf")
+    assert response.status_code == 200
+    assert response.mimetype == "application/pdf"
+    assert response.headers["ETag"] == ETAG
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert await response.get_data() == PDF
+    assert blob_client.downloads == [(0, len(PDF))]
+
+    response = await client.get("/content/Benefit_Options-2.pdf")
+    assert await response.get_data() == PDF
+    assert blob_client.downloads == [(0, len(PDF))]
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 10-19/{len(PDF)}"
+    assert await response.get_data() == PDF[10:20]
+    assert blob_client.downloads == [(0, len(PDF))]
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"If-None-Match": ETAG})
+    assert response.status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_content_file_range(client, blob_client):
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"Range": "bytes=100-299"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 100-299/{len(PDF)}"
+    assert await response.get_data() == PDF[100:300]
+    assert blob_client.downloads == [(100, 200)]
+    # partial downloads are not cached
+    await (await client.get("/content/Benefit_Options-2.pdf")).get_data()
+    assert blob_client.downloads == [(100, 200), (0, len(PDF))]
+
+
+@pytest.mark.asyncio
+async def test_content_file_range_not_satisfiable(client, blob_client):
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"Range": f"bytes={len(PDF)}-"})
+    assert response.status_code == 416
+    assert blob_client.downloads == []
+
+
+@pytest.mark.asyncio
+async def test_content_file_not_modified(client, blob_client):
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"If-None-Match": ETAG})
+    assert response.status_code == 304
+    assert await response.get_data() == b""
+    response = await client.get("/content/Benefit_Options-2.pdf", headers={"If-Modified-Since": "Sat, 01 Jul 2023 00:00:00 GMT"})
+    assert response.status_code == 304
+    assert blob_client.downloads == []
+
+
+@pytest.mark.asyncio
+async def test_content_file_not_found(client, blob_client):
+    response = await client.get("/content/Missing.pdf")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_content_cache_keyed_by_etag(tmp_path):
+    cache = ContentCache(str(tmp_path), max_bytes=1000)
+    with await cache.open() as f:
+        f.write(b"page")
+    await cache.commit(f, "a.pdf", '"1"')
+    with await cache.get("a.pdf", '"1"') as f:
+        assert f.read() == b"page"
+    assert await cache.get("a.pdf", '"2"') is None
+    assert await cache.get("b.pdf", '"1"') is None
+
+
+@pytest.mark.asyncio
+async def test_content_cache_evicts_least_recently_served(tmp_path):
+    cache = ContentCache(str(tmp_path), max_bytes=250)
+    for i, name in enumerate(["a.pdf", "b.pdf", "c.pdf"]):
+        with await cache.open() as f:
+            f.write(b"x" * 100)
+        await cache.commit(f, name, '"1"')
+        os.utime(cache.path(name, '"1"'), (i, i))
+        if name == "b.pdf":
+            # serving a.pdf again makes b.pdf the least recently used
+            (await cache.get("a.pdf", '"1"')).close()
+    assert os.path.exists(cache.path("a.pdf", '"1"'))
+    assert not os.path.exists(cache.path("b.pdf", '"1"'))
+    assert os.path.exists(cache.path("c.pdf", '"1"'))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+@pytest.mark.asyncio
+async def test_content_file_evicted_after_get_is_served(client, blob_client, content_cache, monkeypatch):
+    await (await client.get("/content/Benefit_Options-2.pdf")).get_data()
+    get = content_cache.get
+
+    async def get_then_evict(name, etag):
+        # Another worker evicts the file between the lookup and the response
+        file = await get(name, etag)
+        os.remove(content_cache.path(name, etag))
+        return file
+
+    monkeypatch.setattr(content_cache, "get", get_then_evict)
+    response = await client.get("/content/Benefit_Options-2.pdf")
+    assert response.status_code == 200
+    assert await response.get_data() == PDF
+    assert blob_client.downloads == [(0, len(PDF))]
@@ -0,0 +1,99 @@
+import asyncio
+import sqlite3
+
+import openai
+import pytest
+
+from core.diskcache import DiskCache
+from core.embeddings import EmbeddingCache, compute_embedding
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_roundtrip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), ttl=60, max_entries=10)
+    assert await cache.get("embedding", "What is a PPO?") is None
+    await cache.set("embedding", "What is a PPO?", [0.25, -1.5, 3.0])
+    assert await cache.get("embedding", "What is a PPO?") == [0.25, -1.5, 3.0]
+    # the deployment is part of the key
+    assert await cache.get("other", "What is a PPO?") is None
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_normalizes_whitespace(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), ttl=60, max_entries=10)
+    await cache.set("embedding", "What is a PPO?", [1.0])
+    assert await cache.get("embedding", "  What  is a\nPPO? ") == [1.0]
+    assert await cache.get("embedding", "What is an HMO?") is None
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_shared_between_instances(tmp_path):
+    await EmbeddingCache(str(tmp_path / "cache.sqlite3"), ttl=60, max_entries=10).set("embedding", "q", [1.0])
+    assert await EmbeddingCache(str(tmp_path / "cache.sqlite3"), ttl=60, max_entries=10).get("embedding", "q") == [1.0]
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_expires(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite3"), "test", ttl=-1, max_entries=10)
+    await cache.set("key", b"value")
+    assert await cache.get("key") is None
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_evicts_oldest(tmp_path, monkeypatch):
+    monkeypatch.setattr(DiskCache, "EVICT_EVERY", 1)
+    cache = DiskCache(str(tmp_path / "cache.sqlite3"), "test", ttl=60, max_entries=2)
+    for i in range(4):
+        await cache.set(f"key{i}", b"value")
+    assert await cache.get("key0") is None
+    assert await cache.get("key1") is None
+    assert await cache.get("key3") == b"value"
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_errors_are_misses(tmp_path):
+    cache = DiskCache(str(tmp_path / "missing" / "cache.sqlite3"), "test", ttl=60, max_entries=2)
+    await cache.set("key", b"value")
+    assert await cache.get("key") is None
+    await cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_disk_cache_waits_for_locks_in_a_thread(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite3"), "test", ttl=60, max_entries=10)
+    await cache.set("key", b"value")
+    # Another worker holding the write lock makes the write wait for the busy timeout, while the event loop keeps running
+    other_worker = sqlite3.connect(str(tmp_path / "cache.sqlite3"), isolation_level=None)
+    other_worker.execute("BEGIN IMMEDIATE")
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.create_task(tick())
+    await cache.set("key", b"new value")
+    ticker.cancel()
+    other_worker.rollback()
+    other_worker.close()
+    assert ticks >= 10
+    assert await cache.get("key") == b"value"
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_uses_cache(tmp_path, monkeypatch):
+    calls = []
+
+    async def mock_acreate(engine, input):
+        calls.append(input)
+        return {"data": [{"embedding": [0.5, 0.5]}]}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_acreate)
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), ttl=60, max_entries=10)
+    assert await compute_embedding("embedding", "What is a PPO?", cache) == [0.5, 0.5]
+    assert await compute_embedding("embedding", "What is a PPO?", cache) == [0.5, 0.5]
+    assert calls == ["What is a PPO?"]
+    assert await compute_embedding("embedding", "What is a PPO?") == [0.5, 0.5]
+    assert len(calls) == 2
@@ -0,0 +1,69 @@
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from benchmarks.fakeservices import FakeServices, Latency
+from langchain.agents import ZeroShotAgent
+from langchain.agents.react.base import ReActDocstoreAgent
+from langchain.schema import AgentAction, AgentFinish
+
+
+def make_services(**kwargs):
+    options = {"completion_tokens": 5, "content_length": 80, "embedding_dimensions": 8}
+    options.update(kwargs)
+    return FakeServices(Latency("0"), Latency("0"), Latency("0"), Latency("0"), **options)
+
+
+def test_latency_distributions():
+    assert Latency("200").sample() == 0.2
+    assert all(0.1 <= Latency("uniform:100:300").sample() <= 0.3 for _ in range(100))
+    assert all(Latency("normal:10:100").sample() >= 0 for _ in range(100))
+    samples = sorted(Latency("lognormal:200:0.5").sample() for _ in range(1001))
+    assert 0.15 < samples[500] < 0.25
+    with pytest.raises(ValueError):
+        Latency("poisson:3")
+
+
+def test_agent_steps_parsed_by_the_agents():
+    services = make_services()
+    zero_shot = ZeroShotAgent._get_default_output_parser()
+    prompt = "Use the format\nAction Input: the input\nObservation: the result\nBegin!\n\nQuestion: Does my plan cover eye exams?\n\nThought:"
+    action = zero_shot.parse(services.agent_step(prompt))
+    assert isinstance(action, AgentAction)
+    assert (action.tool, action.tool_input) == ("CognitiveSearch", "Does my plan cover eye exams?")
+    assert isinstance(zero_shot.parse(services.agent_step(prompt + " I need to search\nObservation: results\nThought:")), AgentFinish)
+
+    react = ReActDocstoreAgent._get_default_output_parser()
+    prompt = "Question: example\nObservation: <a.pdf> example\nAction: Finish[a]\n\nQuestion: Does my plan cover eye exams?\n"
+    action = react.parse(services.agent_step(prompt))
+    assert isinstance(action, AgentAction)
+    assert (action.tool, action.tool_input) == ("Search", "Does my plan cover eye exams?")
+    assert isinstance(react.parse(services.agent_step(prompt + "Action: Search[eye exams]\nObservation: results\n")), AgentFinish)
+
+
+@pytest.mark.asyncio
+async def test_endpoints():
+    async with TestClient(TestServer(make_services().app())) as client:
+        response = await client.post("/openai/deployments/chat/chat/completions", json={"messages": [{"role": "user", "content": "hello"}]})
+        completion = await response.json()
+        assert len(completion["choices"][0]["message"]["content"].split(" ")) == 6
+        assert completion["usage"]["total_tokens"] > 0
+
+        response = await client.post("/openai/deployments/chat/chat/completions", json={"messages": [{"role": "user", "content": "hello"}], "stream": True})
+        events = (await response.text()).strip().split("\n\n")
+        assert len(events) == 8
+        assert events[-1] == "data: [DONE]"
+
+        response = await client.post("/openai/deployments/embedding/embeddings", json={"input": ["a", "b"]})
+        embeddings = await response.json()
+        assert [data["index"] for data in embeddings["data"]] == [0, 1]
+        assert len(embeddings["data"][0]["embedding"]) == 8
+
+        response = await client.post("/search/indexes('gptkbindex')/docs/search.post.search", json={"search": "eye exams", "top": 3, "captions": "extractive", "count": True})
+        results = await response.json()
+        assert len(results["value"]) == 3
+        assert results["@odata.count"] == 3
+        assert "@search.captions" in results["value"][0]
+
+        response = await client.get("/blob/content", params={"restype": "container"})
+        assert response.status == 200
+
+        assert await (await client.get("/stats")).json() == {"chat": 2, "embeddings": 1, "search": 1, "blob": 1}
@@ -22,3 +22,53 @@ def test_messagebuilder_append():
     ]
     assert builder.model == "gpt-35-turbo"
     assert builder.token_length == 17
+
+
+def test_messagebuilder_append_messages():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    builder.append_messages(
+        [
+            {"role": "user", "content": "Hello, how are you?"},
+            {"role": "assistant", "content": "You are a bot."},
+        ]
+    )
+    assert [m["role"] for m in builder.messages] == ["system", "user", "assistant"]
+    assert builder.token_length == 8 + 9 + 8
+
+
+def test_messagebuilder_append_history_fits():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    turns = [
+        # 9 tokens, 8 tokens
+        [{"role": "user", "content": "Hello, how are you?"}, {"role": "assistant", "content": "You are a bot."}],
+        # 9 tokens
+        [{"role": "user", "content": "Hello, how are you?"}],
+    ]
+    last_message = {"role": "user", "content": "Hello, how are you?"}
+    builder.append_history(turns, last_message, max_tokens=8 + 17 + 9 + 9)
+    assert builder.messages == [{"role": "system", "content": "You are a bot."}, *turns[0], *turns[1], last_message]
+    assert builder.token_length == 8 + 17 + 9 + 9
+
+
+def test_messagebuilder_append_history_drops_oldest_turns():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    turns = [
+        [{"role": "user", "content": "Hello, how are you?"}, {"role": "assistant", "content": "You are a bot."}],
+        [{"role": "user", "content": "Hello, how are you?"}, {"role": "assistant", "content": "You are a bot."}],
+        [{"role": "user", "content": "Hello, how are you?"}, {"role": "assistant", "content": "You are a bot."}],
+    ]
+    last_message = {"role": "user", "content": "Hello, how are you?"}
+    # One token short of fitting the two most recent turns
+    builder.append_history(turns, last_message, max_tokens=8 + 17 + 17 + 9 - 1)
+    assert builder.messages == [{"role": "system", "content": "You are a bot."}, *turns[2], last_message]
+    assert builder.token_length == 8 + 17 + 9
+    assert builder.token_length <= 8 + 17 + 17 + 9 - 1
+
+
+def test_messagebuilder_append_history_over_budget():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    turns = [[{"role": "user", "content": "Hello, how are you?"}]]
+    last_message = {"role": "user", "content": "Hello, how are you?"}
+    builder.append_history(turns, last_message, max_tokens=10)
+    assert builder.messages == [{"role": "system", "content": "You are a bot."}, last_message]
+    assert builder.token_length == 17
@@ -0,0 +1,135 @@
+import sqlite3
+import uuid
+
+import pytest
+from langchain.schema import Generation, LLMResult
+
+from core import tracing
+from core.metrics import MetricsRegistry, MetricsStore, RequestMetrics
+from core.tracing import RequestTrace
+from langchainadapters import TracingCallbackHandler
+
+
+@pytest.mark.asyncio
+async def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency.", ("stage",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, "search")
+    assert (await registry.render()).splitlines() == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{stage="search",le="0.1"} 1',
+        'latency_seconds_bucket{stage="search",le="1"} 3',
+        'latency_seconds_bucket{stage="search",le="+Inf"} 4',
+        'latency_seconds_sum{stage="search"} 4.25',
+        'latency_seconds_count{stage="search"} 4',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_counter_escapes_label_values():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "Requests.", ("approach",))
+    counter.inc('a"b\\c\n')
+    counter.inc('a"b\\c\n', amount=2)
+    assert 'requests_total{approach="a\\"b\\\\c\\n"} 3' in (await registry.render()).splitlines()
+
+
+@pytest.mark.asyncio
+async def test_track_records_trace():
+    metrics = RequestMetrics()
+    with metrics.track("ask", "rrr") as trace, trace.activate():
+        with tracing.stage("search"):
+            pass
+        with tracing.stage("search"):
+            pass
+        trace.add_usage({"prompt_tokens": 900, "completion_tokens": 50, "total_tokens": 950})
+        trace.add_agent_iteration()
+        trace.add_agent_iteration()
+    assert tracing.current_trace() is None
+    text = await metrics.registry.render()
+    assert 'app_requests_total{endpoint="ask",approach="rrr",status="ok"} 1' in text
+    assert 'app_stage_duration_seconds_count{endpoint="ask",approach="rrr",stage="search"} 1' in text
+    assert 'app_openai_tokens_total{endpoint="ask",approach="rrr",type="prompt"} 900' in text
+    assert 'app_openai_tokens_total{endpoint="ask",approach="rrr",type="completion"} 50' in text
+    assert 'app_agent_iterations_bucket{endpoint="ask",approach="rrr",le="2"} 1' in text
+    assert 'app_agent_iterations_bucket{endpoint="ask",approach="rrr",le="1"} 0' in text
+
+
+@pytest.mark.asyncio
+async def test_track_records_errors():
+    metrics = RequestMetrics()
+    with pytest.raises(ValueError):
+        with metrics.track("chat", "rrr"):
+            raise ValueError("failed")
+    text = await metrics.registry.render()
+    assert 'app_requests_total{endpoint="chat",approach="rrr",status="error"} 1' in text
+    assert "app_agent_iterations_count" not in text
+
+
+
+@pytest.mark.asyncio
+async def test_store_sums_the_metrics_of_every_worker(tmp_path):
+    # Two workers sharing the store, the second of which exited after its last flush
+    workers = [MetricsRegistry(MetricsStore(str(tmp_path / "metrics.sqlite3"))) for _ in range(2)]
+    for registry in workers:
+        registry.counter("requests_total", "Requests.", ("approach",)).inc("rrr")
+        histogram = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+    await workers[1].close()
+    lines = (await workers[0].render()).splitlines()
+    assert 'requests_total{approach="rrr"} 2' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert "latency_seconds_sum 1.1" in lines
+    assert "latency_seconds_count 4" in lines
+    # Flushed values are added only once
+    assert await workers[0].render() == await workers[1].render()
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_retried(tmp_path, monkeypatch):
+    store = MetricsStore(str(tmp_path / "metrics.sqlite3"))
+    registry = MetricsRegistry(store)
+    counter = registry.counter("requests_total", "Requests.")
+    counter.inc()
+
+    def locked(pending):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(store, "add", locked)
+    await registry.flush()
+    counter.inc()
+    monkeypatch.undo()
+    assert "requests_total 2" in (await registry.render()).splitlines()
+
+
+def test_stage_without_trace():
+    with tracing.stage("search"):
+        pass
+    assert tracing.current_trace() is None
+
+
+def test_server_timing():
+    trace = RequestTrace()
+    trace.add_span("search", 0.05)
+    trace.add_span("completion", 1.2)
+    trace.add_span("search", 0.025)
+    assert trace.server_timing() == "search;dur=75.0, completion;dur=1200.0"
+
+
+def test_tracing_callback_handler():
+    trace = RequestTrace()
+    handler = TracingCallbackHandler(trace)
+    for _ in range(2):
+        run_id = uuid.uuid4()
+        handler.on_llm_start({}, ["prompt"], run_id=run_id)
+        handler.on_llm_end(LLMResult(generations=[[Generation(text="Action: Search[eye exams]")]],
+                                     llm_output={"token_usage": {"prompt_tokens": 300, "completion_tokens": 20}}), run_id=run_id)
+    run_id = uuid.uuid4()
+    handler.on_llm_start({}, ["prompt"], run_id=run_id)
+    handler.on_llm_error(TimeoutError(), run_id=run_id)
+    assert [name for name, _ in trace.spans] == ["completion"] * 3
+    assert (trace.prompt_tokens, trace.completion_tokens, trace.agent_iterations) == (600, 40, 2)
@@ -1,9 +1,12 @@
 import pytest
 
+from core import modelhelper
 from core.modelhelper import (
+    get_encoding,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
+    num_tokens_from_messages_batch,
 )
 
 
@@ -43,6 +46,42 @@ def test_num_tokens_from_messages_gpt4():
     assert num_tokens_from_messages(message, model) == 9
 
 
+def test_num_tokens_from_messages_batch():
+    messages = [
+        # 1 token : 1 token, 1 token : 5 tokens
+        {"role": "user", "content": "Hello, how are you?"},
+        # 1 token : 1 token, 1 token : 5 tokens
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "Hello, how are you?"},
+    ]
+    assert num_tokens_from_messages_batch(messages, "gpt-35-turbo") == [9, 8, 9]
+    assert num_tokens_from_messages_batch([], "gpt-35-turbo") == []
+
+
+def test_num_tokens_from_messages_cached(monkeypatch):
+    message = {"role": "user", "content": "Is this counted twice?"}
+    first = num_tokens_from_messages(message, "gpt-35-turbo")
+
+    def fail_encode(text):
+        raise AssertionError(f"{text} was encoded again")
+
+    monkeypatch.setattr(get_encoding("gpt-35-turbo"), "encode", fail_encode)
+    assert num_tokens_from_messages(message, "gpt-35-turbo") == first
+    assert num_tokens_from_messages_batch([message, message], "gpt-35-turbo") == [first, first]
+
+
+def test_num_tokens_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(modelhelper, "TOKEN_COUNT_CACHE_SIZE", 2)
+    for i in range(5):
+        num_tokens_from_messages({"role": "user", "content": f"message {i}"}, "gpt-4")
+    assert len(modelhelper._token_counts) == 2
+
+
+def test_get_encoding_is_shared():
+    assert get_encoding("gpt-35-turbo") is get_encoding("gpt-35-turbo")
+    assert get_encoding("gpt-35-turbo").name == "cl100k_base"
+
+
 def test_get_oai_chatmodel_tiktok_mapped():
     assert get_oai_chatmodel_tiktok("gpt-35-turbo") == "gpt-3.5-turbo"
     assert get_oai_chatmodel_tiktok("gpt-35-turbo-16k") == "gpt-3.5-turbo-16k"
@@ -1,3 +1,8 @@
+import argparse
+import os
+
+import scripts.prepdocs as prepdocs
+from azure.ai.formrecognizer import AnalyzeResult, DocumentPage, DocumentSpan
 from scripts.prepdocs import filename_to_id
 
 
@@ -8,3 +13,156 @@ def test_filename_to_id():
     assert filename_to_id("foo\u00A9.txt") == "file-foo__txt-666F6FC2A92E747874"
     # test filenaming starting with unicode
     assert filename_to_id("ファイル名.pdf") == "file-______pdf-E38395E382A1E382A4E383ABE5908D2E706466"
+
+
+def test_extract_files_in_worker_processes(monkeypatch):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(localpdfparser=True, verbose=False, category="benefits", workers=2), raising=False)
+    data = os.path.join(os.path.dirname(__file__), "..", "data")
+    filenames = [os.path.join(data, name) for name in ("PerksPlus.pdf", "employee_handbook.pdf", "missing.pdf")]
+    results = {filename: (pages, error) for filename, pages, error in prepdocs.extract_files(filenames)}
+    assert set(results) == set(filenames)
+
+    pages, error = results[filenames[0]]
+    assert error is None
+    sections = prepdocs.create_sections("PerksPlus.pdf", pages)
+    assert sections[0]["id"] == prepdocs.filename_to_id("PerksPlus.pdf") + "-page-0"
+    assert sections[0]["sourcepage"] == "PerksPlus-0.pdf"
+    assert sections[0]["category"] == "benefits"
+    assert "embedding" not in sections[0]
+
+    # errors are reported per file
+    pages, error = results[filenames[2]]
+    assert pages is None
+    assert isinstance(error, FileNotFoundError)
+
+    # same pages as when extracting in this process
+    monkeypatch.setattr(prepdocs.args, "workers", 1)
+    assert dict((f, p) for f, p, _ in prepdocs.extract_files(filenames[:2])) == {f: results[f][0] for f in filenames[:2]}
+
+
+def test_analyze_document_uses_cached_results(monkeypatch, tmp_path):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(localpdfparser=False, analysiscache=str(tmp_path), formrecognizerservice="test", verbose=False), raising=False)
+    monkeypatch.setattr(prepdocs, "formrecognizer_creds", None, raising=False)
+    analyzed = []
+
+    class MockPoller:
+        def result(self):
+            return AnalyzeResult(api_version="2022-08-31", model_id="prebuilt-layout", content="Benefits",
+                                 pages=[DocumentPage(page_number=1, spans=[DocumentSpan(offset=0, length=8)], lines=[], words=[], selection_marks=[])], tables=[])
+
+    class MockDocumentAnalysisClient:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def begin_analyze_document(self, model_id, document):
+            analyzed.append((model_id, document.read()))
+            return MockPoller()
+
+    monkeypatch.setattr(prepdocs, "DocumentAnalysisClient", MockDocumentAnalysisClient)
+    filename = tmp_path / "benefits.pdf"
+    filename.write_bytes(b"benefits")
+
+    assert prepdocs.get_document_text(str(filename)) == [(0, 0, "Benefits ")]
+    assert prepdocs.get_document_text(str(filename)) == [(0, 0, "Benefits ")]
+    assert analyzed == [("prebuilt-layout", b"benefits")]
+
+    # a changed file is analyzed again
+    filename.write_bytes(b"new benefits")
+    prepdocs.get_document_text(str(filename))
+    assert analyzed[1] == ("prebuilt-layout", b"new benefits")
+
+    # results of another service aren't reused, nor cached without --analysiscache
+    monkeypatch.setattr(prepdocs.args, "formrecognizerservice", "other")
+    prepdocs.get_document_text(str(filename))
+    assert len(analyzed) == 3
+    monkeypatch.setattr(prepdocs.args, "analysiscache", None)
+    prepdocs.get_document_text(str(filename))
+    prepdocs.get_document_text(str(filename))
+    assert len(analyzed) == 5
+
+
+def test_ingest_files(monkeypatch, capsys):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(localpdfparser=True, verbose=False, category=None, workers=1, skipblobs=True, searchservice="test"), raising=False)
+    monkeypatch.setattr(prepdocs, "manifest", None, raising=False)
+    monkeypatch.setattr(prepdocs, "local_index", None, raising=False)
+    monkeypatch.setattr(prepdocs, "use_vectors", False, raising=False)
+    indexed = {}
+    monkeypatch.setattr(prepdocs, "index_sections", lambda name, sections: indexed.setdefault(name, sections))
+    data = os.path.join(os.path.dirname(__file__), "..", "data")
+    filenames = [os.path.join(data, name) for name in ("PerksPlus.pdf", "missing.pdf", "employee_handbook.pdf")]
+
+    results = {job["filename"]: (job, error) for job, error in prepdocs.ingest_files(filenames)}
+    assert results[filenames[0]][1] is None
+    assert isinstance(results[filenames[1]][1], FileNotFoundError)
+    assert results[filenames[2]][1] is None
+    assert set(indexed) == {"PerksPlus.pdf", "employee_handbook.pdf"}
+    assert indexed["PerksPlus.pdf"] == results[filenames[0]][0]["sections"]
+    report = capsys.readouterr().out
+    assert "extract: 2 items" in report and "1 failed" in report
+    assert "split: 2 items" in report
+    assert "index: 2 items" in report
+
+
+def test_bump_index_generation(monkeypatch):
+    class MockContainerClient:
+        def __init__(self):
+            self.metadata = {"other": "1"}
+
+        def get_container_properties(self):
+            return argparse.Namespace(metadata=dict(self.metadata))
+
+        def set_container_metadata(self, metadata):
+            self.metadata = metadata
+
+    container_client = MockContainerClient()
+    blob_manager = argparse.Namespace(container_client=container_client, ensure_container=lambda: None)
+    monkeypatch.setattr(prepdocs, "blob_manager", blob_manager, raising=False)
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(index="gptkb-index", storageaccount="account", container="content", verbose=False), raising=False)
+    prepdocs.bump_index_generation()
+    assert set(container_client.metadata) == {"other", "indexgeneration_gptkb_index"}
+
+    # a run writing only a local index has no search index generation to update
+    container_client.metadata = {"other": "1"}
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(index=None, localindex="localindex", storageaccount="account", container="content", verbose=False), raising=False)
+    prepdocs.bump_index_generation()
+    assert container_client.metadata == {"other": "1"}
+
+
+def test_index_file_reuses_search_indexer(monkeypatch):
+    class MockSearchIndexer:
+        def __init__(self):
+            self.calls = []
+
+        def upload_documents(self, documents):
+            self.calls.append(("upload", [doc["id"] for doc in documents]))
+
+        def delete_documents(self, ids):
+            self.calls.append(("delete", ids))
+
+    search_indexer = MockSearchIndexer()
+    monkeypatch.setattr(prepdocs, "search_indexer", search_indexer, raising=False)
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(searchservice="test", index="gptkbindex", verbose=False), raising=False)
+    monkeypatch.setattr(prepdocs, "manifest", None, raising=False)
+    monkeypatch.setattr(prepdocs, "local_index", None, raising=False)
+    for name in ("a.pdf", "b.pdf"):
+        prepdocs.index_file({"name": name, "changed": [{"id": f"{name}-0"}], "removed": [f"{name}-1"]})
+    assert search_indexer.calls == [("upload", ["a.pdf-0"]), ("delete", ["a.pdf-1"]), ("upload", ["b.pdf-0"]), ("delete", ["b.pdf-1"])]
+
+
+def test_ingest_files_reuses_file_hashes(monkeypatch, tmp_path):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(localpdfparser=True, verbose=False, category=None, workers=1, skipblobs=True, searchservice="test"), raising=False)
+    monkeypatch.setattr(prepdocs, "manifest", prepdocs.Manifest(str(tmp_path / "manifest.json"), "gptkbindex", {}), raising=False)
+    monkeypatch.setattr(prepdocs, "local_index", None, raising=False)
+    monkeypatch.setattr(prepdocs, "use_vectors", False, raising=False)
+    monkeypatch.setattr(prepdocs, "index_sections", lambda name, sections: None)
+    filename = os.path.join(os.path.dirname(__file__), "..", "data", "PerksPlus.pdf")
+    file_hashes = {filename: prepdocs.Manifest.file_hash(filename)}
+
+    def file_hash(filename):
+        raise AssertionError(f"{filename} hashed again")
+
+    monkeypatch.setattr(prepdocs.Manifest, "file_hash", staticmethod(file_hash))
+    [(job, error)] = list(prepdocs.ingest_files([filename], file_hashes))
+    assert error is None
+    assert job["file_hash"] == file_hashes[filename]
+    assert prepdocs.manifest.is_unchanged("PerksPlus.pdf", file_hashes[filename])
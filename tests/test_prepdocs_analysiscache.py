@@ -0,0 +1,47 @@
+from azure.ai.formrecognizer import (
+    AnalyzeResult,
+    BoundingRegion,
+    DocumentPage,
+    DocumentSpan,
+    DocumentTable,
+    DocumentTableCell,
+)
+
+from prepdocslib.analysiscache import AnalysisCache
+
+
+def make_result():
+    cell = DocumentTableCell(kind="columnHeader", row_index=0, column_index=0, row_span=1, column_span=1, content="Plan", bounding_regions=[], spans=[])
+    table = DocumentTable(row_count=1, column_count=1, cells=[cell], bounding_regions=[BoundingRegion(page_number=1, polygon=[])], spans=[DocumentSpan(offset=9, length=4)])
+    page = DocumentPage(page_number=1, spans=[DocumentSpan(offset=0, length=13)], lines=[], words=[], selection_marks=[])
+    return AnalyzeResult(api_version="2022-08-31", model_id="prebuilt-layout", content="Benefits\nPlan", pages=[page], tables=[table])
+
+
+def test_cached_result_round_trip(tmp_path):
+    cache = AnalysisCache(str(tmp_path / "cache"))
+    assert cache.get("abc", "prebuilt-layout") is None
+
+    cache.set("abc", "prebuilt-layout", make_result())
+    result = cache.get("abc", "prebuilt-layout")
+    assert result.content == "Benefits\nPlan"
+    assert result.pages[0].spans[0].offset == 0
+    assert result.pages[0].spans[0].length == 13
+    assert result.tables[0].bounding_regions[0].page_number == 1
+    assert result.tables[0].cells[0].kind == "columnHeader"
+    assert result.tables[0].spans[0].offset == 9
+    # no temporary files left behind
+    assert [path.name for path in (tmp_path / "cache").iterdir()] == ["prebuilt-layout-abc.json"]
+
+
+def test_results_keyed_by_file_hash_and_model(tmp_path):
+    cache = AnalysisCache(str(tmp_path))
+    cache.set("abc", "prebuilt-layout", make_result())
+    assert cache.get("abd", "prebuilt-layout") is None
+    assert cache.get("abc", "prebuilt-read") is None
+
+
+def test_unreadable_result_is_a_miss(tmp_path):
+    cache = AnalysisCache(str(tmp_path))
+    with open(cache.path("abc", "prebuilt-layout"), "w") as f:
+        f.write('{"pages": [')
+    assert cache.get("abc", "prebuilt-layout") is None
@@ -0,0 +1,106 @@
+import io
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+from pypdf import PdfReader
+
+from prepdocslib.blobmanager import BlobManager
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data")
+
+
+class MockContainerClient:
+    def __init__(self, upload_delay=0):
+        self.blobs = {}
+        self.created = False
+        self.exists_calls = 0
+        self.uploads = []
+        self.upload_delay = upload_delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def exists(self):
+        self.exists_calls += 1
+        return self.created
+
+    def create_container(self):
+        self.created = True
+
+    def list_blobs(self, name_starts_with=""):
+        return [SimpleNamespace(name=name, content_settings=settings) for name, (_, settings) in self.blobs.items() if name.startswith(name_starts_with)]
+
+    def list_blob_names(self, name_starts_with=""):
+        return [name for name in self.blobs if name.startswith(name_starts_with)]
+
+    def upload_blob(self, name, data, overwrite, content_settings):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.upload_delay)
+        with self.lock:
+            self.in_flight -= 1
+            self.uploads.append(name)
+            self.blobs[name] = (data, content_settings)
+
+    def delete_blob(self, name):
+        with self.lock:
+            del self.blobs[name]
+
+
+def test_upload_pdf_pages_concurrently():
+    container = MockContainerClient(upload_delay=0.01)
+    manager = BlobManager(container, max_concurrency=3)
+    filename = os.path.join(DATA, "employee_handbook.pdf")
+    pages = len(PdfReader(filename).pages)
+
+    assert manager.upload_file(filename) == pages
+    assert sorted(container.uploads) == sorted(f"employee_handbook-{i}.pdf" for i in range(pages))
+    assert 1 < container.max_in_flight <= 3
+    data, settings = container.blobs["employee_handbook-0.pdf"]
+    assert settings.content_type == "application/pdf"
+    assert len(PdfReader(io.BytesIO(data)).pages) == 1
+
+
+def test_skip_unchanged_blobs():
+    container = MockContainerClient()
+    manager = BlobManager(container)
+    filename = os.path.join(DATA, "PerksPlus.pdf")
+    uploaded = manager.upload_file(filename)
+    assert uploaded > 0
+
+    container.uploads.clear()
+    assert manager.upload_file(filename) == 0
+    assert container.uploads == []
+
+    # a page whose content differs is uploaded again
+    data, settings = container.blobs["PerksPlus-0.pdf"]
+    container.blobs["PerksPlus-0.pdf"] = (b"old", SimpleNamespace(content_md5=bytearray(b"0" * 16)))
+    assert manager.upload_file(filename) == 1
+    assert container.uploads == ["PerksPlus-0.pdf"]
+    assert container.blobs["PerksPlus-0.pdf"][0] == data
+
+
+def test_container_created_once():
+    container = MockContainerClient()
+    manager = BlobManager(container)
+    manager.upload_file(os.path.join(DATA, "PerksPlus.pdf"))
+    manager.upload_file(os.path.join(DATA, "PerksPlus.pdf"))
+    assert container.exists_calls == 1
+
+
+def test_remove_file_blobs():
+    container = MockContainerClient()
+    manager = BlobManager(container, max_concurrency=2)
+    manager.upload_file(os.path.join(DATA, "PerksPlus.pdf"))
+    container.blobs["PerksPlus-report.txt"] = (b"", SimpleNamespace(content_md5=None))
+    container.blobs["Benefits-0.pdf"] = (b"", SimpleNamespace(content_md5=None))
+    pages = len(PdfReader(os.path.join(DATA, "PerksPlus.pdf")).pages)
+
+    assert manager.remove_file("PerksPlus.pdf") == pages
+    assert sorted(container.blobs) == ["Benefits-0.pdf", "PerksPlus-report.txt"]
+
+    assert manager.remove_file(None) == 2
+    assert container.blobs == {}
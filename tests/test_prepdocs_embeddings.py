@@ -0,0 +1,74 @@
+import threading
+import time
+
+import openai
+import pytest
+from tenacity import wait_random_exponential
+
+from prepdocslib.embeddings import BatchEmbedder, TokenBucket
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    requests = []
+    lock = threading.Lock()
+
+    def mock_create(engine, input):
+        with lock:
+            requests.append(list(input))
+        # return the embeddings out of order, with their index
+        return {"data": [{"index": i, "embedding": [float(len(text))]} for i, text in reversed(list(enumerate(input)))]}
+
+    monkeypatch.setattr(openai.Embedding, "create", mock_create)
+    return requests
+
+
+def test_embed_packs_texts_into_batches(requests):
+    texts = [f"section {i} " * (i + 1) for i in range(40)]
+    embedder = BatchEmbedder("embedding", max_batch_size=16)
+    assert embedder.embed(texts) == [[float(len(text))] for text in texts]
+    assert sorted(len(r) for r in requests) == [8, 16, 16]
+    assert sorted(text for r in requests for text in r) == sorted(texts)
+
+
+def test_create_batches_respects_token_limit():
+    embedder = BatchEmbedder("embedding", max_batch_tokens=10)
+    texts = [" ".join(["word"] * n) for n in (4, 4, 4, 20, 1)]
+    assert [indexes for indexes, _ in embedder.create_batches(texts)] == [[0, 1], [2], [3], [4]]
+    assert [tokens for _, tokens in embedder.create_batches(texts)] == [8, 4, 20, 1]
+
+
+def test_embed_no_texts(requests):
+    assert BatchEmbedder("embedding").embed([]) == []
+    assert requests == []
+
+
+def test_embed_retries_rate_limited_requests(requests, monkeypatch):
+    create = openai.Embedding.create
+    failures = [openai.error.RateLimitError("Too many requests")]
+
+    def mock_create(engine, input):
+        if failures:
+            raise failures.pop()
+        return create(engine=engine, input=input)
+
+    monkeypatch.setattr(openai.Embedding, "create", mock_create)
+    monkeypatch.setattr(wait_random_exponential, "__call__", lambda self, retry_state: 0)
+    assert BatchEmbedder("embedding").embed(["a", "bb"]) == [[1.0], [2.0]]
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(per_minute=600, capacity=10)
+    start = time.monotonic()
+    for _ in range(10):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+    bucket.acquire(3)
+    # 10 units a second, so 3 more units take about 0.3s
+    assert 0.25 < time.monotonic() - start < 0.6
+
+
+def test_token_bucket_caps_large_requests():
+    bucket = TokenBucket(per_minute=6000, capacity=10)
+    bucket.acquire(1000)
+    assert bucket.available == 0
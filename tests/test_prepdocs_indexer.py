@@ -0,0 +1,168 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+from prepdocslib.indexer import IndexingError, SearchIndexer
+
+
+def make_documents(count, embedding_size=10, sourcefile="a.pdf"):
+    return [{"id": f"doc-{i}", "content": "text", "sourcefile": sourcefile, "embedding": [0.1] * embedding_size} for i in range(count)]
+
+
+class MockSearchClient:
+    def __init__(self, failures=None, errors=None, delay=0, search_lag=0):
+        # failures: key -> list of status codes returned on successive attempts; errors: list of status codes raised for whole requests
+        self.failures = failures or {}
+        self.errors = errors or []
+        self.delay = delay
+        self.requests = []
+        self.indexed = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.search_lag = search_lag
+        self.searches = []
+        self.deleted = {}
+
+    def search(self, search_text, filter, select, top):
+        self.searches.append((filter, select, top))
+        # deleted documents stay in search results for a few searches
+        for key in [key for key, searches in self.deleted.items() if searches == 0]:
+            del self.deleted[key]
+        for key in self.deleted:
+            self.deleted[key] -= 1
+        keys = sorted(key for key, document in self.indexed.items() if filter is None or document["sourcefile"] == filter) + sorted(self.deleted)
+        return [{select[0]: key} for key in keys[:top]]
+
+    def delete_documents(self, documents):
+        with self.lock:
+            self.requests.append([d["id"] for d in documents])
+            for document in documents:
+                if self.indexed.pop(document["id"], None) is not None:
+                    self.deleted[document["id"]] = self.search_lag
+        return [SimpleNamespace(key=document["id"], succeeded=True, status_code=200, error_message=None) for document in documents]
+
+    def upload_documents(self, documents):
+        with self.lock:
+            self.requests.append([d["id"] for d in documents])
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            error = self.errors.pop(0) if self.errors else None
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        if error is not None:
+            e = HttpResponseError(message=f"error {error}")
+            e.status_code = error
+            raise e
+        results = []
+        for document in documents:
+            codes = self.failures.get(document["id"])
+            status_code = codes.pop(0) if codes else 201
+            if status_code < 300:
+                self.indexed[document["id"]] = document
+            results.append(SimpleNamespace(key=document["id"], succeeded=status_code < 300, status_code=status_code, error_message=None if status_code < 300 else "failed"))
+        return results
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(SearchIndexer, "backoff", lambda self, attempt: None)
+
+
+def test_batches_sized_by_bytes():
+    documents = [{**document, "id": f"doc-{i:03}"} for i, document in enumerate(make_documents(100, embedding_size=1536))]
+    document_bytes = len(json.dumps(documents[0]).encode())
+    indexer = SearchIndexer(MockSearchClient(), max_batch_bytes=10 * document_bytes)
+    batches = indexer.create_batches(documents)
+    assert [len(batch) for batch in batches] == [10] * 10
+    assert [d for batch in batches for d in batch] == documents
+
+    indexer = SearchIndexer(MockSearchClient(), max_batch_size=30)
+    assert [len(batch) for batch in indexer.create_batches(documents)] == [30, 30, 30, 10]
+
+
+def test_batches_sent_concurrently():
+    search_client = MockSearchClient(delay=0.02)
+    indexer = SearchIndexer(search_client, max_batch_size=10, max_concurrency=3)
+    assert indexer.upload_documents(make_documents(100)) == 100
+    assert len(search_client.indexed) == 100
+    assert 1 < search_client.max_in_flight <= 3
+
+
+def test_only_failed_documents_retried():
+    search_client = MockSearchClient(failures={"doc-3": [503, 503], "doc-7": [409]})
+    indexer = SearchIndexer(search_client)
+    indexer.upload_documents(make_documents(10))
+    assert search_client.requests == [[f"doc-{i}" for i in range(10)], ["doc-3", "doc-7"], ["doc-3"]]
+    assert len(search_client.indexed) == 10
+
+
+def test_failed_documents_reported():
+    # doc-1 fails for good, doc-2 keeps being throttled
+    search_client = MockSearchClient(failures={"doc-1": [400], "doc-2": [503] * 5})
+    indexer = SearchIndexer(search_client, max_attempts=3)
+    with pytest.raises(IndexingError) as e:
+        indexer.upload_documents(make_documents(5))
+    assert set(e.value.failed) == {"doc-1", "doc-2"}
+    assert search_client.requests[1:] == [["doc-2"], ["doc-2"]]
+
+
+def test_failed_request_retried():
+    search_client = MockSearchClient(errors=[503])
+    indexer = SearchIndexer(search_client)
+    indexer.upload_documents(make_documents(5))
+    assert len(search_client.requests) == 2
+    assert len(search_client.indexed) == 5
+
+
+def test_request_too_large_split():
+    search_client = MockSearchClient(errors=[413])
+    indexer = SearchIndexer(search_client)
+    indexer.upload_documents(make_documents(6))
+    assert search_client.requests[1:] == [["doc-0", "doc-1", "doc-2"], ["doc-3", "doc-4", "doc-5"]]
+    assert len(search_client.indexed) == 6
+
+
+def test_remove_documents_by_key(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("prepdocslib.indexer.time.sleep", sleeps.append)
+    search_client = MockSearchClient(search_lag=2)
+    indexer = SearchIndexer(search_client, max_batch_size=100)
+    indexer.upload_documents(make_documents(250, sourcefile="a.pdf"))
+    indexer.upload_documents([{**d, "id": "b" + d["id"]} for d in make_documents(10, sourcefile="b.pdf")])
+    search_client.requests.clear()
+
+    assert indexer.remove_documents("a.pdf") == 250
+    assert sorted(search_client.indexed) == sorted(f"bdoc-{i}" for i in range(10))
+    # only the keys are searched, deleted in batches, and the search is repeated until deleted documents are gone
+    assert all(select == ["id"] for _, select, _ in search_client.searches)
+    assert [len(r) for r in search_client.requests] == [100, 100, 50]
+    assert len(sleeps) == 2
+
+    assert indexer.remove_documents(None) == 10
+    assert search_client.indexed == {}
+
+
+def test_remove_known_keys_first():
+    search_client = MockSearchClient()
+    indexer = SearchIndexer(search_client)
+    indexer.upload_documents(make_documents(5))
+    search_client.requests.clear()
+
+    assert indexer.remove_documents("a.pdf", known_keys=["doc-0", "doc-1"]) == 5
+    assert search_client.requests == [["doc-0", "doc-1"], ["doc-2", "doc-3", "doc-4"]]
+
+
+def test_remove_more_documents_than_a_search_returns():
+    search_client = MockSearchClient()
+    indexer = SearchIndexer(search_client, max_search_results=40)
+    indexer.upload_documents(make_documents(100))
+    assert indexer.remove_documents(None) == 100
+    assert search_client.indexed == {}
+    assert len(search_client.searches) == 4
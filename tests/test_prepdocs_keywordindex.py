@@ -0,0 +1,30 @@
+import numpy as np
+
+from prepdocslib.keywordindex import build_keyword_index, tokenize
+
+
+def test_tokenize():
+    assert tokenize("Northwind Health PLUS covers eye-exams, ﬁllings: $50.") == ["northwind", "health", "plus", "covers", "eye", "exams", "fillings", "50"]
+
+
+def test_build_keyword_index():
+    index = build_keyword_index(["eye exams eye", "dental exams", "vision"])
+    terms = index["terms"].tolist()
+    assert terms == ["dental", "exams", "eye", "vision"]
+
+    def postings(term):
+        i = terms.index(term)
+        start, end = index["offsets"][i], index["offsets"][i + 1]
+        return index["postings_docs"][start:end].tolist(), index["postings_tf"][start:end].tolist()
+
+    assert postings("exams") == ([0, 1], [1.0, 1.0])
+    assert postings("eye") == ([0], [2.0])
+    assert postings("vision") == ([2], [1.0])
+    assert index["doc_lengths"].tolist() == [3, 2, 1]
+    assert np.allclose(index["idf"][terms.index("exams")], np.log(1 + (3 - 2 + 0.5) / (2 + 0.5)))
+
+
+def test_build_empty_keyword_index():
+    index = build_keyword_index([])
+    assert index["offsets"].tolist() == [0]
+    assert len(index["postings_docs"]) == 0
@@ -0,0 +1,58 @@
+import json
+
+from prepdocslib.manifest import Manifest
+
+OPTIONS = {"category": None, "localpdfparser": True, "vectors": True, "openaideployment": "embedding"}
+
+
+def sections(*contents):
+    return [{"id": f"file-a-page-{i}", "content": content, "sourcepage": "a-0.pdf", "sourcefile": "a.pdf"} for i, content in enumerate(contents)]
+
+
+def test_unchanged_file_is_skipped(tmp_path):
+    (tmp_path / "a.pdf").write_bytes(b"version 1")
+    manifest = Manifest(str(tmp_path / "manifest.json"), "index", OPTIONS)
+    file_hash = manifest.file_hash(str(tmp_path / "a.pdf"))
+    assert not manifest.is_unchanged("a.pdf", file_hash)
+    manifest.update("a.pdf", file_hash, sections("one", "two"))
+
+    # the manifest is saved after every file, a new run starts where the previous one stopped
+    manifest = Manifest(str(tmp_path / "manifest.json"), "index", OPTIONS)
+    assert manifest.is_unchanged("a.pdf", file_hash)
+    (tmp_path / "a.pdf").write_bytes(b"version 2")
+    assert not manifest.is_unchanged("a.pdf", manifest.file_hash(str(tmp_path / "a.pdf")))
+
+
+def test_diff_sections(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.json"), "index", OPTIONS)
+    manifest.update("a.pdf", "hash1", sections("one", "two", "three"))
+    changed, removed = manifest.diff("a.pdf", sections("one", "2"))
+    assert [section["content"] for section in changed] == ["2"]
+    assert removed == ["file-a-page-2"]
+    # embeddings are not part of the section hash
+    assert manifest.diff("a.pdf", [{**section, "embedding": [1.0]} for section in sections("one", "two", "three")]) == ([], [])
+
+
+def test_options_change_reprocesses_everything(tmp_path):
+    Manifest(str(tmp_path / "manifest.json"), "index", OPTIONS).update("a.pdf", "hash1", sections("one", "two"))
+    manifest = Manifest(str(tmp_path / "manifest.json"), "index", {**OPTIONS, "category": "benefits"})
+    assert not manifest.is_unchanged("a.pdf", "hash1")
+    changed, removed = manifest.diff("a.pdf", sections("one"))
+    assert len(changed) == 1
+    assert removed == ["file-a-page-1"]
+
+
+def test_manifest_of_other_index_is_ignored(tmp_path):
+    Manifest(str(tmp_path / "manifest.json"), "index", OPTIONS).update("a.pdf", "hash1", sections("one"))
+    assert not Manifest(str(tmp_path / "manifest.json"), "other", OPTIONS).is_unchanged("a.pdf", "hash1")
+
+
+def test_remove(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.json"), "index", OPTIONS)
+    manifest.update("a.pdf", "hash1", sections("one"))
+    manifest.update("b.pdf", "hash2", sections("two"))
+    manifest.remove("a.pdf")
+    assert list(json.loads((tmp_path / "manifest.json").read_text())["files"]) == ["b.pdf"]
+    manifest.remove()
+    assert json.loads((tmp_path / "manifest.json").read_text())["files"] == {}
+    assert not (tmp_path / "manifest.json.tmp").exists()
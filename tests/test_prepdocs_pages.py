@@ -0,0 +1,49 @@
+import random
+from types import SimpleNamespace
+
+from benchmarks.page_assembly import (
+    generate_document,
+    reference_build_page_text,
+    reference_table_to_html,
+)
+from scripts.prepdocs import build_page_text, table_to_html
+
+
+def make_table(spans, rows=2, columns=2):
+    cells = [SimpleNamespace(row_index=row, column_index=column, kind="columnHeader" if row == 0 else "content",
+                             column_span=1, row_span=1, content=f"<{row},{column}>")
+             for row in range(rows) for column in range(columns)]
+    return SimpleNamespace(row_count=rows, cells=cells[::-1], spans=[SimpleNamespace(offset=offset, length=length) for offset, length in spans])
+
+
+def test_table_to_html_same_as_reference():
+    _, document_pages = generate_document(pages=3, tables=4, rows=5)
+    for _, _, tables in document_pages:
+        for table in tables:
+            assert table_to_html(table) == reference_table_to_html(table)
+
+
+def test_table_to_html_escapes_and_sorts_cells():
+    table = make_table([(0, 1)])
+    assert table_to_html(table) == "<table><tr><th>&lt;0,0&gt;</th><th>&lt;0,1&gt;</th></tr><tr><td>&lt;1,0&gt;</td><td>&lt;1,1&gt;</td></tr></table>"
+
+
+def test_same_page_text_as_reference_on_generated_document():
+    content, document_pages = generate_document(pages=10, tables=3, rows=4)
+    for page_offset, page_length, tables in document_pages:
+        assert build_page_text(content, page_offset, page_length, tables) == reference_build_page_text(content, page_offset, page_length, tables)
+
+
+def test_same_page_text_as_reference_with_overlapping_spans():
+    # Spans that overlap each other, cross the page edges, are empty, or are outside the page
+    rng = random.Random(7)
+    content = "".join(rng.choice("abc .\n") for _ in range(400))
+    for _ in range(200):
+        page_offset = rng.randint(0, 200)
+        page_length = rng.randint(0, 200)
+        tables = [make_table([(rng.randint(0, 400), rng.randint(0, 60)) for _ in range(rng.randint(1, 3))]) for _ in range(rng.randint(0, 4))]
+        assert build_page_text(content, page_offset, page_length, tables) == reference_build_page_text(content, page_offset, page_length, tables)
+
+
+def test_page_text_without_tables():
+    assert build_page_text("first page. second page.", 12, 12, []) == "second page."
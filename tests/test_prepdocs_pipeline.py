@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+
+from prepdocslib.pipeline import Pipeline, PipelineStage
+
+
+def source(items):
+    for item in items:
+        yield item, None
+
+
+def test_items_go_through_all_stages():
+    pipeline = Pipeline("source", [PipelineStage("double", lambda x: x * 2), PipelineStage("increment", lambda x: x + 1)])
+    assert sorted(pipeline.run(source(range(10)))) == [(x * 2 + 1, None) for x in range(10)]
+    assert pipeline.source.items == 10
+    assert [stage.items for stage in pipeline.stages] == [10, 10]
+
+
+def test_stages_run_at_the_same_time():
+    def slow(x):
+        time.sleep(0.05)
+        return x
+
+    stages = [PipelineStage(name, slow) for name in ("a", "b", "c")]
+    start = time.perf_counter()
+    results = list(Pipeline("source", stages).run(source(range(6))))
+    elapsed = time.perf_counter() - start
+    assert [item for item, _ in results] == list(range(6))
+    # sequentially, 6 items through 3 stages would take 0.9s, overlapped it's about (6 + 2) * 0.05s
+    assert elapsed < 0.7
+    assert all(stage.busy >= 0.3 for stage in stages)
+
+
+def test_queues_are_bounded():
+    produced = []
+    release = threading.Event()
+
+    def produce():
+        for i in range(100):
+            produced.append(i)
+            yield i, None
+
+    def blocked(x):
+        release.wait()
+        return x
+
+    pipeline = Pipeline("source", [PipelineStage("blocked", blocked)], queue_size=2)
+    results = pipeline.run(produce())
+    thread = threading.Thread(target=lambda: results.__next__())
+    thread.start()
+    time.sleep(0.1)
+    # one item in the stage, two in its input queue, and one waiting to be put in the queue
+    assert len(produced) <= 4
+    release.set()
+    thread.join()
+    assert len(list(results)) == 99
+
+
+def test_failed_items_skip_next_stages():
+    calls = []
+
+    def fail_odd(x):
+        if x % 2:
+            raise ValueError(x)
+        return x
+
+    def record(x):
+        calls.append(x)
+        return x
+
+    pipeline = Pipeline("source", [PipelineStage("fail", fail_odd), PipelineStage("record", record)])
+    results = dict(pipeline.run([(0, None), (1, None), (2, None), (3, KeyError(3))]))
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], ValueError)
+    assert isinstance(results[3], KeyError)
+    assert sorted(calls) == [0, 2]
+    # failed items are counted apart from the throughput of the stages
+    assert (pipeline.source.items, pipeline.source.failures) == (3, 1)
+    assert (pipeline.stages[0].items, pipeline.stages[0].failures) == (2, 1)
+    assert (pipeline.stages[1].items, pipeline.stages[1].failures) == (2, 0)
+    assert pipeline.report()[1].endswith(", 1 failed")
+
+
+def test_stage_with_several_workers():
+    in_flight = []
+    lock = threading.Lock()
+    active = [0]
+
+    def work(x):
+        with lock:
+            active[0] += 1
+            in_flight.append(active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        return x
+
+    pipeline = Pipeline("source", [PipelineStage("work", work, workers=3)], queue_size=4)
+    assert sorted(item for item, _ in pipeline.run(source(range(12)))) == list(range(12))
+    assert max(in_flight) > 1
+
+
+def test_source_error_raised():
+    def broken():
+        yield 1, None
+        raise OSError("listing failed")
+
+    with pytest.raises(OSError):
+        list(Pipeline("source", [PipelineStage("noop", lambda x: x)]).run(broken()))
+
+
+def test_report():
+    pipeline = Pipeline("parse", [PipelineStage("index", lambda x: x)], size=lambda x: len(x))
+    list(pipeline.run(source(["abc", "de"])))
+    report = pipeline.report("sections")
+    assert report[0].startswith("parse: 2 items, 5 sections in ")
+    assert report[1].startswith("index: 2 items, 5 sections in ")
+
+
+def test_stage_size_and_unit():
+    pipeline = Pipeline("extract", [PipelineStage("split", lambda x: x.split())], size=lambda x: len(x), source_size=lambda x: 1, source_unit="pages")
+    list(pipeline.run(source(["a b c", "d e"])))
+    report = pipeline.report("sections")
+    assert report[0].startswith("extract: 2 items, 2 pages in ")
+    assert report[1].startswith("split: 2 items, 5 sections in ")
@@ -0,0 +1,60 @@
+import random
+
+from benchmarks.split_text import reference_split_text
+
+from prepdocslib.textsplitter import TextSplitter
+
+
+def page_map_from_texts(texts):
+    page_map = []
+    offset = 0
+    for page_num, text in enumerate(texts):
+        page_map.append((page_num, offset, text))
+        offset += len(text)
+    return page_map
+
+
+def split(page_map):
+    return list(TextSplitter(1000, 100, 100).split_pages(page_map))
+
+
+def test_same_sections_as_reference_on_random_text():
+    rng = random.Random(42)
+    words = ["benefits", "plan", "Northwind", "coverage", "deductible", "in-network", "(PPO)", "$500", "[1]", "e.g."]
+    for _ in range(30):
+        pages = []
+        for _ in range(rng.randint(1, 8)):
+            page = []
+            for _ in range(rng.randint(0, 600)):
+                page.append(rng.choice(words))
+                page.append(rng.choice([" ", " ", " ", ", ", ". ", "! ", "? ", "\n", ";", "\t", ""]))
+            pages.append("".join(page))
+        page_map = page_map_from_texts(pages)
+        assert split(page_map) == list(reference_split_text(page_map))
+
+
+def test_same_sections_as_reference_without_boundaries():
+    page_map = page_map_from_texts(["x" * 2500, "", "y" * 1500, "z" * 50])
+    assert split(page_map) == list(reference_split_text(page_map))
+
+
+def test_same_sections_as_reference_with_unclosed_tables():
+    table = "<table>" + "".join(f"<tr><td>Plan {i}</td><td>${i}00 copay</td></tr>" for i in range(40)) + "</table>"
+    text = ("Northwind Plus covers eye exams. " * 20 + table + " Some text after the table. ") * 5
+    page_map = page_map_from_texts([text[i:i + 1800] for i in range(0, len(text), 1800)])
+    sections = split(page_map)
+    assert sections == list(reference_split_text(page_map))
+    assert any(section.lstrip().startswith("<table>") for section, _ in sections)
+
+
+def test_page_of_sections():
+    page_map = page_map_from_texts(["First page. " * 100, "", "Third page. " * 100])
+    pages = [page for _, page in split(page_map)]
+    assert pages == [page for _, page in reference_split_text(page_map)]
+    assert pages[0] == 0
+    assert pages[-1] == 2
+
+
+def test_same_sections_as_reference_with_lone_surrogates():
+    page_map = page_map_from_texts(["Northwind Plus \ud800covers eye exams. " * 60, "Deductibles\udfff apply. " * 60])
+    assert split(page_map) == list(reference_split_text(page_map))
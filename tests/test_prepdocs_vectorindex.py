@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+
+from prepdocslib.vectorindex import VectorIndexWriter
+
+
+def section(id, embedding, sourcefile="a.pdf", category=None):
+    return {"id": id, "content": f"content of {id}", "category": category, "sourcepage": f"{sourcefile}-0", "sourcefile": sourcefile, "embedding": embedding}
+
+
+def test_save_normalizes_embeddings(tmp_path):
+    writer = VectorIndexWriter(str(tmp_path), dtype="float32")
+    writer.upsert([section("a-0", [3.0, 4.0]), section("a-1", [0.0, 0.0])])
+    writer.save()
+
+    metadata = json.loads((tmp_path / "index.json").read_text())
+    assert metadata["dimensions"] == 2
+    assert [s["id"] for s in metadata["sections"]] == ["a-0", "a-1"]
+    assert "embedding" not in metadata["sections"][0]
+    matrix = np.load(tmp_path / metadata["matrix"])
+    assert matrix.dtype == np.float32
+    assert np.allclose(matrix, [[0.6, 0.8], [0.0, 0.0]])
+
+
+def test_update_existing_index(tmp_path):
+    writer = VectorIndexWriter(str(tmp_path))
+    writer.upsert([section("a-0", [1.0, 0.0]), section("a-1", [0.0, 1.0]), section("b-0", [1.0, 1.0], sourcefile="b.pdf")])
+    writer.save()
+    first_matrix = json.loads((tmp_path / "index.json").read_text())["matrix"]
+
+    # a later run only knows about the sections it processed
+    writer = VectorIndexWriter(str(tmp_path), dtype="float16")
+    assert len(writer.sections) == 3
+    writer.upsert([section("a-1", [0.0, -1.0])])
+    writer.delete(["a-0"])
+    assert writer.remove_file("b.pdf") == 1
+    writer.save()
+
+    metadata = json.loads((tmp_path / "index.json").read_text())
+    assert [s["id"] for s in metadata["sections"]] == ["a-1"]
+    matrix = np.load(tmp_path / metadata["matrix"])
+    assert matrix.dtype == np.float16
+    assert np.allclose(matrix, [[0.0, -1.0]])
+    assert not (tmp_path / first_matrix).exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(["index.json", metadata["matrix"], metadata["keywords"]])
+
+
+def test_empty_index(tmp_path):
+    writer = VectorIndexWriter(str(tmp_path))
+    writer.upsert([section("a-0", [1.0, 0.0])])
+    writer.remove_file(None)
+    writer.save()
+    assert VectorIndexWriter(str(tmp_path)).sections == {}
@@ -0,0 +1,81 @@
+import pytest
+from azure.search.documents.models import AnswerResult, CaptionResult, QueryType
+from conftest import MockSearchClient
+
+from core.retriever import Retriever
+
+DOCS = [
+    {"sourcepage": "Benefit_Options-2.pdf", "content": "Northwind Plus\ncovers eye exams.",
+     "@search.captions": [CaptionResult.from_dict({"text": "covers eye exams"}), CaptionResult.from_dict({"text": "and glasses"})]},
+    {"sourcepage": "Benefit_Options-3.pdf", "content": "Northwind Standard does not.", "@search.captions": []},
+]
+
+
+@pytest.mark.asyncio
+async def test_retrieve_hybrid(embedded):
+    stages = []
+    search_client = MockSearchClient(DOCS)
+    retriever = Retriever(search_client, "embedding", "sourcepage", "content", on_stage=lambda name, elapsed: stages.append(name))
+    results = await retriever.retrieve("eye exams", {"exclude_category": "it's"})
+    assert results == ["Benefit_Options-2.pdf: Northwind Plus covers eye exams.", "Benefit_Options-3.pdf: Northwind Standard does not."]
+    assert embedded == ["eye exams"]
+    assert stages == ["embedding", "search"]
+    search_text, options = search_client.searches[0]
+    assert search_text == "eye exams"
+    assert options["filter"] == "category ne 'it''s'"
+    assert options["top"] == 3
+    assert options["vector"] == [0.5, 0.5]
+    assert options["top_k"] == 50
+    assert options["vector_fields"] == "embedding"
+
+
+@pytest.mark.asyncio
+async def test_retrieve_text_only(embedded):
+    search_client = MockSearchClient(DOCS)
+    await Retriever(search_client, "embedding", "sourcepage", "content").retrieve("eye exams", {"retrieval_mode": "text", "top": 5})
+    assert embedded == []
+    search_text, options = search_client.searches[0]
+    assert search_text == "eye exams"
+    assert options["top"] == 5
+    assert options["vector"] is None
+
+
+@pytest.mark.asyncio
+async def test_retrieve_vectors_only_with_given_vector(embedded):
+    search_client = MockSearchClient(DOCS)
+    await Retriever(search_client, "embedding", "sourcepage", "content").retrieve("eye exams", {"retrieval_mode": "vectors"}, [1.0, 0.0])
+    assert embedded == []
+    search_text, options = search_client.searches[0]
+    assert search_text is None
+    assert options["vector"] == [1.0, 0.0]
+
+
+@pytest.mark.asyncio
+async def test_retrieve_semantic_captions(embedded):
+    search_client = MockSearchClient(DOCS)
+    retriever = Retriever(search_client, "embedding", "sourcepage", "content")
+    results = await retriever.retrieve("eye exams", {"semantic_ranker": True, "semantic_captions": True}, separator=":", caption_separator=" -.- ")
+    assert results[0] == "Benefit_Options-2.pdf:covers eye exams -.- and glasses"
+    options = search_client.searches[0][1]
+    assert options["query_type"] == QueryType.SEMANTIC
+    assert options["query_caption"] == "extractive|highlight-false"
+
+
+@pytest.mark.asyncio
+async def test_lookup_returns_answer_or_content():
+    stages = []
+    search_client = MockSearchClient(DOCS[:1], answers=[AnswerResult.from_dict({"text": "Eye exams are covered."})])
+    retriever = Retriever(search_client, "embedding", "sourcepage", "content", on_stage=lambda name, elapsed: stages.append(name))
+    assert await retriever.lookup("eye exams") == "Eye exams are covered."
+    assert stages == ["lookup"]
+    options = search_client.searches[0][1]
+    assert options["top"] == 1
+    assert options["query_answer"] == "extractive|count-1"
+
+    assert await Retriever(MockSearchClient(DOCS[:1]), "embedding", "sourcepage", "content").lookup("eye exams") == "Northwind Plus\ncovers eye exams."
+    assert await Retriever(MockSearchClient([]), "embedding", "sourcepage", "content").lookup("eye exams") is None
+
+
+def test_format_truncates_content():
+    retriever = Retriever(MockSearchClient(DOCS), "embedding", "sourcepage", "content")
+    assert retriever.format(DOCS[0], False, separator=":", max_length=14) == "Benefit_Options-2.pdf:Northwind Plus"
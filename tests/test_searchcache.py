@@ -0,0 +1,109 @@
+import pytest
+from azure.search.documents.models import CaptionResult, QueryType
+
+from core.searchcache import CachingSearchClient, SearchCache
+
+
+class MockSearchResults:
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def __aiter__(self):
+        for doc in self.documents:
+            yield doc
+
+
+class MockSearchClient:
+    def __init__(self):
+        self.searches = []
+
+    async def search(self, search_text, **kwargs):
+        self.searches.append((search_text, kwargs))
+        return MockSearchResults(
+            [
+                {
+                    "sourcepage": "Benefit_Options-2.pdf",
+                    "content": "There is a whistleblower policy.",
+                    "embedding": [0.1, 0.2],
+                    "@search.score": 1.5,
+                    "@search.captions": [CaptionResult.from_dict({"text": "whistleblower policy"})],
+                }
+            ]
+        )
+
+    async def close(self):
+        self.closed = True
+
+
+def search_cache(tmp_path, **kwargs):
+    return SearchCache(str(tmp_path / "cache.sqlite3"), ttl=60, max_entries=100, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_repeated_search_is_cached(tmp_path):
+    search_client = MockSearchClient()
+    client = CachingSearchClient(search_client, search_cache(tmp_path))
+    for _ in range(2):
+        r = await client.search("whistleblower", filter=None, top=3, query_type=QueryType.SEMANTIC, vector=[0.5, 0.5])
+        docs = [doc async for doc in r]
+        assert docs[0]["sourcepage"] == "Benefit_Options-2.pdf"
+        assert docs[0]["@search.captions"][0].text == "whistleblower policy"
+        assert "embedding" not in docs[0]
+    assert len(search_client.searches) == 1
+
+    await client.search("whistleblower", filter=None, top=5, query_type=QueryType.SEMANTIC, vector=[0.5, 0.5])
+    assert len(search_client.searches) == 2
+
+
+@pytest.mark.asyncio
+async def test_new_generation_invalidates_results(tmp_path):
+    generations = iter(["1", "1", "2"])
+
+    async def get_generation():
+        return next(generations)
+
+    search_client = MockSearchClient()
+    client = CachingSearchClient(search_client, search_cache(tmp_path, generation_source=get_generation, generation_refresh=0))
+    for _ in range(3):
+        await client.search("whistleblower", top=3)
+    assert len(search_client.searches) == 2
+
+
+@pytest.mark.asyncio
+async def test_generation_is_refreshed_periodically(tmp_path):
+    calls = []
+
+    async def get_generation():
+        calls.append(1)
+        return "1"
+
+    cache = search_cache(tmp_path, generation_source=get_generation, generation_refresh=3600)
+    assert await cache.generation() == "1"
+    assert await cache.generation() == "1"
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_generation_errors_keep_previous_generation(tmp_path):
+    async def get_generation():
+        raise ConnectionError("storage is down")
+
+    cache = search_cache(tmp_path, generation_source=get_generation, generation_refresh=0)
+    assert await cache.generation() == ""
+
+
+@pytest.mark.asyncio
+async def test_count_and_answer_searches_are_not_cached(tmp_path):
+    search_client = MockSearchClient()
+    client = CachingSearchClient(search_client, search_cache(tmp_path))
+    for _ in range(2):
+        r = await client.search("whistleblower", top=1, include_total_count=True, query_answer="extractive|count-1")
+        assert isinstance(r, MockSearchResults)
+    assert len(search_client.searches) == 2
+
+
+@pytest.mark.asyncio
+async def test_other_methods_are_delegated(tmp_path):
+    search_client = MockSearchClient()
+    await CachingSearchClient(search_client, search_cache(tmp_path)).close()
+    assert search_client.closed
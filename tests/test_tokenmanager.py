@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import pytest
+from azure.core.credentials import AccessToken
+
+from core.tokenmanager import TokenManager
+
+
+class MockCredential:
+    def __init__(self, lifetime, failures=0):
+        self.lifetime = lifetime
+        self.failures = failures
+        self.calls = 0
+
+    async def get_token(self, scope):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("identity endpoint unavailable")
+        return AccessToken(f"token{self.calls}", int(time.time() + self.lifetime))
+
+
+@pytest.mark.asyncio
+async def test_start_fetches_first_token():
+    refreshed = []
+    manager = TokenManager(MockCredential(3600), "scope", refreshed.append)
+    await manager.start()
+    assert manager.token.token == "token1"
+    assert refreshed == [manager.token]
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_refresh_is_single_flight():
+    credential = MockCredential(3600)
+    manager = TokenManager(credential, "scope", lambda token: None)
+    tokens = await asyncio.gather(*[manager.refresh() for _ in range(10)])
+    assert credential.calls == 1
+    assert {token.token for token in tokens} == {"token1"}
+
+
+@pytest.mark.asyncio
+async def test_refreshes_in_background_before_expiry():
+    refreshed = []
+    credential = MockCredential(2)
+    manager = TokenManager(credential, "scope", refreshed.append, refresh_margin=1.5)
+    await manager.start()
+    await asyncio.sleep(1)
+    await manager.close()
+    assert credential.calls >= 2
+    assert [token.token for token in refreshed][:2] == ["token1", "token2"]
+
+
+@pytest.mark.asyncio
+async def test_retries_failed_refresh():
+    credential = MockCredential(2)
+    manager = TokenManager(credential, "scope", lambda token: None, refresh_margin=2, retry_interval=0.05)
+    await manager.start()
+    credential.failures = 2
+    await asyncio.sleep(0.3)
+    await manager.close()
+    assert credential.calls >= 4
+    assert manager.token.token != "token1"
+
+
+@pytest.mark.asyncio
+async def test_short_lived_token_is_not_refreshed_in_a_loop():
+    # A token within the refresh margin, like the cached one azure-identity returns when it can't refresh it
+    credential = MockCredential(200)
+    manager = TokenManager(credential, "scope", lambda token: None, refresh_margin=300, retry_interval=0.1)
+    await manager.start()
+    await asyncio.sleep(0.25)
+    await manager.close()
+    assert 2 <= credential.calls <= 5
@@ -0,0 +1,144 @@
+import math
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+from core.keywordindex import tokenize
+from core.vectorindex import (
+    FallbackSearchClient,
+    LocalSearchClient,
+    LocalVectorIndex,
+    reciprocal_rank_fusion,
+)
+from prepdocslib.vectorindex import VectorIndexWriter
+
+WORDS = ["eye", "exams", "dental", "vision", "plan", "deductible", "northwind", "health", "plus", "standard", "copay", "claims"]
+
+
+def write_index(directory, embeddings, categories=None, contents=None):
+    writer = VectorIndexWriter(str(directory))
+    writer.upsert([{"id": f"doc-{i}", "content": contents[i] if contents else f"content {i}", "category": (categories or {}).get(i),
+                    "sourcepage": f"doc-{i}.pdf", "sourcefile": "doc.pdf", "embedding": embedding} for i, embedding in enumerate(embeddings)])
+    writer.save()
+
+
+def reference_bm25(contents, query, k1=1.2, b=0.75):
+    docs = [Counter(tokenize(content)) for content in contents]
+    lengths = [sum(doc.values()) for doc in docs]
+    average = sum(lengths) / len(lengths)
+    scores = []
+    for doc, length in zip(docs, lengths):
+        score = 0.0
+        for term in set(tokenize(query)):
+            df = sum(1 for d in docs if term in d)
+            if term in doc:
+                idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+                score += idf * doc[term] * (k1 + 1) / (doc[term] + k1 * (1 - b + b * length / average))
+        scores.append(score)
+    return scores
+
+
+def test_search_matches_exact_cosine_ranking(tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(500, 64)).astype(np.float32)
+    write_index(tmp_path, embeddings.tolist())
+    # Small blocks, so the scores of several blocks are compared
+    index = LocalVectorIndex(str(tmp_path), block_size=64)
+    query = rng.normal(size=64)
+
+    expected = embeddings @ query / np.linalg.norm(embeddings, axis=1) / np.linalg.norm(query)
+    results = index.search(query.tolist(), top=5)
+    assert [section["id"] for section, _ in results] == [f"doc-{i}" for i in np.argsort(-expected)[:5]]
+    assert np.allclose([score for _, score in results], np.sort(expected)[::-1][:5], atol=1e-2)
+    assert isinstance(index.matrix, np.memmap)
+
+
+@pytest.mark.asyncio
+async def test_search_client(tmp_path):
+    write_index(tmp_path, [[1.0, 0.0], [0.9, 0.1], [0.0, 1.0]], categories={0: "it's excluded"})
+    client = LocalSearchClient(LocalVectorIndex(str(tmp_path)))
+
+    results = await client.search("query", filter="category ne 'it''s excluded'", top=2, vector=[1.0, 0.0], query_caption="extractive|highlight-false")
+    documents = [doc async for doc in results]
+    assert [doc["id"] for doc in documents] == ["doc-1", "doc-2"]
+    assert documents[0]["@search.captions"][0].text == "content 1"
+    assert documents[0]["@search.score"] > documents[1]["@search.score"]
+    assert await results.get_count() == 2
+
+    results = await client.search(None, top=10, vector=[0.0, 1.0])
+    assert len([doc async for doc in results]) == 3
+
+    with pytest.raises(ValueError):
+        await client.search(None, filter="sourcefile eq 'a.pdf'", top=3, vector=[1.0, 0.0])
+
+
+def test_reload_new_index(tmp_path):
+    write_index(tmp_path, [[1.0, 0.0]])
+    index = LocalVectorIndex(str(tmp_path), refresh_interval=0)
+    write_index(tmp_path, [[1.0, 0.0], [0.0, 1.0]])
+    # Make sure the modification time changes even on file systems with a coarse resolution
+    stat = os.stat(tmp_path / "index.json")
+    os.utime(tmp_path / "index.json", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert [section["id"] for section, _ in index.search([0.0, 1.0], top=1)] == ["doc-1"]
+
+
+def test_keyword_search_matches_reference_bm25(tmp_path):
+    rng = np.random.default_rng(0)
+    contents = [" ".join(rng.choice(WORDS, size=rng.integers(5, 40))) for _ in range(200)]
+    write_index(tmp_path, rng.normal(size=(200, 8)).tolist(), contents=contents)
+    index = LocalVectorIndex(str(tmp_path))
+
+    for query in ["eye exams", "Northwind PLUS deductible deductible", "copay", "unknown words"]:
+        expected = reference_bm25(contents, query)
+        assert np.allclose(index.keywords.scores(query), expected, atol=1e-4)
+        results = index.keyword_search(query, top=5)
+        assert [score for _, score in results] == pytest.approx(sorted([s for s in expected if s > 0], reverse=True)[:5], abs=1e-4)
+    assert index.keyword_search("unknown words", top=5) == []
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([[1, 2, 3], [3, 1]], k=60)
+    assert [doc for doc, _ in fused] == [1, 3, 2]
+    assert fused[0][1] == pytest.approx(1 / 61 + 1 / 62)
+
+
+@pytest.mark.asyncio
+async def test_search_client_text_and_hybrid(tmp_path):
+    contents = ["dental plan", "eye exams and vision", "eye exams", "claims"]
+    write_index(tmp_path, [[1.0, 0.0], [0.0, 1.0], [0.5, 0.5], [0.9, 0.1]], categories={2: "excluded"}, contents=contents)
+    client = LocalSearchClient(LocalVectorIndex(str(tmp_path)))
+
+    results = await client.search("eye exams", top=3)
+    assert [doc["id"] async for doc in results] == ["doc-2", "doc-1"]
+    results = await client.search("eye exams", filter="category ne 'excluded'", top=3)
+    assert [doc["id"] async for doc in results] == ["doc-1"]
+
+    # doc-1 ranks first for text and last for the vector, doc-0 first for the vector only
+    results = await client.search("vision", top=2, top_k=50, vector=[1.0, 0.0])
+    documents = [doc async for doc in results]
+    assert [doc["id"] for doc in documents] == ["doc-1", "doc-0"]
+    assert documents[0]["@search.score"] == pytest.approx(1 / 61 + 1 / 64)
+
+
+class ThrottledSearchClient:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    async def search(self, search_text, **kwargs):
+        error = HttpResponseError(message="throttled")
+        error.status_code = self.status_code
+        raise error
+
+
+@pytest.mark.asyncio
+async def test_fallback_search_client(tmp_path):
+    write_index(tmp_path, [[1.0, 0.0], [0.0, 1.0]], contents=["eye exams", "dental"])
+    fallback = LocalSearchClient(LocalVectorIndex(str(tmp_path)))
+
+    results = await FallbackSearchClient(ThrottledSearchClient(429), fallback).search("dental", top=3)
+    assert [doc["id"] async for doc in results] == ["doc-1"]
+    with pytest.raises(HttpResponseError):
+        await FallbackSearchClient(ThrottledSearchClient(400), fallback).search("dental", top=3)